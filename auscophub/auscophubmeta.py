@@ -16,7 +16,9 @@ class AusCopHubMeta(object):
     zipfiles delivered by ESA. 
     
     Same class is used for Sentinel-1 and Sentinel-2 (and probably 3 when we get to it). 
-    Not all attributes will be present, depending on the satellite. 
+    Not all attributes will be present, depending on the satellite. Those which are
+    only relevant for some satellites (centroid, cloud cover, polarisation, swath, mode 
+    and pass direction) are always present, but are None when not given in the XML. 
     
     Attributes:
         satellite:               String, e.g. S1A, S2A, etc. 
@@ -47,6 +49,16 @@ class AusCopHubMeta(object):
         # Save the XML string on the object, so we can see it later on, if required. 
         self.xmlStr = xmlStr
         
+        # Optional attributes default to None, so that users can test them 
+        # directly, rather than with hasattr()
+        self.ctrLong = None
+        self.ctrLat = None
+        self.cloudCoverPcnt = None
+        self.polarisationValuesList = None
+        self.swathValuesList = None
+        self.mode = None
+        self.passDirection = None
+        
         doc = minidom.parseString(xmlStr)
         
         safeDescrNodeList = doc.getElementsByTagName('AUSCOPHUB_SAFE_FILEDESCRIPTION')
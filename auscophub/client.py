@@ -9,7 +9,13 @@ downloading data.
 """
 from __future__ import print_function, division
 
+import os
+import re
 import sys
+import sqlite3
+import hashlib
+import threading
+from concurrent import futures
 from xml.dom import minidom
 import xml.parsers.expat
 
@@ -30,6 +36,11 @@ THREDDS_SEN1_CATALOG_BASE = "{}/{}/Sentinel-1".format(THREDDS_CATALOG_BASE, THRE
 THREDDS_SEN2_CATALOG_BASE = "{}/{}/Sentinel-2".format(THREDDS_CATALOG_BASE, THREDDS_COPERNICUS_SUBDIR)
 THREDDS_SEN3_CATALOG_BASE = "{}/{}/Sentinel-3".format(THREDDS_CATALOG_BASE, THREDDS_COPERNICUS_SUBDIR)
 
+# Default number of concurrent reads of XML files from the server
+DEFAULT_NUM_THREADS = 16
+# Name of the SQLite index of cached XML files, within the cache directory
+METAINDEX_FILENAME = "metaindex.sqlite"
+
 
 def makeUrlOpener(proxy=None):
     """
@@ -47,7 +58,8 @@ def makeUrlOpener(proxy=None):
 
 
 def getDescriptionMetaFromThreddsByBounds(urlOpener, sentinelNumber, instrumentStr, 
-        productId, startDate, endDate, longLatBoundingBox):
+        productId, startDate, endDate, longLatBoundingBox, cacheDir=None, 
+        numThreads=DEFAULT_NUM_THREADS):
     """
     Search the THREDDS server and return a list of AusCopHubMeta objects for
     the given sentinel number, the given product, and are within the time and
@@ -67,6 +79,10 @@ def getDescriptionMetaFromThreddsByBounds(urlOpener, sentinelNumber, instrumentS
         boundingBox (tuple): Search region lat/long bounding box in decimal degrees, in
                 the form (westLong, eastLong, southLat, northLat), with negative values for
                 south of equator and west of Greenwich. 
+        cacheDir (str): If not None, a local directory in which to cache the XML files
+                read from the server. Files already in the cache are not read again, 
+                unless the modified date or size in the server's catalog has changed. 
+        numThreads (int): Number of threads with which to read the XML files from the server
 
     In future, support may be added for products RAW and OCN for Sentinel-1, and L2A for Sentinel-2. 
 
@@ -147,25 +163,210 @@ def getDescriptionMetaFromThreddsByBounds(urlOpener, sentinelNumber, instrumentS
         dirlists = ThreddsServerDirList(urlOpener, subdirObj.fullUrl)
         dsObjList.extend([dsObj for dsObj in dirlists.datasets if dsObj.name.endswith(".xml")])
     
-    # Create a list of the meta files and their contents
-    metaList = []
-    for dsObj in dsObjList:
-        url = dsObj.fullUrl
-        xmlStr = urlOpener.open(url).read()
-        try:
-            metaObj = auscophubmeta.AusCopHubMeta(xmlStr=xmlStr)
-        except Exception:
-            metaObj = None
+    # Create a list of the meta files and their contents. These are many small reads, 
+    # so do them in a pool of threads
+    urlList = [dsObj.fullUrl for dsObj in dsObjList]
+    versionByUrl = dict([(dsObj.fullUrl, dsObj.versionStr) for dsObj in dsObjList])
+    
+    # Files we have seen before, at the same version as now in the catalog, and which 
+    # are known to be outside the search bounds, need not be read again
+    metaIndex = openMetaIndex(cacheDir)
+    try:
+        indexedVersions = {}
+        if metaIndex is not None:
+            (indexedVersions, matchingUrls) = searchMetaIndex(metaIndex, longLatBoundingBox, 
+                startDate, endDate)
+            urlList = [url for url in urlList 
+                if not indexIsCurrent(indexedVersions, url, versionByUrl[url]) or 
+                    url in matchingUrls]
         
-        if metaObj is not None:
-            # Filter by exact date, instead of just month, as above
-            yyyymmdd = metaObj.startTime.strftime("%Y%m%d")
-            if yyyymmdd >= startDate and yyyymmdd <= endDate:
-                metaList.append((url, metaObj))
+        with futures.ThreadPoolExecutor(max_workers=numThreads) as executor:
+            metaObjList = list(executor.map(lambda url: readMetaFromUrl(urlOpener, url, cacheDir, 
+                versionByUrl[url]), urlList))
+        
+        metaList = []
+        for (url, metaObj) in zip(urlList, metaObjList):
+            if metaObj is not None:
+                versionStr = versionByUrl[url]
+                if metaIndex is not None and not indexIsCurrent(indexedVersions, url, versionStr):
+                    addToMetaIndex(metaIndex, url, versionStr, metaObj)
+                # Filter by exact date, instead of just month, as above
+                yyyymmdd = metaObj.startTime.strftime("%Y%m%d")
+                if yyyymmdd >= startDate and yyyymmdd <= endDate:
+                    metaList.append((url, metaObj))
+    finally:
+        if metaIndex is not None:
+            metaIndex.commit()
+            metaIndex.close()
     
     return metaList
 
 
+def indexIsCurrent(indexedVersions, url, versionStr):
+    """
+    Return True if the index entry for the given URL is for the given version of 
+    the file. If versionStr is None, the version cannot be known, so it is never
+    current. 
+    """
+    return (versionStr is not None and indexedVersions.get(url) == versionStr)
+
+
+def openMetaIndex(cacheDir):
+    """
+    Open the SQLite index of XML files in the given cache directory, creating it if
+    necessary. This records the footprint envelope and acquisition date of each 
+    XML file read, and the version of the file it was read from (as given in the
+    catalog), with an R-tree on the envelopes. Returns an sqlite3 connection, 
+    or None if cacheDir is None, or the index cannot be used (e.g. if this SQLite 
+    has no R-tree support). 
+    
+    An index from before the version was recorded cannot be trusted, so it is 
+    discarded and started again. 
+    
+    """
+    conn = None
+    if cacheDir is not None:
+        try:
+            if not os.path.exists(cacheDir):
+                os.makedirs(cacheDir)
+            conn = sqlite3.connect(os.path.join(cacheDir, METAINDEX_FILENAME))
+            columnNames = [row[1] for row in conn.execute("PRAGMA table_info(meta)")]
+            if len(columnNames) > 0 and 'version' not in columnNames:
+                conn.execute("DROP TABLE meta")
+                conn.execute("DROP TABLE IF EXISTS footprint_rtree")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                "(id INTEGER PRIMARY KEY, url TEXT UNIQUE, version TEXT, startdate TEXT)")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS footprint_rtree "
+                "USING rtree(id, minx, maxx, miny, maxy)")
+        except (sqlite3.Error, OSError):
+            conn = None
+    return conn
+
+
+def searchMetaIndex(conn, longLatBoundingBox, startDate, endDate):
+    """
+    Search the index for XML files within the given bounding box and date range. 
+    Returns a tuple
+        (indexedVersions, matchingUrls)
+    where indexedVersions is a dictionary of the version of every URL in the index,
+    keyed by URL, and matchingUrls is the set of those whose footprint envelope 
+    intersects the bounding box, and whose date is in range. 
+    
+    """
+    (westLong, eastLong, southLat, northLat) = longLatBoundingBox
+    indexedVersions = dict(conn.execute("SELECT url, version FROM meta"))
+    matchingUrls = set([row[0] for row in conn.execute(
+        "SELECT meta.url FROM footprint_rtree JOIN meta ON meta.id = footprint_rtree.id "
+        "WHERE footprint_rtree.minx <= ? AND footprint_rtree.maxx >= ? AND "
+        "footprint_rtree.miny <= ? AND footprint_rtree.maxy >= ? AND "
+        "meta.startdate >= ? AND meta.startdate <= ?",
+        (eastLong, westLong, northLat, southLat, startDate, endDate))])
+    return (indexedVersions, matchingUrls)
+
+
+def addToMetaIndex(conn, url, versionStr, metaObj):
+    """
+    Add the given XML file URL, the version of the file (from the catalog), and its 
+    AusCopHubMeta object to the index, replacing any entry for an older version. 
+    Objects with no footprint, or no known version, are not added, so they are 
+    always read. 
+    
+    """
+    footprintWkt = getattr(metaObj, 'footprintWkt', None)
+    if footprintWkt is not None and versionStr is not None:
+        (minx, maxx, miny, maxy) = wktEnvelope(footprintWkt)
+        yyyymmdd = metaObj.startTime.strftime("%Y%m%d")
+        for (oldId,) in conn.execute("SELECT id FROM meta WHERE url = ?", (url,)).fetchall():
+            conn.execute("DELETE FROM footprint_rtree WHERE id = ?", (oldId,))
+            conn.execute("DELETE FROM meta WHERE id = ?", (oldId,))
+        cursor = conn.execute("INSERT INTO meta (url, version, startdate) VALUES (?, ?, ?)", 
+            (url, versionStr, yyyymmdd))
+        conn.execute("INSERT INTO footprint_rtree VALUES (?, ?, ?, ?, ?)",
+            (cursor.lastrowid, minx, maxx, miny, maxy))
+
+
+def wktEnvelope(wkt):
+    """
+    Return the (xMin, xMax, yMin, yMax) envelope of a 2-d WKT geometry string, 
+    without needing OGR. 
+    
+    """
+    coords = [float(v) for v in re.findall(r"[-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?", wkt)]
+    xVals = coords[0::2]
+    yVals = coords[1::2]
+    return (min(xVals), max(xVals), min(yVals), max(yVals))
+
+
+def readMetaFromUrl(urlOpener, url, cacheDir, versionStr=None):
+    """
+    Read the XML file at the given URL (or from the cache in cacheDir, if present), 
+    and return an AusCopHubMeta object of its contents. Returns None if the XML
+    could not be parsed. 
+    
+    The versionStr is that of the file's ThreddsDatasetEntry, and is part of the 
+    cache key, so a file which has been re-written on the server is read again. 
+    If it is None, there is no way to tell, so the cache is not used. 
+    
+    """
+    cacheFile = makeCacheFilename(cacheDir, url, versionStr)
+    fromCache = (cacheFile is not None and os.path.exists(cacheFile))
+    if fromCache:
+        with open(cacheFile, 'rb') as f:
+            xmlStr = f.read()
+    else:
+        xmlStr = urlOpener.open(url).read()
+    try:
+        metaObj = auscophubmeta.AusCopHubMeta(xmlStr=xmlStr)
+    except Exception:
+        metaObj = None
+    
+    if metaObj is not None and cacheFile is not None and not fromCache:
+        saveToCache(cacheFile, xmlStr)
+    return metaObj
+
+
+def makeCacheFilename(cacheDir, url, versionStr):
+    """
+    Return the name of the file in cacheDir which would hold a cached copy of the 
+    given version of the given URL, or None if cacheDir or versionStr is None. The 
+    name is a hash of the URL and versionStr. 
+    
+    """
+    cacheFile = None
+    if cacheDir is not None and versionStr is not None:
+        key = "{}\n{}".format(url, versionStr)
+        keyHash = hashlib.md5(key.encode('utf-8')).hexdigest()
+        cacheFile = os.path.join(cacheDir, keyHash[:2], keyHash + ".xml")
+    return cacheFile
+
+
+def saveToCache(cacheFile, xmlStr):
+    """
+    Write the given XML string to the given cache file. It is written to a temporary 
+    name and then renamed, so that an interrupted run does not leave a partial file 
+    in the cache. Failure to write the cache is not an error, it just means the 
+    file will be read from the server again next time. 
+    
+    """
+    if not isinstance(xmlStr, bytes):
+        xmlStr = xmlStr.encode('utf-8')
+    tmpFile = "{}.{}.{}.tmp".format(cacheFile, os.getpid(), threading.current_thread().ident)
+    cacheSubdir = os.path.dirname(cacheFile)
+    if not os.path.exists(cacheSubdir):
+        try:
+            os.makedirs(cacheSubdir)
+        except OSError:
+            # Probably another thread has just created it
+            pass
+    try:
+        with open(tmpFile, 'wb') as f:
+            f.write(xmlStr)
+        os.rename(tmpFile, cacheFile)
+    except (IOError, OSError):
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+
 def gridCellDirWithinBounds(gridCellDirName, northLat, southLat, westLong, eastLong):
     """
     Return True if the given grid cell directory name lies at least partially within the 
@@ -238,11 +439,36 @@ class ThreddsServerDirList(object):
 class ThreddsDatasetEntry(object):
     """
     Details of a <dataset> tag in the catalog.xml
+    
+    The versionStr attribute combines the modified date and the size of the 
+    file, as given in the catalog, so that it changes whenever the file on the 
+    server is re-written. It is None if the catalog gives neither of these. 
     """
     def __init__(self, datasetNode):
         self.name = datasetNode.getAttribute('name').strip()
         self.urlPath = datasetNode.getAttribute('urlPath').strip()
         self.fullUrl = "{}/{}".format(THREDDS_FILES_BASE, self.urlPath)
+        
+        modifiedStr = ""
+        for dateNode in datasetNode.getElementsByTagName('date'):
+            if dateNode.getAttribute('type') == 'modified':
+                modifiedStr = nodeText(dateNode)
+        sizeStr = ""
+        sizeNodeList = datasetNode.getElementsByTagName('dataSize')
+        if len(sizeNodeList) > 0:
+            sizeStr = "{}{}".format(nodeText(sizeNodeList[0]), 
+                sizeNodeList[0].getAttribute('units'))
+        self.versionStr = None
+        if modifiedStr != "" or sizeStr != "":
+            self.versionStr = "{}|{}".format(modifiedStr, sizeStr)
+
+
+def nodeText(node):
+    """
+    Return the stripped text content of the given minidom node
+    """
+    return ''.join([child.data for child in node.childNodes 
+        if child.nodeType == child.TEXT_NODE]).strip()
 
 
 class ThreddsCatalogRefEntry(object):
@@ -253,7 +479,10 @@ class ThreddsCatalogRefEntry(object):
         self.href = catalogRefNode.getAttribute('xlink:href').strip()
         self.idStr = catalogRefNode.getAttribute('ID').strip()
         self.title = catalogRefNode.getAttribute('xlink:title').strip()
-        self.fullUrl = "{}/{}".format(baseUrl.strip("/catalog.xml"), self.href)
+        # Note that str.strip("/catalog.xml") would remove any of those characters from the end
+        if baseUrl.endswith("/catalog.xml"):
+            baseUrl = baseUrl[:-len("/catalog.xml")]
+        self.fullUrl = "{}/{}".format(baseUrl, self.href)
 
 
 def getThreddsCatalogXml(urlOpener, baseUrl, returnXmlString=False):
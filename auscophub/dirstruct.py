@@ -7,9 +7,11 @@ from __future__ import print_function, division
 
 import sys
 import os
+import errno
 import shutil
 import hashlib
-import subprocess
+import tempfile
+from xml.sax import saxutils
 from PIL import Image
 isPython3 = (sys.version_info.major == 3)
 if isPython3:
@@ -29,6 +31,11 @@ stdGridCellSize = {
 }
 
 
+# Rename a file, replacing any existing file of the new name. This is what os.rename()
+# does on POSIX, but os.replace() does it everywhere. Python 2 does not have os.replace(). 
+replaceFile = getattr(os, 'replace', os.rename)
+
+
 # Some octal constants to use as permission modes in things like chmod()
 UNIXMODE_UrwxGrwxOrx = 0o775
 UNIXMODE_UrwGrOr     = 0o644
@@ -86,11 +93,29 @@ def makeGridSquareDir(metainfo, gridCellSize):
     i = int(latitude / gridCellSize)
     j = int(longitude / gridCellSize)
     
+    # The name depends only on the cell indexes (and which side of zero, as int() 
+    # truncates towards zero), so many files in a run share the same one
+    key = (i, j, longitude < 0, latitude < 0, gridCellSize)
+    if key not in gridSquareDirCache:
+        gridSquareDirCache[key] = gridSquareDirName(*key)
+    return gridSquareDirCache[key]
+
+
+# Cache of grid square directory names, keyed by the arguments to gridSquareDirName()
+gridSquareDirCache = {}
+
+
+def gridSquareDirName(i, j, longIsNeg, latIsNeg, gridCellSize):
+    """
+    Make the grid square directory name for the grid cell with lat/long indexes 
+    i and j. The longIsNeg and latIsNeg flags are True for a centroid west and south
+    of zero, respectively. 
+    """
     longitude5left = j * gridCellSize
-    if longitude < 0:
+    if longIsNeg:
         longitude5left = longitude5left - gridCellSize
     latitude5bottom = i * gridCellSize
-    if latitude < 0:
+    if latIsNeg:
         latitude5bottom = latitude5bottom - gridCellSize
     
     # Now the top and right
@@ -130,11 +155,15 @@ def makeYearMonthDir(metainfo):
     the months up a bit. After we have a few years of data, it could become rather onerous
     if we do not divide them. 
     """
-    year = metainfo.startTime.year
-    month = metainfo.startTime.month
-    
-    dirName = os.path.join("{:04}".format(year), "{:04}-{:02}".format(year, month))
-    return dirName
+    key = (metainfo.startTime.year, metainfo.startTime.month)
+    if key not in yearMonthDirCache:
+        (year, month) = key
+        yearMonthDirCache[key] = os.path.join("{:04}".format(year), "{:04}-{:02}".format(year, month))
+    return yearMonthDirCache[key]
+
+
+# Cache of year/month directory names, keyed by (year, month)
+yearMonthDirCache = {}
 
 
 def makeDateDir(metainfo):
@@ -214,41 +243,41 @@ def checkFinalDir(finalOutputDir, dummy, verbose):
     Check that the final output dir exists, and has write permission. If it does not exist,
     then create it
     """
-    exists = os.path.exists(finalOutputDir)
-    if not exists:
-        if dummy:
+    if dummy:
+        if not os.path.exists(finalOutputDir):
             print("Would make dir", finalOutputDir)
-        else:
+    else:
+        # Just try to create it, rather than checking first. If it is already there, 
+        # possibly made by another process in the meantime, then just move along. 
+        # Anything else is re-raised, so we don't mask any other problems. 
+        try:
+            os.makedirs(finalOutputDir, UNIXMODE_UrwxGrwxOrx)   # Should the permissions come from the command line?
             if verbose:
-                print("Creating dir", finalOutputDir)
-            try:
-                os.makedirs(finalOutputDir, UNIXMODE_UrwxGrwxOrx)   # Should the permissions come from the command line?
-            except OSError as e:
-                # If the error was just "File exists", then just move along, as it just means that
-                # the directory was created by another process after we checked. If it was anything 
-                # else then re-raise the exception, so we don't mask any other problems. 
-                if "File exists" not in str(e):
-                    raise 
-
-    if not dummy:
+                print("Created dir", finalOutputDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(finalOutputDir):
+                raise 
+
         writeable = os.access(finalOutputDir, os.W_OK)
         if not writeable:
             raise AusCopDirStructError("Output directory {} is not writeable".format(finalOutputDir))
 
 
 def moveZipfile(zipfilename, finalOutputDir, dummy, verbose, makeCopy, makeSymlink, nooverwrite,
-        moveandsymlink, makereadonly=False):
+        moveandsymlink, makereadonly=False, makeHardlink=False):
     """
-    Move the given zipfile to the final output directory
+    Move the given zipfile to the final output directory. If makeHardlink is True, 
+    then hard link it instead, falling back to a copy if it is on a different filesystem. 
     """
     preExisting = False
     finalFile = os.path.join(finalOutputDir, os.path.basename(zipfilename))
-    if os.path.exists(finalFile):
-        if os.path.abspath(zipfilename)== os.path.abspath(finalFile):
-            if verbose:
-                print ("Zipfile", zipfilename, "already in final location. No move is required. ")
-            preExisting = True
-        elif nooverwrite:
+    # The zipfile is known to exist, so if it is already at finalFile, no need to stat that
+    if os.path.abspath(zipfilename) == os.path.abspath(finalFile):
+        if verbose:
+            print ("Zipfile", zipfilename, "already in final location. No move is required. ")
+        preExisting = True
+    elif os.path.exists(finalFile):
+        if nooverwrite:
             if verbose:
                 print("Zipfile", zipfilename, "already in final location. Not moved. ")
             preExisting = True
@@ -264,10 +293,24 @@ def moveZipfile(zipfilename, finalOutputDir, dummy, verbose, makeCopy, makeSymli
         if dummy:
             print("Would move to", finalFile)
         else:
-            if makeCopy:
+            if makeHardlink:
+                try:
+                    os.link(zipfilename, finalFile)
+                    if verbose:
+                        print("Hard link to", finalFile)
+                except OSError as e:
+                    # Cannot link across filesystems, so copy it instead
+                    if e.errno != errno.EXDEV:
+                        raise
+                    if verbose:
+                        print("Different filesystem, copy to", finalFile)
+                    copyFile(zipfilename, finalFile)
+                    shutil.copystat(zipfilename, finalFile)
+                if makereadonly: os.chmod(finalFile, UNIXMODE_UrGrOr)
+            elif makeCopy:
                 if verbose:
                     print("Copy to", finalFile)
-                shutil.copyfile(zipfilename, finalFile)
+                copyFile(zipfilename, finalFile)
                 shutil.copystat(zipfilename, finalFile)
                 if makereadonly: os.chmod(finalFile, UNIXMODE_UrGrOr)
             elif makeSymlink:
@@ -284,6 +327,109 @@ def moveZipfile(zipfilename, finalOutputDir, dummy, verbose, makeCopy, makeSymli
                     os.symlink(os.path.abspath(finalFile), os.path.abspath(zipfilename))
 
 
+# Size of each chunk when copying zipfiles ourselves
+COPY_CHUNKSIZE = 4 * 1024 * 1024
+# Largest byte count to ask for in a single sendfile() or copy_file_range() call
+KERNEL_COPY_MAXBLOCK = 1024 * 1024 * 1024
+
+
+def copyFile(srcFile, dstFile):
+    """
+    Copy the contents of srcFile to dstFile. The zipfiles are often several GB, so 
+    avoid pushing them through small user-space buffers. Where os.copy_file_range() 
+    exists (Python 3.8+ on Linux), try that first, as the kernel can then copy 
+    without reading the data at all on filesystems which support it (e.g. reflinks 
+    on btrfs/XFS, or server-side copy on NFS 4.2). Otherwise, from Python 3.8, 
+    shutil.copyfile() already uses sendfile() on Linux. Before that, use 
+    os.sendfile() ourselves where it exists, otherwise copy in large chunks. 
+    """
+    if hasattr(os, 'copy_file_range') and copyFileRange(srcFile, dstFile):
+        return
+
+    if sys.version_info >= (3, 8):
+        shutil.copyfile(srcFile, dstFile)
+    else:
+        with open(srcFile, 'rb') as fsrc, open(dstFile, 'wb') as fdst:
+            copied = False
+            if hasattr(os, 'sendfile'):
+                try:
+                    offset = 0
+                    blocksize = kernelCopyBlocksize(os.fstat(fsrc.fileno()).st_size)
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, blocksize)
+                    while sent > 0:
+                        offset += sent
+                        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, blocksize)
+                    copied = True
+                except OSError as e:
+                    # Some filesystems do not support it, in which case nothing 
+                    # has been written yet, so just do it the ordinary way
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS) or offset > 0:
+                        raise
+            if not copied:
+                shutil.copyfileobj(fsrc, fdst, COPY_CHUNKSIZE)
+
+
+# Errors from copy_file_range() which just mean it can't be used for this pair of files
+COPY_FILE_RANGE_UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, 
+    errno.EPERM])
+
+
+def copyFileRange(srcFile, dstFile):
+    """
+    Copy srcFile to dstFile with os.copy_file_range(). Returns True if this worked, 
+    or False if it is not supported for these files, in which case nothing has 
+    been copied and the caller should do it some other way. 
+    
+    It keeps going until the whole size of srcFile has been copied. Some filesystems
+    (and older kernels) just return 0 instead of raising an error when they can't
+    do this, so a 0 before anything has been copied also counts as not supported. 
+    A 0 part way through would leave a short file, so that raises an error. 
+    """
+    with open(srcFile, 'rb') as fsrc, open(dstFile, 'wb') as fdst:
+        fileSize = os.fstat(fsrc.fileno()).st_size
+        blocksize = kernelCopyBlocksize(fileSize)
+        copiedBytes = 0
+        try:
+            while copiedBytes < fileSize:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), blocksize)
+                if copied == 0:
+                    if copiedBytes == 0:
+                        return False
+                    raise AusCopDirStructError(
+                        "Copy of {} to {} stopped after {} of {} bytes".format(srcFile, 
+                            dstFile, copiedBytes, fileSize))
+                copiedBytes += copied
+        except OSError as e:
+            if e.errno not in COPY_FILE_RANGE_UNSUPPORTED or copiedBytes > 0:
+                raise
+            return False
+    return True
+
+
+def kernelCopyBlocksize(fileSize):
+    """
+    Return the byte count to ask for in each sendfile()/copy_file_range() call when 
+    copying a file of the given size. No data passes through user space with these, 
+    so ask for the whole file at once (with COPY_CHUNKSIZE as the minimum), and the 
+    kernel will usually do it in one or two calls. Capped at 1 GiB, which is safe 
+    for a 32-bit size_t. 
+    """
+    return min(max(fileSize, COPY_CHUNKSIZE), KERNEL_COPY_MAXBLOCK)
+
+
+def makeFinalFilename(filename, finalOutputDir, oldSuffix, newSuffix):
+    """
+    Return the name of a file to go alongside the given one in the final output
+    directory, with its oldSuffix swapped for newSuffix. Only a trailing oldSuffix 
+    is removed. If it is not there, newSuffix is just appended, so that the 
+    result can never be the same name as the original file. 
+    """
+    basename = os.path.basename(filename)
+    if basename.endswith(oldSuffix):
+        basename = basename[:-len(oldSuffix)]
+    return os.path.join(finalOutputDir, basename + newSuffix)
+
+
 def createSentinel1Xml(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOverwrite,
         md5esa, makereadonly=False):
     """
@@ -292,69 +438,31 @@ def createSentinel1Xml(zipfilename, finalOutputDir, metainfo, dummy, verbose, no
     information users would need in order to select zipfiles for download. 
     
     """
-    xmlFilename = os.path.basename(zipfilename).replace('.zip', '.xml')
-    finalXmlFile = os.path.join(finalOutputDir, xmlFilename)
-    
-    if os.path.exists(finalXmlFile):
-        if noOverwrite:
-            if verbose or dummy:
-                print("XML already exists {}".format(finalXmlFile))
-            return finalXmlFile
-        else:
-            if dummy:
-                print("Would remove existing file {}".format(finalXmlFile)) 
-            else:
-                if verbose:
-                    print("Removing existing file {}".format(finalXmlFile))
-                os.chmod(finalXmlFile, UNIXMODE_UrwGrOr)
-                os.remove(finalXmlFile)
+    finalXmlFile = makeFinalFilename(zipfilename, finalOutputDir, '.zip', '.xml')
+    return createXmlFile(zipfilename, finalXmlFile, dummy, verbose, noOverwrite, makereadonly,
+        sentinel1XmlLines, finalOutputDir, metainfo, md5esa)
+
+
+def sentinel1XmlLines(zipfilename, finalOutputDir, metainfo, fileInfo, md5esa):
+    """
+    Return the list of lines inside the top level tag of the Sentinel-1 XML file
+    """
+    lines = xmlHeaderLines(zipfilename, finalOutputDir, metainfo, "C-SAR", metainfo.productType)
+    lines.extend(xmlCentroidLines(metainfo))
+    lines.extend(xmlFootprintLines(metainfo.outlineWKT))
+    lines.append(xmlAcquisitionTimeLine(metainfo))
+    if metainfo.polarisation is not None:
+        lines.append("  <POLARISATION values='{}' />".format(xmlAttr(','.join(metainfo.polarisation))))
+    if metainfo.swath is not None:
+        lines.append("  <SWATH values='{}' />".format(xmlAttr(','.join(metainfo.swath))))
+    lines.append("  <MODE value='{}' />".format(xmlAttr(metainfo.mode)))
+    lines.append("  <ORBIT_NUMBERS relative='{}' absolute='{}' />".format(metainfo.relativeOrbitNumber,
+        metainfo.absoluteOrbitNumber))
+    if metainfo.passDirection is not None:
+        lines.append("  <PASS direction='{}' />".format(xmlAttr(metainfo.passDirection)))
+    lines.append(xmlZipfileLine(fileInfo, md5esa))
+    return lines
 
-    if dummy:
-        print("Would make", finalXmlFile)        
-    else:
-        if verbose:
-            print("Creating", finalXmlFile)
-        fileInfo = ZipfileSysInfo(zipfilename)
-
-        f = open(finalXmlFile, 'w')
-        f.write("<?xml version='1.0'?>\n")
-        f.write("<AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.write("  <IDENTIFIER>{}</IDENTIFIER>\n".format(os.path.basename(zipfilename).split('.')[0]))
-        f.write("  <PATH>{}</PATH>\n".format(finalOutputDir.split(makeSatelliteDir(metainfo))[1]))
-        f.write("  <SATELLITE name='{}' />\n".format(metainfo.satId))
-        f.write("  <INSTRUMENT>{}</INSTRUMENT>\n".format("C-SAR"))
-        f.write("  <PRODUCT_TYPE>{}</PRODUCT_TYPE>\n".format(metainfo.productType))  
-        f.write("  <PROCESSING_LEVEL>{}</PROCESSING_LEVEL>\n".format(processingLevel(metainfo)))
-        if metainfo.centroidXY is not None:
-            (longitude, latitude) = tuple(metainfo.centroidXY)
-            f.write("  <CENTROID longitude='{}' latitude='{}' />\n".format(longitude, latitude))
-        f.write("  <ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        f.write("    {}\n".format(metainfo.outlineWKT))
-        f.write("  </ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        startTimestampStr = metainfo.startTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        stopTimestampStr = metainfo.stopTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        f.write("  <ACQUISITION_TIME start_datetime_utc='{}' stop_datetime_utc='{}' />\n".format(
-            startTimestampStr, stopTimestampStr))
-        if metainfo.polarisation is not None:
-            f.write("  <POLARISATION values='{}' />\n".format(','.join(metainfo.polarisation)))
-        if metainfo.swath is not None:
-            f.write("  <SWATH values='{}' />\n".format(','.join(metainfo.swath)))
-        f.write("  <MODE value='{}' />\n".format(metainfo.mode))
-        f.write("  <ORBIT_NUMBERS relative='{}' absolute='{}' />\n".format(metainfo.relativeOrbitNumber,
-            metainfo.absoluteOrbitNumber))
-        if metainfo.passDirection is not None:
-            f.write("  <PASS direction='{}' />\n".format(metainfo.passDirection))
-            
-        f.write("  <ZIPFILE size_bytes='{}' md5_local='{}' ".format(fileInfo.sizeBytes, 
-            fileInfo.md5))
-        if md5esa is not None:
-            f.write("md5_esa='{}' ".format(md5esa.upper()))
-        f.write("/>\n")
-        
-        f.write("</AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.close()
-        if makereadonly: os.chmod(finalXmlFile, UNIXMODE_UrGrOr)
-    return finalXmlFile
 
 def createSentinel2Xml(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOverwrite,
         md5esa, makereadonly=False):
@@ -364,72 +472,36 @@ def createSentinel2Xml(zipfilename, finalOutputDir, metainfo, dummy, verbose, no
     information users would need in order to select zipfiles for download. 
     
     """
-    xmlFilename = os.path.basename(zipfilename).replace('.zip', '.xml')
-    finalXmlFile = os.path.join(finalOutputDir, xmlFilename)
+    finalXmlFile = makeFinalFilename(zipfilename, finalOutputDir, '.zip', '.xml')
+    return createXmlFile(zipfilename, finalXmlFile, dummy, verbose, noOverwrite, makereadonly,
+        sentinel2XmlLines, finalOutputDir, metainfo, md5esa)
+
+
+def sentinel2XmlLines(zipfilename, finalOutputDir, metainfo, fileInfo, md5esa):
+    """
+    Return the list of lines inside the top level tag of the Sentinel-2 XML file
+    """
+    lines = xmlHeaderLines(zipfilename, finalOutputDir, metainfo, "MSI", 
+        "S2MSIL" + metainfo.processingLevel[-2:])
+    lines.extend(xmlCentroidLines(metainfo))
+    lines.append("  <ESA_CLOUD_COVER percentage='{}' />".format(int(round(metainfo.cloudPcnt))))
+    lines.extend(xmlFootprintLines(metainfo.extPosWKT))
+    lines.append(xmlAcquisitionTimeLine(metainfo))
+    lines.append("  <ESA_PROCESSING software_version='{}' processingtime_utc='{}'/>".format(
+        xmlAttr(metainfo.processingSoftwareVersion), metainfo.generationTime))
+    lines.append("  <ORBIT_NUMBERS relative='{}' />".format(metainfo.relativeOrbitNumber))
+    lines.append(xmlZipfileLine(fileInfo, md5esa))
     
-    if os.path.exists(finalXmlFile):
-        if noOverwrite:
-            if verbose or dummy:
-                print("XML already exists {}".format(finalXmlFile))
-            return finalXmlFile
-        else:
-            if dummy:
-                print("Would remove existing file {}".format(finalXmlFile)) 
-            else:
-                if verbose:
-                    print("Removing existing file {}".format(finalXmlFile))
-                os.chmod(finalXmlFile, UNIXMODE_UrwGrOr)
-                os.remove(finalXmlFile)
+    if metainfo.tileNameList is not None:
+        # Only write the list of tile names if it actually exists. 
+        lines.append("")
+        lines.append("  <!-- These MGRS tile identifiers are not those supplied by ESA's processing software, but have been ")
+        lines.append("      calculated directly from tile centroids by the Australian Copernicus Hub -->")
+        lines.append("  <MGRSTILES source='AUSCOPHUB' >")
+        lines.extend(["    {}".format(xmlText(tileName)) for tileName in metainfo.tileNameList])
+        lines.append("  </MGRSTILES>")
+    return lines
 
-    if dummy:
-        print("Would make", finalXmlFile)
-    else:
-        if verbose:
-            print("Creating", finalXmlFile)
-        fileInfo = ZipfileSysInfo(zipfilename)
-        
-        f = open(finalXmlFile, 'w')
-        f.write("<?xml version='1.0'?>\n")
-        f.write("<AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.write("  <IDENTIFIER>{}</IDENTIFIER>\n".format(os.path.basename(zipfilename).split('.')[0]))
-        f.write("  <PATH>{}</PATH>\n".format(finalOutputDir.split(makeSatelliteDir(metainfo))[1]))
-        f.write("  <SATELLITE name='{}' />\n".format(metainfo.satId))
-        f.write("  <INSTRUMENT>{}</INSTRUMENT>\n".format("MSI"))
-        f.write("  <PRODUCT_TYPE>{}</PRODUCT_TYPE>\n".format("S2MSIL" + metainfo.processingLevel[-2:]))
-        f.write("  <PROCESSING_LEVEL>{}</PROCESSING_LEVEL>\n".format(processingLevel(metainfo)))
-        (longitude, latitude) = tuple(metainfo.centroidXY)
-        f.write("  <CENTROID longitude='{}' latitude='{}' />\n".format(longitude, latitude))
-        f.write("  <ESA_CLOUD_COVER percentage='{}' />\n".format(int(round(metainfo.cloudPcnt))))
-        f.write("  <ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        f.write("    {}\n".format(metainfo.extPosWKT))
-        f.write("  </ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        startTimestampStr = metainfo.startTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        stopTimestampStr = metainfo.stopTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        f.write("  <ACQUISITION_TIME start_datetime_utc='{}' stop_datetime_utc='{}' />\n".format(
-            startTimestampStr, stopTimestampStr))
-        f.write("  <ESA_PROCESSING software_version='{}' processingtime_utc='{}'/>\n".format(
-            metainfo.processingSoftwareVersion, metainfo.generationTime))
-        f.write("  <ORBIT_NUMBERS relative='{}' />\n".format(metainfo.relativeOrbitNumber))
-        
-        f.write("  <ZIPFILE size_bytes='{}' md5_local='{}' ".format(fileInfo.sizeBytes, 
-            fileInfo.md5))
-        if md5esa is not None:
-            f.write("md5_esa='{}' ".format(md5esa.upper()))
-        f.write("/>\n")
-        
-        if metainfo.tileNameList is not None:
-            # Only write the list of tile names if it actually exists. 
-            f.write("\n")
-            f.write("  <!-- These MGRS tile identifiers are not those supplied by ESA's processing software, but have been \n")
-            f.write("      calculated directly from tile centroids by the Australian Copernicus Hub -->\n")
-            f.write("  <MGRSTILES source='AUSCOPHUB' >\n")
-            for tileName in metainfo.tileNameList:
-                f.write("    {}\n".format(tileName))
-            f.write("  </MGRSTILES>\n")
-        f.write("</AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.close()
-        if makereadonly: os.chmod(finalXmlFile, UNIXMODE_UrGrOr)
-    return finalXmlFile
 
 def createSentinel3Xml(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOverwrite,
         md5esa, makereadonly=False):
@@ -439,70 +511,32 @@ def createSentinel3Xml(zipfilename, finalOutputDir, metainfo, dummy, verbose, no
     information users would need in order to select zipfiles for download. 
     
     """
-    xmlFilename = os.path.basename(zipfilename).replace('.zip', '.xml')
-    finalXmlFile = os.path.join(finalOutputDir, xmlFilename)
-    
-    if os.path.exists(finalXmlFile):
-        if noOverwrite:
-            if verbose or dummy:
-                print("XML already exists {}".format(finalXmlFile))
-            return finalXmlFile
-        else:
-            if dummy:
-                print("Would remove existing file {}".format(finalXmlFile)) 
-            else:
-                if verbose:
-                    print("Removing existing file {}".format(finalXmlFile))
-                os.chmod(finalXmlFile, UNIXMODE_UrwGrOr)
-                os.remove(finalXmlFile)
+    finalXmlFile = makeFinalFilename(zipfilename, finalOutputDir, '.zip', '.xml')
+    return createXmlFile(zipfilename, finalXmlFile, dummy, verbose, noOverwrite, makereadonly,
+        sentinel3XmlLines, finalOutputDir, metainfo, md5esa)
 
-    if dummy:
-        print("Would make", finalXmlFile)
-    else:
-        if verbose:
-            print("Creating", finalXmlFile)
-        fileInfo = ZipfileSysInfo(zipfilename)
-        
-        f = open(finalXmlFile, 'w')
-        f.write("<?xml version='1.0'?>\n")
-        f.write("<AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.write("  <IDENTIFIER>{}</IDENTIFIER>\n".format(os.path.basename(zipfilename).split('.')[0]))
-        f.write("  <PATH>{}</PATH>\n".format(finalOutputDir.split(makeSatelliteDir(metainfo))[1]))
-        f.write("  <SATELLITE name='{}' />\n".format(metainfo.satId))
-        f.write("  <INSTRUMENT>{}</INSTRUMENT>\n".format(metainfo.instrument))
-        f.write("  <PRODUCT_TYPE>{}</PRODUCT_TYPE>\n".format(metainfo.productType))  
-        f.write("  <PROCESSING_LEVEL>{}</PROCESSING_LEVEL>\n".format(processingLevel(metainfo)))
-        if metainfo.centroidXY is not None:
-            (longitude, latitude) = tuple(metainfo.centroidXY)
-            f.write("  <CENTROID longitude='{}' latitude='{}' />\n".format(longitude, latitude))
-        f.write("  <ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        f.write("    {}\n".format(metainfo.outlineWKT))
-        f.write("  </ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        startTimestampStr = metainfo.startTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        stopTimestampStr = metainfo.stopTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        f.write("  <ACQUISITION_TIME start_datetime_utc='{}' stop_datetime_utc='{}' />\n".format(
-            startTimestampStr, stopTimestampStr))
-        f.write("  <ESA_PROCESSING processingtime_utc='{}' baselinecollection='{}'/>\n".format(
-            metainfo.generationTime, metainfo.baselineCollection))
-        f.write("  <ORBIT_NUMBERS relative='{}' ".format(metainfo.relativeOrbitNumber))
-        if metainfo.frameNumber is not None:
-            f.write("frame='{}' ".format(metainfo.frameNumber))
-        if metainfo.absoluteOrbitNumber is not None:
-            f.write("absolute='{}' ".format(metainfo.absoluteOrbitNumber))
-        if metainfo.cycleNumber is not None:
-            f.write("cycle='{}' ".format(metainfo.cycleNumber))
-        f.write("/>\n")
-        
-        f.write("  <ZIPFILE size_bytes='{}' md5_local='{}' ".format(fileInfo.sizeBytes, 
-            fileInfo.md5))
-        if md5esa is not None:
-            f.write("md5_esa='{}' ".format(md5esa.upper()))
-        f.write("/>\n")
-        
-        f.write("</AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.close()
-        if makereadonly: os.chmod(finalXmlFile, UNIXMODE_UrGrOr)
-    return finalXmlFile
+
+def sentinel3XmlLines(zipfilename, finalOutputDir, metainfo, fileInfo, md5esa):
+    """
+    Return the list of lines inside the top level tag of the Sentinel-3 XML file
+    """
+    lines = xmlHeaderLines(zipfilename, finalOutputDir, metainfo, metainfo.instrument, 
+        metainfo.productType)
+    lines.extend(xmlCentroidLines(metainfo))
+    lines.extend(xmlFootprintLines(metainfo.outlineWKT))
+    lines.append(xmlAcquisitionTimeLine(metainfo))
+    lines.append("  <ESA_PROCESSING processingtime_utc='{}' baselinecollection='{}'/>".format(
+        metainfo.generationTime, xmlAttr(metainfo.baselineCollection)))
+    orbitLine = "  <ORBIT_NUMBERS relative='{}' ".format(metainfo.relativeOrbitNumber)
+    if metainfo.frameNumber is not None:
+        orbitLine += "frame='{}' ".format(metainfo.frameNumber)
+    if metainfo.absoluteOrbitNumber is not None:
+        orbitLine += "absolute='{}' ".format(metainfo.absoluteOrbitNumber)
+    if metainfo.cycleNumber is not None:
+        orbitLine += "cycle='{}' ".format(metainfo.cycleNumber)
+    lines.append(orbitLine + "/>")
+    lines.append(xmlZipfileLine(fileInfo, md5esa))
+    return lines
 
 
 def createSentinel5Xml(ncfilename, finalOutputDir, metainfo, dummy, verbose, noOverwrite,
@@ -518,9 +552,41 @@ def createSentinel5Xml(ncfilename, finalOutputDir, metainfo, dummy, verbose, noO
     should have used a more generic tag name in the first place (with hindsight). 
     
     """
-    xmlFilename = os.path.basename(ncfilename).replace('.nc', '.xml')
-    finalXmlFile = os.path.join(finalOutputDir, xmlFilename)
+    finalXmlFile = makeFinalFilename(ncfilename, finalOutputDir, '.nc', '.xml')
+    return createXmlFile(ncfilename, finalXmlFile, dummy, verbose, noOverwrite, makereadonly,
+        sentinel5XmlLines, finalOutputDir, metainfo, md5esa)
+
+
+def sentinel5XmlLines(ncfilename, finalOutputDir, metainfo, fileInfo, md5esa):
+    """
+    Return the list of lines inside the top level tag of the Sentinel-5 XML file
+    """
+    lines = xmlHeaderLines(ncfilename, finalOutputDir, metainfo, metainfo.instrument, 
+        metainfo.productType)
+    lines.extend(xmlCentroidLines(metainfo))
+    lines.extend(xmlFootprintLines(metainfo.outlineWKT))
+    lines.append(xmlAcquisitionTimeLine(metainfo))
+    lines.append("  <ESA_PROCESSING processingtime_utc='{}' software_version='{}' mode='{}' />".format(
+        metainfo.generationTime, xmlAttr(metainfo.processingSoftwareVersion), 
+        xmlAttr(metainfo.processingMode)))
+    lines.append("  <ORBIT_NUMBERS absolute='{}' />".format(metainfo.absoluteOrbitNumber))
+    lines.append(xmlZipfileLine(fileInfo, md5esa))
+    return lines
+
+
+def createXmlFile(filename, finalXmlFile, dummy, verbose, noOverwrite, makereadonly,
+        xmlLinesFunc, finalOutputDir, metainfo, md5esa):
+    """
+    Do the work which is the same for the XML file of every Sentinel. Deals
+    with any existing file, and then writes the new one. The xmlLinesFunc is
+    the Sentinel-specific function which returns the list of lines to go inside 
+    the top level tag. It is called as
+        xmlLinesFunc(filename, finalOutputDir, metainfo, fileInfo, md5esa)
+    where fileInfo is the ZipfileSysInfo for the given file. 
     
+    Returns the name of the XML file. 
+    
+    """
     if os.path.exists(finalXmlFile):
         if noOverwrite:
             if verbose or dummy:
@@ -540,51 +606,94 @@ def createSentinel5Xml(ncfilename, finalOutputDir, metainfo, dummy, verbose, noO
     else:
         if verbose:
             print("Creating", finalXmlFile)
-        fileInfo = ZipfileSysInfo(ncfilename)
+        fileInfo = ZipfileSysInfo(filename)
         
-        f = open(finalXmlFile, 'w')
-        f.write("<?xml version='1.0'?>\n")
-        f.write("<AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.write("  <IDENTIFIER>{}</IDENTIFIER>\n".format(os.path.basename(ncfilename).split('.')[0]))
-        f.write("  <PATH>{}</PATH>\n".format(finalOutputDir.split(makeSatelliteDir(metainfo))[1]))
-        f.write("  <SATELLITE name='{}' />\n".format(metainfo.satId))
-        f.write("  <INSTRUMENT>{}</INSTRUMENT>\n".format(metainfo.instrument))
-        f.write("  <PRODUCT_TYPE>{}</PRODUCT_TYPE>\n".format(metainfo.productType))  
-        f.write("  <PROCESSING_LEVEL>{}</PROCESSING_LEVEL>\n".format(processingLevel(metainfo)))
-        if metainfo.centroidXY is not None:
-            (longitude, latitude) = tuple(metainfo.centroidXY)
-            f.write("  <CENTROID longitude='{}' latitude='{}' />\n".format(longitude, latitude))
-        f.write("  <ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        f.write("    {}\n".format(metainfo.outlineWKT))
-        f.write("  </ESA_TILEOUTLINE_FOOTPRINT_WKT>\n")
-        startTimestampStr = metainfo.startTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        stopTimestampStr = metainfo.stopTime.strftime("%Y-%m-%d %H:%M:%S.%f")
-        f.write("  <ACQUISITION_TIME start_datetime_utc='{}' stop_datetime_utc='{}' />\n".format(
-            startTimestampStr, stopTimestampStr))
-        f.write("  <ESA_PROCESSING processingtime_utc='{}' software_version='{}' mode='{}' />\n".format(
-            metainfo.generationTime, metainfo.processingSoftwareVersion, 
-            metainfo.processingMode))
-        f.write("  <ORBIT_NUMBERS absolute='{}' ".format(metainfo.absoluteOrbitNumber))
-        f.write("/>\n")
-        
-        f.write("  <ZIPFILE size_bytes='{}' md5_local='{}' ".format(fileInfo.sizeBytes, 
-            fileInfo.md5))
-        if md5esa is not None:
-            f.write("md5_esa='{}' ".format(md5esa.upper()))
-        f.write("/>\n")
-        
-        f.write("</AUSCOPHUB_SAFE_FILEDESCRIPTION>\n")
-        f.close()
+        # Build the whole document first, so it goes out in a single write
+        lines = ["<?xml version='1.0'?>", "<AUSCOPHUB_SAFE_FILEDESCRIPTION>"]
+        lines.extend(xmlLinesFunc(filename, finalOutputDir, metainfo, fileInfo, md5esa))
+        lines.append("</AUSCOPHUB_SAFE_FILEDESCRIPTION>")
+        with open(finalXmlFile, 'w') as f:
+            f.write("\n".join(lines) + "\n")
         if makereadonly: os.chmod(finalXmlFile, UNIXMODE_UrGrOr)
     return finalXmlFile
 
 
+def xmlHeaderLines(filename, finalOutputDir, metainfo, instrument, productType):
+    """
+    Return the list of XML lines which start the description of every Sentinel
+    """
+    lines = [
+        "  <IDENTIFIER>{}</IDENTIFIER>".format(xmlText(os.path.basename(filename).split('.')[0])),
+        "  <PATH>{}</PATH>".format(xmlText(finalOutputDir.split(makeSatelliteDir(metainfo))[1])),
+        "  <SATELLITE name='{}' />".format(xmlAttr(metainfo.satId)),
+        "  <INSTRUMENT>{}</INSTRUMENT>".format(xmlText(instrument)),
+        "  <PRODUCT_TYPE>{}</PRODUCT_TYPE>".format(xmlText(productType)),
+        "  <PROCESSING_LEVEL>{}</PROCESSING_LEVEL>".format(xmlText(processingLevel(metainfo)))
+    ]
+    return lines
+
+
+def xmlCentroidLines(metainfo):
+    """
+    Return a list of the XML line for the centroid, which is empty if there is no centroid
+    """
+    lines = []
+    if metainfo.centroidXY is not None:
+        (longitude, latitude) = tuple(metainfo.centroidXY)
+        lines.append("  <CENTROID longitude='{}' latitude='{}' />".format(longitude, latitude))
+    return lines
+
+
+def xmlFootprintLines(footprintWkt):
+    """
+    Return the list of XML lines for the given footprint WKT
+    """
+    return ["  <ESA_TILEOUTLINE_FOOTPRINT_WKT>", "    {}".format(xmlText(footprintWkt)),
+        "  </ESA_TILEOUTLINE_FOOTPRINT_WKT>"]
+
+
+def xmlAcquisitionTimeLine(metainfo):
+    """
+    Return the XML line for the acquisition start and stop times
+    """
+    startTimestampStr = metainfo.startTime.strftime("%Y-%m-%d %H:%M:%S.%f")
+    stopTimestampStr = metainfo.stopTime.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return "  <ACQUISITION_TIME start_datetime_utc='{}' stop_datetime_utc='{}' />".format(
+        startTimestampStr, stopTimestampStr)
+
+
+def xmlZipfileLine(fileInfo, md5esa):
+    """
+    Return the XML line describing the file itself
+    """
+    line = "  <ZIPFILE size_bytes='{}' md5_local='{}' ".format(fileInfo.sizeBytes, fileInfo.md5)
+    if md5esa is not None:
+        line += "md5_esa='{}' ".format(xmlAttr(md5esa.upper()))
+    return line + "/>"
+
+
+def xmlText(value):
+    """
+    Return the given value as a string which is safe to use as XML element text
+    """
+    return saxutils.escape(str(value))
+
+
+def xmlAttr(value):
+    """
+    Return the given value as a string which is safe to use inside a single-quoted
+    XML attribute value
+    """
+    return saxutils.escape(str(value), {"'": "&apos;"})
+
+
 def createPreviewImg(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOverwrite, makereadonly=False):
     """
-    Create the preview image, in the final output directory
+    Create the preview image, in the final output directory. The image data comes 
+    from metainfo.previewImgBin, which the metadata classes have already read 
+    using their open zipfile, so the zipfile is not opened again here. 
     """
-    pngFilename = os.path.basename(zipfilename).replace('.zip', '.png')
-    finalPngFile = os.path.join(finalOutputDir, pngFilename)
+    finalPngFile = makeFinalFilename(zipfilename, finalOutputDir, '.zip', '.png')
     
     if metainfo.previewImgBin is None:
         if verbose or dummy:
@@ -596,13 +705,11 @@ def createPreviewImg(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOv
                 print("Preview image already exists {}".format(finalPngFile))
             return
         else:
+            # The new file is renamed over the top of it, below, so no need to remove it first
             if dummy:
-                print("Would remove existing file {}".format(finalPngFile)) 
-            else:
-                if verbose:
-                    print("Removing existing file {}".format(finalPngFile))
-                os.chmod(finalPngFile, UNIXMODE_UrwGrOr)
-                os.remove(finalPngFile) 
+                print("Would replace existing file {}".format(finalPngFile)) 
+            elif verbose:
+                print("Replacing existing file {}".format(finalPngFile))
 
     if dummy:
         print("Would make", finalPngFile)
@@ -613,7 +720,7 @@ def createPreviewImg(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOv
         #resize the image
         qldata = BytesIO(metainfo.previewImgBin)
         im = Image.open(qldata)
-        im.thumbnail((512,512), Image.ANTIALIAS)
+        im.thumbnail((512,512), Image.LANCZOS)
         if os.path.basename(zipfilename).startswith('S1'):
             # preview always has top-left as first sensing pixel. 
             # flip according to orbit direction.
@@ -623,8 +730,20 @@ def createPreviewImg(zipfilename, finalOutputDir, metainfo, dummy, verbose, noOv
             else:
                 if verbose: print("Flipping preview left-right")
                 im = im.transpose(Image.FLIP_LEFT_RIGHT)
-        im.save(finalPngFile, "PNG")
-        if makereadonly: os.chmod(finalPngFile, UNIXMODE_UrGrOr)
+        # Write to a temporary file alongside the final one, and rename it into place, so
+        # nothing ever sees a partial image, and any existing file is replaced in one step
+        tmpPng = tempfile.NamedTemporaryFile(mode='wb', prefix='tmpCopHub_', suffix='.png', 
+            dir=finalOutputDir, delete=False)
+        try:
+            with tmpPng:
+                im.save(tmpPng, "PNG")
+            os.chmod(tmpPng.name, UNIXMODE_UrGrOr if makereadonly else UNIXMODE_UrwGrOr)
+            replaceFile(tmpPng.name, finalPngFile)
+        except Exception:
+            # Don't leave the temporary file lying around in the storage tree
+            if os.path.exists(tmpPng.name):
+                os.remove(tmpPng.name)
+            raise
 
 
 class ZipfileSysInfo(object):
@@ -130,6 +130,43 @@ def copyGeom(geom):
     return newGeom
 
 
+def unionOfGeometries(geomList):
+    """
+    Return a single ogr.Geometry which is the union of all the geometries in the
+    given list. If they are all polygons or multipolygons, their polygons are gathered 
+    into one multipolygon, and unioned in a single UnionCascaded() call, 
+    rather than building up the union one geometry at a time, which re-processes 
+    the whole accumulated result at every step. Otherwise, falls back to doing 
+    it one at a time. The result has the spatial reference of the first geometry 
+    in the list. Returns None for an empty list. 
+    
+    """
+    polygonTypes = (ogr.wkbPolygon, ogr.wkbMultiPolygon)
+    allPolygons = all([ogr.GT_Flatten(geom.GetGeometryType()) in polygonTypes 
+        for geom in geomList])
+    
+    wholeGeom = None
+    if len(geomList) == 1:
+        wholeGeom = geomList[0].Clone()
+    elif len(geomList) > 1 and allPolygons:
+        multiGeom = ogr.Geometry(ogr.wkbMultiPolygon)
+        for geom in geomList:
+            if ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbPolygon:
+                multiGeom.AddGeometry(geom)
+            else:
+                for i in range(geom.GetGeometryCount()):
+                    multiGeom.AddGeometry(geom.GetGeometryRef(i))
+        wholeGeom = multiGeom.UnionCascaded()
+        # The new multipolygon has no spatial reference of its own, so give the result
+        # that of the input geometries
+        wholeGeom.AssignSpatialReference(geomList[0].GetSpatialReference())
+    elif len(geomList) > 1:
+        wholeGeom = geomList[0].Clone()
+        for geom in geomList[1:]:
+            wholeGeom = wholeGeom.Union(geom)
+    return wholeGeom
+
+
 def getCoords(geom):
     """
     Return the coordinates of the given OGR geometry. Assumes that this is a single 
@@ -156,14 +193,61 @@ def geomFromOutlineCoords(coords):
     The given list of pairs (or 2-d numpy array) is the (x, y) coords of the polygon outline. 
     Return a Polygon ogr.Geometry object. 
     
+    The ring is built directly from the vertices, rather than going via a JSON or WKT 
+    string which OGR would then have to parse again. 
+    
     """
     if isinstance(coords, numpy.ndarray):
         coords = coords.tolist()
-    geomDict = {'type':'Polygon', 'coordinates':[coords]}
-    geom = ogr.CreateGeometryFromJson(repr(geomDict))
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for (x, y) in coords:
+        ring.AddPoint_2D(x, y)
+    geom = ogr.Geometry(ogr.wkbPolygon)
+    geom.AddGeometry(ring)
     return geom
 
 
+class LazyFootprintMixin(object):
+    """
+    Gives a metadata class centroidXY and outlineWKT properties, which are 
+    calculated from its footprintCoords attribute (a list of [long, lat] pairs) when 
+    first used, as not everything needs them (e.g. the storage directory for 
+    Sentinel-3 does not depend on location). The class must set self.footprintCoords. 
+    
+    """
+    @property
+    def centroidXY(self):
+        """
+        The [x, y] lat/long centroid of the footprint, or None if no sensible
+        projection could be found to calculate it in. 
+        """
+        if not hasattr(self, '_centroidXY'):
+            self.makeFootprint()
+        return self._centroidXY
+
+    @property
+    def outlineWKT(self):
+        """
+        WKT string of the footprint polygon
+        """
+        if not hasattr(self, '_outlineWKT'):
+            self.makeFootprint()
+        return self._outlineWKT
+
+    def makeFootprint(self):
+        """
+        Make the footprint geometry from self.footprintCoords, and use it to fill in 
+        the values behind the centroidXY and outlineWKT properties. 
+        """
+        footprintGeom = geomFromOutlineCoords(self.footprintCoords)
+        prefEpsg = findSensibleProjection(footprintGeom)
+        if prefEpsg is not None:
+            self._centroidXY = findCentroid(footprintGeom, prefEpsg)
+        else:
+            self._centroidXY = None
+        self._outlineWKT = footprintGeom.ExportToWkt()
+
+
 def geomFromInteriorPoints(coords):
     """
     The given list of pairs (or 2-d numpy array) is the (x, y) coords of a set of internal
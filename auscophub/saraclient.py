@@ -15,6 +15,10 @@ This would return a list of multi-level dictionary objects created from the JSON
 of the server, one for each matching zipfile. The paramList can be any of the parameters which
 the SARA API accepts, these are passed straight through to the API. 
 
+The urlOpener is a requests.Session. Note that in older versions of this module 
+it was a urllib opener object, with an open() method, so any code which used it 
+directly to open URLs will need to use its get() method instead. 
+
 The default SARA server is hard-wired in this module. However, the server name, and the protocol
 to be used, can both be over-ridden using the following environment variables
     | AUSCOPHUB_SARA_PROTOCOL (default https)
@@ -30,13 +34,13 @@ import copy
 import shlex
 import subprocess
 
+import requests
+from requests.adapters import HTTPAdapter
+
 isPython3 = (sys.version_info.major == 3)
 if isPython3:
-    from urllib.request import build_opener, ProxyHandler
-    from urllib.error import HTTPError
     from urllib.parse import quote as urlquote
 else:
-    from urllib2 import build_opener, ProxyHandler, HTTPError
     from urllib import quote as urlquote
 
 
@@ -45,19 +49,33 @@ SARA_HOST = os.getenv("AUSCOPHUB_SARA_SERVERHOST", default="copernicus.nci.org.a
 
 SARA_SEARCHSERVER = "{}://{}/sara.server/1.0/api/collections".format(SARA_PROTOCOL, SARA_HOST)
 
+# Number of connections to the server kept open for re-use, which is enough for 
+# each thread of a concurrent search to have its own
+URLOPENER_POOLSIZE = 8
+# Timeouts (seconds) for connecting to the server, and for each read from it, so that
+# a stalled server cannot hang a search for ever
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
 
 def makeUrlOpener(proxy=None):
     """
-    Use the crazy urllib2 routines to make a thing which can open a URL, with proxy
-    handling if required. Return an opener object, which is used as::
-        reader = opener.open(url)
+    Make a thing which can open a URL, with proxy handling if required. This is a 
+    requests.Session, which keeps its connections to the server open, so that 
+    successive queries (e.g. each page of a search, or a series of searches) re-use 
+    them, rather than each doing its own connection and SSL handshake. Return the
+    session object, which is used as::
+        response = opener.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    
+    Note that this used to return a urllib opener object, used as opener.open(url). 
         
     """
-    if proxy is None:
-        opener = build_opener()
-    else:
-        proxyHandler = ProxyHandler({'http':proxy, 'https':proxy})
-        opener = build_opener(proxyHandler)
+    opener = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=URLOPENER_POOLSIZE)
+    opener.mount("http://", adapter)
+    opener.mount("https://", adapter)
+    if proxy is not None:
+        opener.proxies = {'http':proxy, 'https':proxy}
     return opener
 
 
@@ -94,6 +112,17 @@ def searchSara(urlOpener, sentinelNumber, paramList):
         queries, because the server pages its output, so the list is just the feature objects,
         without all the stuff which would be repeated per page. 
     
+    """
+    return list(searchSaraIter(urlOpener, sentinelNumber, paramList))
+
+
+def searchSaraIter(urlOpener, sentinelNumber, paramList):
+    """
+    A generator version of searchSara(), with the same arguments. Yields each matching 
+    feature object in turn, fetching each page of results from the server only as it 
+    is required. This means that a very large search need not have all its
+    results in memory at once. 
+    
     """
     url = makeQueryUrl(sentinelNumber, paramList)
     
@@ -103,7 +132,8 @@ def searchSara(urlOpener, sentinelNumber, paramList):
         raise SaraClientError(httpErrorStr)
     
     # Start with the first page of results. 
-    allFeatures = results['features']
+    for feature in results['features']:
+        yield feature
     
     # The API only gives us a page of results at a time. So, we have to do repeated queries,
     # with increasing page numbers, to get all pages. We can't use the totalResults field to work
@@ -117,15 +147,17 @@ def searchSara(urlOpener, sentinelNumber, paramList):
         tmpParamList.append('page={}'.format(page))
         url = makeQueryUrl(sentinelNumber, tmpParamList)
         (results, httpErrorStr) = readJsonUrl(urlOpener, url)
+        if httpErrorStr is not None:
+            print("Error querying URL:", url, file=sys.stderr)
+            raise SaraClientError(httpErrorStr)
         features = results['features']
         
         if len(features) > 0:
-            allFeatures.extend(features)
+            for feature in features:
+                yield feature
             page += 1
         else:
             finished = True
-    
-    return allFeatures
 
 
 def makeQueryUrl(sentinelNumber, paramList):
@@ -146,18 +178,17 @@ def makeQueryUrl(sentinelNumber, paramList):
 
 def readJsonUrl(urlOpener, url):
     """
-    Read the contents of the given URL, returning the object created from the
-    JSON which the server returns
+    Read the contents of the given URL, returning a tuple (results, httpErrorStr), 
+    where results is the object created from the JSON which the server returns. If 
+    the request fails (including timing out), results is None and httpErrorStr 
+    describes the error, otherwise httpErrorStr is None. 
     """
     try:
-        reader = urlOpener.open(url)
-        jsonStr = reader.read()
-        # Ensure that we have a str object, but in a robust way. Mainly required in Python-3. 
-        if hasattr(jsonStr, 'decode'):
-            jsonStr = jsonStr.decode('utf-8')
-        results = json.loads(jsonStr)
+        response = urlOpener.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        response.raise_for_status()
+        results = json.loads(response.content.decode('utf-8'))
         httpErrorStr = None
-    except HTTPError as e:
+    except requests.RequestException as e:
         results = None
         httpErrorStr = str(e)
     return (results, httpErrorStr)
@@ -22,19 +22,24 @@ class Sen1ZipfileMeta(object):
     files, when more detail is required. 
     
     """
-    def __init__(self, zipfilename=None):
+    def __init__(self, zipfilename=None, zipfileObj=None):
         """
-        Currently only operates on the zipfile itself. 
+        Currently only operates on the zipfile itself. If the caller already has
+        it open, the zipfile.ZipFile object can be given as zipfileObj, to save
+        opening it again, but zipfilename is still required. 
         """
         if zipfilename is None:
             raise Sen1MetaError("Must give zipfilename")
         
-        zf = zipfile.ZipFile(zipfilename, 'r')
-        filenames = [zi.filename for zi in zf.infolist()]
+        if zipfileObj is not None:
+            zf = zipfileObj
+        else:
+            zf = zipfile.ZipFile(zipfilename, 'r')
+        filenames = zf.namelist()
         # Find the name of the .SAFE/ subdirectory. ESA now create zip files
         # which do not include it explicitly. 
-        topDirList = [fn.split('/')[0] for fn in filenames]
-        safeDirName = [fn for fn in topDirList if fn.endswith('.SAFE')][0]
+        topDirGen = (fn.split('/')[0] for fn in filenames)
+        safeDirName = next(fn for fn in topDirGen if fn.endswith('.SAFE'))
         safeDirName = safeDirName + '/'
         bn = safeDirName.replace('.SAFE/', '')
         
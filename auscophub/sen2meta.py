@@ -67,7 +67,7 @@ class Sen2TileMeta(object):
         
         """
         if filename is not None:
-            f = open(filename)
+            f = open(filename, 'rb')
         elif fileobj is not None:
             f = fileobj
         elif zipfilename is not None:
@@ -90,6 +90,9 @@ class Sen2TileMeta(object):
             raise Sen2MetaError("Must give either filename, fileobj or zipfilename")
         
         xmlStr = f.read()
+        if fileobj is None:
+            # We opened it, so close it
+            f.close()
         doc = minidom.parseString(xmlStr)
         
         generalInfoNode = doc.getElementsByTagName('n1:General_Info')[0]
@@ -337,35 +340,42 @@ class Sen2ZipfileMeta(object):
         wvpScaleValue:      Scale factor for water vapour raster (L2A only)
     
     """
-    def __init__(self, xmlStr=None, xmlfilename=None, zipfilename=None):
+    def __init__(self, xmlStr=None, xmlfilename=None, zipfilename=None, zipfileObj=None):
         """
         Take either the name of a zipfile, an XML file, or an XML string, and construct
-        the object from the metadata
+        the object from the metadata. If the caller already has the zipfile open,
+        the zipfile.ZipFile object can be given as zipfileObj instead of zipfilename. 
         """
         self.previewImgBin = None
         if xmlStr is None:
             if xmlfilename is not None:
-                xmlStr = open(xmlfilename).read()
-            elif zipfilename is not None:
-                zf = zipfile.ZipFile(zipfilename, 'r')
-                filenames = [zi.filename for zi in zf.infolist()]
+                with open(xmlfilename, 'rb') as f:
+                    xmlStr = f.read()
+            elif zipfilename is not None or zipfileObj is not None:
+                if zipfileObj is not None:
+                    zf = zipfileObj
+                else:
+                    zf = zipfile.ZipFile(zipfilename, 'r')
+                filenames = zf.namelist()
+                # Membership tests against a set, as large packages have many thousands of entries
+                filenameSet = set(filenames)
                 # The older format version (before baseline 03.00) included 
                 # the SAFE directory name as a separate entry. The newer version 
                 # of the format does not, so we re-construct it from the 
                 # filenames themselves, including the trailing '/' which was 
                 # there in the older form. 
-                topDirList = [fn.split('/')[0] for fn in filenames]
-                safeDirName = [fn for fn in topDirList if fn.endswith('.SAFE')][0]
+                topDirGen = (fn.split('/')[0] for fn in filenames)
+                safeDirName = next(fn for fn in topDirGen if fn.endswith('.SAFE'))
                 safeDirName = safeDirName + '/'
                 bn = safeDirName.replace('.SAFE/', '')
                 # The meta filename is, rather ridiculously, named something slightly different 
                 # inside the SAFE directory, so we have to construct that name. 
                 metafilename = bn.replace('PRD', 'MTD').replace('MSIL1C', 'SAFL1C') + ".xml"
                 fullmetafilename = safeDirName + metafilename
-                if fullmetafilename not in filenames:
+                if fullmetafilename not in filenameSet:
                     # We have a new format package, in which the meta filename is constant. 
                     fullmetafilename = safeDirName + 'MTD_MSIL1C.xml'
-                if fullmetafilename not in filenames:
+                if fullmetafilename not in filenameSet:
                     # Perhaps we have a Level-2A file 
                     fullmetafilename = safeDirName + 'MTD_MSIL2A.xml'
                 mf = zf.open(fullmetafilename)
@@ -375,14 +385,14 @@ class Sen2ZipfileMeta(object):
                 # Read in the raw content of the preview image png file, and stash on the object
                 previewFilename = bn.replace('PRD', 'BWI') + ".png"
                 previewFullFilename = safeDirName + previewFilename
-                if previewFullFilename not in filenames:
+                if previewFullFilename not in filenameSet:
                     # Perhaps we have a new format package, with the preview image as 
                     # a jp2 in the QI_DATA directory
-                    previewFullFilenameList = [fn for fn in filenames 
-                        if fnmatch.fnmatch(fn, '*/GRANULE/*/QI_DATA/*PVI.jp2')]
+                    previewFullFilenameList = fnmatch.filter(filenames, 
+                        '*/GRANULE/*/QI_DATA/*PVI.jp2')
                     if len(previewFullFilenameList) > 0:
                         previewFullFilename = previewFullFilenameList[0]
-                if previewFullFilename in filenames:
+                if previewFullFilename in filenameSet:
                     try:
                         pf = zf.open(previewFullFilename)
                         self.previewImgBin = pf.read()
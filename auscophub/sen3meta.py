@@ -5,143 +5,166 @@ from __future__ import print_function, division
 
 import zipfile
 import datetime
-from xml.dom import minidom
+from io import BytesIO
+from xml.etree import ElementTree
 
-from osgeo import ogr
+import numpy
 
 from auscophub import geomutils
 
 
-class Sen3ZipfileMeta(object):
+class Sen3ZipfileMeta(geomutils.LazyFootprintMixin):
     """
     The metadata associated with the SAFE format file. The metadata is contained
     within a single XML file, inside the SAFE directory. The
     constructor for this class takes an XML string which has been read from 
     that file, or the name of the XML file, or the name of the zipped
     SAFE file. In the latter case, the XML file will be read directly
-    from the zipfile. 
+    from the zipfile. If the zipfile is already open, the zipfile.ZipFile
+    object can be given as zipfileObj instead. 
     
     """
-    def __init__(self, xmlStr=None, xmlfilename=None, zipfilename=None):
+    def __init__(self, xmlStr=None, xmlfilename=None, zipfilename=None, zipfileObj=None):
         if xmlStr is None:
             if xmlfilename is not None:
-                xmlStr = open(xmlfilename).read()
+                with open(xmlfilename, 'rb') as f:
+                    xmlStr = f.read()
+            elif zipfileObj is not None:
+                xmlStr = readManifestFromZipfile(zipfileObj)
             elif zipfilename is not None:
-                zf = zipfile.ZipFile(zipfilename, 'r')
-                filenames = [zi.filename for zi in zf.infolist()]
-                metadataXmlfile = [fn for fn in filenames if fn.endswith('xfdumanifest.xml')][0]
-                mf = zf.open(metadataXmlfile)
-                xmlStr = mf.read()
-                del mf
+                with zipfile.ZipFile(zipfilename, 'r') as zf:
+                    xmlStr = readManifestFromZipfile(zf)
         
-        doc = minidom.parseString(xmlStr)
-
-        xfduNode = doc.getElementsByTagName('xfdu:XFDU')[0]
-        metadataSectionNode = xfduNode.getElementsByTagName('metadataSection')[0]
-        metadataNodeList = metadataSectionNode.getElementsByTagName('metadataObject')
+        (fieldDict, self.md5) = scanManifest(xmlStr)
         
         # Acquisition times
-        acquisitionPeriodNode = self.findMetadataNodeByIdName(metadataNodeList, 'acquisitionPeriod')
-        startTimeNode = acquisitionPeriodNode.getElementsByTagName('sentinel-safe:startTime')[0]
-        startTimeStr = startTimeNode.firstChild.data.strip()
+        startTimeStr = fieldDict[('acquisitionPeriod', 'startTime')]
         self.startTime = datetime.datetime.strptime(startTimeStr, "%Y-%m-%dT%H:%M:%S.%fZ")
-        stopTimeNode = acquisitionPeriodNode.getElementsByTagName('sentinel-safe:stopTime')[0]
-        stopTimeStr = stopTimeNode.firstChild.data.strip()
+        stopTimeStr = fieldDict[('acquisitionPeriod', 'stopTime')]
         self.stopTime = datetime.datetime.strptime(stopTimeStr, "%Y-%m-%dT%H:%M:%S.%fZ")
         
         # Platform details
-        platformNode = self.findMetadataNodeByIdName(metadataNodeList, 'platform')
-        familyNameNodeList = platformNode.getElementsByTagName('sentinel-safe:familyName') 
-        satFamilyNameNode = [node for node in familyNameNodeList
-            if node.getAttribute('abbreviation') == ''][0]
-        satFamilyNameStr = satFamilyNameNode.firstChild.data.strip()
-        satNumberNode = platformNode.getElementsByTagName('sentinel-safe:number')[0]
-        satNumberStr = satNumberNode.firstChild.data.strip()
+        satFamilyNameStr = fieldDict[('platform', 'familyName')]
+        satNumberStr = fieldDict[('platform', 'number')]
         if satFamilyNameStr == "Sentinel-3":
             self.satId = "S3" + satNumberStr
         else:
             raise Sen3MetaError("Satellite family = '{}', does not appear to be Sentinel-3".format(
                 satFamilyNameStr))
-        instrumentNode = platformNode.getElementsByTagName('sentinel-safe:instrument')[0]
-        instrFamilyNameNode = instrumentNode.getElementsByTagName('sentinel-safe:familyName')[0]
-        self.instrument = instrFamilyNameNode.getAttribute('abbreviation')
+        self.instrument = fieldDict[('platform', 'instrumentAbbreviation')]
 
         # Footprint. Confusingly, this is stored under the measurementFrameSet metadata node. 
-        frameSetNode = self.findMetadataNodeByIdName(metadataNodeList, 'measurementFrameSet')
-        posListNode = frameSetNode.getElementsByTagName('gml:posList')[0]
-        posListStr = posListNode.firstChild.data.strip()
-        posListStrVals = posListStr.split()
-        numVals = len(posListStrVals)
-        # Note that a gml:posList has pairs in order [lat long ....], with no sensible pair delimiter
-        posListPairs = ["{} {}".format(posListStrVals[i+1], posListStrVals[i]) for i in range(0, numVals, 2)]
-        posListVals = [[float(x), float(y)] for (x, y) in [pair.split() for pair in posListPairs]]
-
-        footprintGeom = geomutils.geomFromOutlineCoords(posListVals)
-        prefEpsg = geomutils.findSensibleProjection(footprintGeom)
-        if prefEpsg is not None:
-            self.centroidXY = geomutils.findCentroid(footprintGeom, prefEpsg)
-        else:
-            self.centroidXY = None
-        self.outlineWKT = footprintGeom.ExportToWkt()
+        posListStr = fieldDict[('measurementFrameSet', 'posList')]
+        # Note that a gml:posList has pairs in order [lat long ....], with no sensible pair delimiter,
+        # so reshape into pairs, and swap the columns to give (long, lat)
+        # The centroidXY and outlineWKT properties are calculated from these when first used
+        self.footprintCoords = numpy.array(posListStr.split(), dtype=float).reshape((-1, 2))[:, ::-1]
 
         # Frame, which is not stored in the measurementFrameSet node, but in 
         # the generalProductInfo node. 
-        prodInfoNode = self.findMetadataNodeByIdName(metadataNodeList, 'generalProductInformation')
-        frameNodeList = prodInfoNode.getElementsByTagName('sentinel3:alongtrackCoordinate')
         self.frameNumber = None
-        if len(frameNodeList) > 0:
-            frameNode = frameNodeList[0]
-            self.frameNumber = int(frameNode.firstChild.data.strip())
+        if ('generalProductInformation', 'alongtrackCoordinate') in fieldDict:
+            self.frameNumber = int(fieldDict[('generalProductInformation', 'alongtrackCoordinate')])
         
         # Processing level
-        productTypeNode = prodInfoNode.getElementsByTagName('sentinel3:productType')[0]
-        self.productType = productTypeNode.firstChild.data.strip()
+        self.productType = fieldDict[('generalProductInformation', 'productType')]
         self.processingLevel = self.productType[3]
         self.productName = self.productType[5:]
         
         # Product creation/processing time. Note that they use a different time format (sigh.....)
-        creationTimeNode = prodInfoNode.getElementsByTagName('sentinel3:creationTime')[0]
-        generationTimeStr = creationTimeNode.firstChild.data.strip()
+        generationTimeStr = fieldDict[('generalProductInformation', 'creationTime')]
         self.generationTime = datetime.datetime.strptime(generationTimeStr, "%Y%m%dT%H%M%S")
         # I think this is as close as we get to a software version number. 
-        baselineNode = prodInfoNode.getElementsByTagName('sentinel3:baselineCollection')[0]
-        self.baselineCollection = baselineNode.firstChild.data.strip()
+        self.baselineCollection = fieldDict[('generalProductInformation', 'baselineCollection')]
 
         # Orbit number
-        orbitRefNode = self.findMetadataNodeByIdName(metadataNodeList, 'measurementOrbitReference')
-        relativeOrbitNode = orbitRefNode.getElementsByTagName('sentinel-safe:relativeOrbitNumber')[0]
-        self.relativeOrbitNumber = int(relativeOrbitNode.firstChild.data.strip())
-        absoluteOrbitNode = orbitRefNode.getElementsByTagName('sentinel-safe:orbitNumber')[0]
-        self.absoluteOrbitNumber = int(absoluteOrbitNode.firstChild.data.strip())
-        cycleNode = orbitRefNode.getElementsByTagName('sentinel-safe:cycleNumber')[0]
-        self.cycleNumber = int(cycleNode.firstChild.data.strip())
-        
-        # MD5 checksum for .nc files
-        dataSectionNode = xfduNode.getElementsByTagName('dataObjectSection')[0]
-        dataList = dataSectionNode.getElementsByTagName('dataObject')
-        md5={}
-        for dataObject in dataList:
-            key=dataObject.getElementsByTagName('fileLocation')[0].getAttribute('href')
-            value=dataObject.getElementsByTagName('checksum')[0].firstChild.data.strip()
-            md5[key]=value
-        self.md5=md5
+        self.relativeOrbitNumber = int(fieldDict[('measurementOrbitReference', 'relativeOrbitNumber')])
+        self.absoluteOrbitNumber = int(fieldDict[('measurementOrbitReference', 'orbitNumber')])
+        self.cycleNumber = int(fieldDict[('measurementOrbitReference', 'cycleNumber')])
 
         # Currently have no mechanism for a preview image
         self.previewImgBin = None
-        
-    @staticmethod
-    def findMetadataNodeByIdName(metadataNodeList, idName):
-        """
-        Search the given list of metadataNode objects, and find the first one with the
-        given ID=idName. If no such object found, return None. 
-        
-        """
-        metadataObj = None
-        matchingNodes = [node for node in metadataNodeList if node.getAttribute('ID') == idName]
-        if len(matchingNodes) > 0:
-            metadataObj = matchingNodes[0]
 
-        return metadataObj
+
+def readManifestFromZipfile(zf):
+    """
+    Return the contents of the xfdumanifest.xml file inside the given open zipfile.ZipFile
+    """
+    metadataXmlfile = next(fn for fn in zf.namelist() if fn.endswith('xfdumanifest.xml'))
+    return zf.read(metadataXmlfile)
+
+
+# The tags we want from within each metadataObject in the manifest, as local names, i.e. 
+# without their namespace prefix. Only the first occurrence within each metadataObject is used. 
+MANIFEST_FIELDNAMES = set(['startTime', 'stopTime', 'familyName', 'number', 'posList', 
+    'alongtrackCoordinate', 'productType', 'creationTime', 'baselineCollection', 
+    'relativeOrbitNumber', 'orbitNumber', 'cycleNumber'])
+
+
+def scanManifest(xmlStr):
+    """
+    Scan the xfdumanifest.xml string for the fields we want. This uses ElementTree.iterparse(),
+    and discards each metadataObject and dataObject as it is finished with, so the
+    whole document is never held in memory as a DOM. 
+    
+    Returns a tuple (fieldDict, md5Dict). The fieldDict is keyed by a tuple of
+    (metadataObjectID, localTagName), for the tags in MANIFEST_FIELDNAMES, with 
+    the stripped text of the element as value. The instrument's familyName is 
+    different, in that the key is (metadataObjectID, 'instrumentAbbreviation'), and the 
+    value is its abbreviation attribute. The md5Dict is keyed by the href of 
+    each dataObject's fileLocation, with the value of its checksum. 
+    
+    """
+    if not isinstance(xmlStr, bytes):
+        xmlStr = xmlStr.encode('utf-8')
+    
+    fieldDict = {}
+    md5Dict = {}
+    metadataObjId = None
+    inInstrument = False
+    for (event, elem) in ElementTree.iterparse(BytesIO(xmlStr), events=('start', 'end')):
+        localName = localTagName(elem)
+        if event == 'start':
+            if localName == 'metadataObject':
+                metadataObjId = elem.get('ID')
+            elif localName == 'instrument':
+                inInstrument = True
+        elif localName == 'metadataObject':
+            metadataObjId = None
+            elem.clear()
+        elif localName == 'instrument':
+            inInstrument = False
+        elif localName == 'dataObject':
+            href = None
+            checksum = None
+            for subElem in elem.iter():
+                subName = localTagName(subElem)
+                if subName == 'fileLocation' and href is None:
+                    href = subElem.get('href')
+                elif subName == 'checksum' and checksum is None:
+                    checksum = subElem.text.strip()
+            md5Dict[href] = checksum
+            elem.clear()
+        elif metadataObjId is not None and localName in MANIFEST_FIELDNAMES:
+            key = (metadataObjId, localName)
+            value = (elem.text or '').strip()
+            if localName == 'familyName':
+                if inInstrument:
+                    key = (metadataObjId, 'instrumentAbbreviation')
+                    value = elem.get('abbreviation')
+                elif elem.get('abbreviation', '') != '':
+                    key = None
+            if key is not None and key not in fieldDict:
+                fieldDict[key] = value
+
+    return (fieldDict, md5Dict)
+
+
+def localTagName(elem):
+    """
+    Return the tag name of the given ElementTree element, without any namespace
+    """
+    return elem.tag.split('}')[-1]
 
 
 class Sen3MetaError(Exception): pass
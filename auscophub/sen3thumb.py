@@ -8,6 +8,10 @@ from distutils import spawn
 import subprocess
 import zipfile
 import shutil
+import tempfile
+from concurrent import futures
+
+from auscophub import dirstruct
 
 def sen3thumb(zipfilename, finalOutputDir, 
               dummy, verbose, noOverwrite, mountpath,
@@ -31,20 +35,19 @@ def sen3thumb(zipfilename, finalOutputDir,
         cmd = os.path.join(pconvertpath, 'pconvert')
     else:
         cmd = 'pconvert'
-    if not spawn.find_executable(cmd):
+    if not findExecutable(cmd):
         raise thumbError("Executable {} is not found.".format(cmd)) 
 
     # confirm mount command
     # if archivemount is not available, unzip the file in the mount location
     mountcmd = 'archivemount'
     mount = True
-    if not spawn.find_executable(mountcmd):
+    if not findExecutable(mountcmd):
         mount = False
         if verbose:
             print("Executable {} is not found, will unzip the archive in path {}".format(mountcmd, mountpath)) 
 
-    pngFilename = os.path.basename(zipfilename).replace('.zip', '.png')
-    finalPngFile = os.path.join(finalOutputDir, pngFilename)
+    finalPngFile = dirstruct.makeFinalFilename(zipfilename, finalOutputDir, '.zip', '.png')
     if dummy:
         print("Would make", finalPngFile)
     elif os.path.exists(finalPngFile) and noOverwrite:
@@ -65,9 +68,8 @@ def sen3thumb(zipfilename, finalOutputDir,
         if verbose: print("Creating mountpoint {}.".format(mountpoint))
         os.mkdir(mountpoint)
         if mount:
-            mountcmd = 'archivemount {} {}'.format(zipfilename, mountpoint)
             if verbose: print("Mounting zipfile {} to {}.".format(zipfilename, mountpoint))
-            returncode = subprocess.call(mountcmd, shell=True)
+            returncode = subprocess.call([mountcmd, zipfilename, mountpoint])
             if returncode != 0:
                 raise thumbError("Failed to mount file {} to point {}.".format(zipfilename, mountpoint))
         else:
@@ -81,11 +83,17 @@ def sen3thumb(zipfilename, finalOutputDir,
             raise thumbError("{} directories found in mountpoint {}.".format(len(mountdir), mountpoint))
 
         mountpath = os.path.join(mountpoint, mountdir[0])
-        fullcmd = '{} -f png -r 512,512 -b {} -m equalize {} -o {}'.format(cmd, bands, mountpath, outputdir)
+        fullcmd = [cmd, '-f', 'png', '-r', '512,512', '-b', bands, '-m', 'equalize', 
+            mountpath, '-o', outputdir]
 
-        # run conversion
+        # run conversion. Only collect pconvert's (rather verbose) stdout if we might
+        # report it, otherwise it just gets thrown away. 
         if verbose: print("Creating", finalPngFile)
-        proc = subprocess.Popen(fullcmd, shell=True, stdout=subprocess.PIPE, 
+        if verbose:
+            stdoutDest = subprocess.PIPE
+        else:
+            stdoutDest = subprocess.DEVNULL
+        proc = subprocess.Popen(fullcmd, stdout=stdoutDest, 
             stderr=subprocess.PIPE, universal_newlines=True)
         stdout, stderr= proc.communicate()
         if proc.returncode != 0:
@@ -99,9 +107,68 @@ def sen3thumb(zipfilename, finalOutputDir,
         if verbose: print("Directory {} is removed.".format(mountpoint))
 
 
+def sen3thumbBatch(zipfileDirList, dummy, verbose, noOverwrite, mountpath,
+                   pconvertpath=None, bands=None, numWorkers=None):
+    """
+    Make thumbnails for a number of Sentinel-3 zipfiles, running sen3thumb() on 
+    several of them concurrently, in a pool of numWorkers processes (default is
+    one per CPU). 
+    
+    The zipfileDirList is a list of (zipfilename, finalOutputDir) pairs. Each 
+    zipfile is mounted in its own temporary directory under mountpath, so that 
+    concurrent mounts cannot get in each other's way. 
+    
+    Returns a list of (zipfilename, msg) pairs for any zipfiles which failed. 
+    
+    """
+    failureList = []
+    with futures.ProcessPoolExecutor(max_workers=numWorkers) as pool:
+        futureDict = {}
+        for (zipfilename, finalOutputDir) in zipfileDirList:
+            fut = pool.submit(sen3thumbInTempMount, zipfilename, finalOutputDir, 
+                dummy, verbose, noOverwrite, mountpath, pconvertpath, bands)
+            futureDict[fut] = zipfilename
+        for fut in futures.as_completed(futureDict):
+            try:
+                fut.result()
+            except Exception as e:
+                failureList.append((futureDict[fut], str(e)))
+    return failureList
+
+
+def sen3thumbInTempMount(zipfilename, finalOutputDir, dummy, verbose, noOverwrite, 
+        mountpath, pconvertpath, bands):
+    """
+    Call sen3thumb() for a single zipfile, using a private temporary directory
+    under mountpath, which is removed afterwards if empty. Used by sen3thumbBatch(). 
+    """
+    tmpMountpath = tempfile.mkdtemp(prefix='sen3thumb_', dir=mountpath)
+    try:
+        sen3thumb(zipfilename, finalOutputDir, dummy, verbose, noOverwrite, 
+            tmpMountpath, pconvertpath=pconvertpath, bands=bands)
+    finally:
+        # Deliberately not rmtree(), in case a failure has left a zipfile mounted in there
+        try:
+            os.rmdir(tmpMountpath)
+        except OSError:
+            pass
+
+
+# Results of findExecutable(), so the PATH is only searched once per command in each process
+executableCache = {}
+
+
+def findExecutable(cmd):
+    """
+    Return the full path of the given executable, or None if it can't be found. 
+    """
+    if cmd not in executableCache:
+        executableCache[cmd] = spawn.find_executable(cmd)
+    return executableCache[cmd]
+
+
 def umount(mountpoint):
-    umountcmd = 'umount {}'.format(mountpoint)
-    returncode = subprocess.call(umountcmd, shell=True)
+    returncode = subprocess.call(['umount', mountpoint])
     if returncode != 0:
         raise thumbError("Failed to unmount {}.".format(mountpoint))
     
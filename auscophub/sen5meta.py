@@ -13,7 +13,7 @@ from osgeo import gdal
 from auscophub import geomutils
 
 
-class Sen5Meta(object):
+class Sen5Meta(geomutils.LazyFootprintMixin):
     """
     The metadata associated with the Sentinel-5 netCDF file.  
     
@@ -72,15 +72,8 @@ class Sen5Meta(object):
         numVals = len(posListStrVals)
         # Note that a gml:posList has pairs in order [lat long ....], with no sensible pair delimiter
         posListPairs = ["{} {}".format(posListStrVals[i+1], posListStrVals[i]) for i in range(0, numVals, 2)]
-        posListVals = [[float(x), float(y)] for (x, y) in [pair.split() for pair in posListPairs]]
-
-        footprintGeom = geomutils.geomFromOutlineCoords(posListVals)
-        prefEpsg = geomutils.findSensibleProjection(footprintGeom)
-        if prefEpsg is not None:
-            self.centroidXY = geomutils.findCentroid(footprintGeom, prefEpsg)
-        else:
-            self.centroidXY = None
-        self.outlineWKT = footprintGeom.ExportToWkt()
+        # The centroidXY and outlineWKT properties are calculated from these when first used
+        self.footprintCoords = [[float(x), float(y)] for (x, y) in [pair.split() for pair in posListPairs]]
 
         # Currently have no mechanism for a preview image
         self.previewImgBin = None
@@ -122,15 +115,8 @@ class Sen5Meta(object):
         numVals = len(posListStrVals)
         # Note that a gml:posList has pairs in order [lat long ....], with no sensible pair delimiter
         posListPairs = ["{} {}".format(posListStrVals[i+1], posListStrVals[i]) for i in range(0, numVals, 2)]
-        posListVals = [[float(x), float(y)] for (x, y) in [pair.split() for pair in posListPairs]]
-
-        footprintGeom = geomutils.geomFromOutlineCoords(posListVals)
-        prefEpsg = geomutils.findSensibleProjection(footprintGeom)
-        if prefEpsg is not None:
-            self.centroidXY = geomutils.findCentroid(footprintGeom, prefEpsg)
-        else:
-            self.centroidXY = None
-        self.outlineWKT = footprintGeom.ExportToWkt()
+        # The centroidXY and outlineWKT properties are calculated from these when first used
+        self.footprintCoords = [[float(x), float(y)] for (x, y) in [pair.split() for pair in posListPairs]]
 
         # Currently have no mechanism for a preview image
         self.previewImgBin = None
@@ -23,6 +23,7 @@ from osgeo import osr
 from osgeo import ogr
 
 from auscophub import auscophubmeta
+from auscophub import geomutils
 
 def getCmdargs():
     """
@@ -66,10 +67,8 @@ def mainRoutine():
             xmllistOutside.append(xmlfile)
             geomOutsideList.append(geom)
 
-    f = open(cmdargs.outsidelist, 'w')  
-    for xmlfile in xmllistOutside:
-        f.write(xmlfile+'\n')
-    f.close()
+    with open(cmdargs.outsidelist, 'w') as f:
+        f.write(''.join([xmlfile+'\n' for xmlfile in xmllistOutside]))
     
     if cmdargs.outsideshp is not None:
         writeShapefile(cmdargs.outsideshp, roiSr, geomOutsideList)
@@ -87,15 +86,12 @@ def readRoiPolygon(roifile):
     lyr = ds.GetLayer()
     sr = lyr.GetSpatialRef()
     
-    fullGeom = None
+    geomList = []
     feat = lyr.GetNextFeature()
     while feat is not None:
-        geom = feat.GetGeometryRef()
-        if fullGeom is None:
-            fullGeom = copyGeom(geom)
-        else:
-            fullGeom = fullGeom.Union(geom)
+        geomList.append(copyGeom(feat.GetGeometryRef()))
         feat = lyr.GetNextFeature()
+    fullGeom = geomutils.unionOfGeometries(geomList)
     
     return (fullGeom, sr)
 
@@ -18,7 +18,7 @@ from __future__ import print_function
 
 import os
 import argparse
-import fnmatch
+import json
 
 from auscophub import sen1meta, sen2meta, sen3meta, dirstruct
 
@@ -30,6 +30,10 @@ def getCmdargs():
     p = argparse.ArgumentParser()
     p.add_argument("--outscript", 
         help="Filename of script to write, which will move files which are in wrong directory")
+    p.add_argument("--cache", 
+        help=("JSON file in which to cache the correct directory for each zip file, between "+
+            "runs. Zip files whose size and modification time have not changed since the "+
+            "previous run are not re-read. Default does not use a cache. "))
     cmdargs = p.parse_args()
     return cmdargs
 
@@ -41,14 +45,18 @@ def main():
     cmdargs = getCmdargs()
     
     suffixList = ['zip', 'xml', 'png']
+    relDirCache = loadRelDirCache(cmdargs.cache)
     
     zipfilesToMove = []
     # Walk the directory tree under '.', looking for zip files which are 
     for (dirpath, dirnames, filenames) in os.walk('.'):
         for fn in filenames:
-            if fnmatch.fnmatch(fn, '*.zip'):
+            if fn.endswith('.zip'):
                 fnWithRelDir = os.path.join(dirpath, fn)
-                correctRelDir = getRelDir(fnWithRelDir)
+                if cmdargs.cache is not None:
+                    correctRelDir = getRelDirCached(fnWithRelDir, relDirCache)
+                else:
+                    correctRelDir = getRelDir(fnWithRelDir)
                 if correctRelDir is not None:
                     absActualDir = os.path.abspath(dirpath)
                     (actualRelDir, topDir) = matchSubdirLevel(absActualDir, correctRelDir)
@@ -61,25 +69,35 @@ def main():
                 else:
                     print("Cannot deduce correct dir for", os.path.join(dirpath, fn))
 
+    if cmdargs.cache is not None:
+        saveRelDirCache(cmdargs.cache, relDirCache)
+
     if len(zipfilesToMove) > 0:
         # Check all destination directories, and for any which do not exists, generate mkdir commands
         allCorrectDirs = sorted(list(set(['/'.join(r[-2:]) for r in zipfilesToMove])))
         if cmdargs.outscript is not None:
-            f = open(cmdargs.outscript, 'w')
-            print("#!/bin/bash", file=f)
-            print("cd", os.getcwd(), file=f)
+            scriptLines = ["#!/bin/bash\n", "cd {}\n".format(os.getcwd())]
             dirsToCreate = [d for d in allCorrectDirs if not os.path.exists(d)]
             for d in dirsToCreate:
-                print("mkdir -p", d, file=f)
+                scriptLines.append("mkdir -p {}\n".format(d))
 
             print(len(zipfilesToMove))
+            # Cache the contents of each directory, so we only list it once, rather
+            # than checking for each associated file separately
+            dirContentsCache = {}
             for (dirpath, fn, topDir, correctRelDir) in zipfilesToMove:
+                if dirpath not in dirContentsCache:
+                    dirContentsCache[dirpath] = set([entry.name for entry in os.scandir(dirpath)])
+                dirContents = dirContentsCache[dirpath]
                 for suffix in suffixList:
                     fnToMove = fn.replace('.zip', '.{}'.format(suffix))
                     fnToMoveFull = os.path.join(dirpath, fnToMove)
-                    if os.path.exists(fnToMoveFull):
+                    if fnToMove in dirContents:
                         outDirFull = '/'.join([topDir, correctRelDir])
-                        print("mv", fnToMoveFull, outDirFull, file=f)
+                        scriptLines.append("mv {} {}\n".format(fnToMoveFull, outDirFull))
+            
+            with open(cmdargs.outscript, 'w') as f:
+                f.writelines(scriptLines)
         
         print("Found", len(zipfilesToMove), "files in wrong directories")
     else:
@@ -111,6 +129,52 @@ def getRelDir(zipfilename):
     return relativeOutputDir
 
 
+def getRelDirCached(zipfilename, relDirCache):
+    """
+    Get the relative directory for the given zip file, using the cached value if 
+    the zip file has not changed since it was cached. The relDirCache is a dictionary, 
+    keyed by absolute zip file name, with values [mtime, sizeBytes, relativeOutputDir],
+    and is updated with any newly calculated directories. 
+    
+    If the zip file cannot be stat'ed (e.g. a dangling symlink, or removed during the
+    walk), it is left to getRelDir(), which returns None for anything it cannot read. 
+    """
+    zipfileFull = os.path.abspath(zipfilename)
+    try:
+        statInfo = os.stat(zipfileFull)
+    except OSError:
+        statInfo = None
+    cacheEntry = relDirCache.get(zipfileFull)
+    if (statInfo is not None and cacheEntry is not None and 
+            cacheEntry[0] == statInfo.st_mtime and cacheEntry[1] == statInfo.st_size):
+        relativeOutputDir = cacheEntry[2]
+    else:
+        relativeOutputDir = getRelDir(zipfilename)
+        if relativeOutputDir is not None and statInfo is not None:
+            relDirCache[zipfileFull] = [statInfo.st_mtime, statInfo.st_size, relativeOutputDir]
+    return relativeOutputDir
+
+
+def loadRelDirCache(cachefile):
+    """
+    Load the cache of relative directories from the given JSON file. Returns
+    an empty dictionary if cachefile is None, or does not yet exist. 
+    """
+    relDirCache = {}
+    if cachefile is not None and os.path.exists(cachefile):
+        with open(cachefile) as f:
+            relDirCache = json.load(f)
+    return relDirCache
+
+
+def saveRelDirCache(cachefile, relDirCache):
+    """
+    Save the cache of relative directories to the given JSON file
+    """
+    with open(cachefile, 'w') as f:
+        json.dump(relDirCache, f)
+
+
 def matchSubdirLevel(absDir, correctRelDir):
     """
     The two input directories are supposed to be to the same level. Find how many
@@ -118,11 +182,15 @@ def matchSubdirLevel(absDir, correctRelDir):
     from the end of absDir. Also return the topDir, which is the components of absDir
     above the level of correctRelativeDir
     
+    Since absDir is absolute, its first component is the empty string before the
+    leading '/'. If absDir is not deep enough to hold all the levels, this ends up
+    in matchingSubdir, so it cannot match, and topDir comes back empty. 
+    
     """
-    numLevels = len(correctRelDir.split('/'))
+    numLevels = correctRelDir.count('/') + 1
     absDirComponents = absDir.split('/')
     
-    matchingSubdir = '/'.join(absDirComponents[1:][-numLevels:])
+    matchingSubdir = '/'.join(absDirComponents[-numLevels:])
     topDir = '/'.join(absDirComponents[:-numLevels])
     return (matchingSubdir, topDir)
 
@@ -10,13 +10,28 @@ from __future__ import print_function, division
 
 import os
 import argparse
+import bisect
 import json
-import copy
+import itertools
+from concurrent import futures
+try:
+    # If orjson is available, we use it for faster writing of JSON files
+    import orjson
+except ImportError:
+    orjson = None
 
 from osgeo import ogr, osr
 
 from auscophub import saraclient, geomutils
 
+# Maximum number of concurrent searches, when searching with multiple polygons
+MAX_SEARCH_THREADS = 8
+# Buffer size for writing output files. Features are written one at a time, so we 
+# want these gathered up into large writes. 
+WRITE_BUFFERSIZE = 1 << 20
+# Exclude lists of at least this many names are held in a SortedIdSet, rather than a set()
+LARGE_EXCLUDELIST_SIZE = 10000
+
 def getCmdargs():
     """
     Get commandline arguments
@@ -66,6 +81,10 @@ def getCmdargs():
             "file can be any vector format readable using GDAL/OGR. It should contain a "+
             "single polygon layer, with one or more polygons. Highly complex polygons will "+
             "only slow down searching, so keep it simple. "))
+    spatialGroup.add_argument("--simplifytolerance", type=float, default=0.01,
+        help=("Tolerance (in degrees) for simplifying the --polygonfile polygons before "+
+            "sending them to the server, as complex polygons make for long query URLs and slow "+
+            "searches. Use 0 to send the polygons unchanged (default=%(default)s)"))
     
     outputGroup = p.add_argument_group(title="Output options")
     outputGroup.add_argument("--urllist", 
@@ -100,112 +119,238 @@ def mainRoutine():
     
     excludeSet = loadExcludeList(cmdargs.excludelist)
     if cmdargs.polygonfile is not None:
-        geomList = readPolygonFile(cmdargs.polygonfile)
+        geomList = readPolygonFile(cmdargs.polygonfile, cmdargs.simplifytolerance)
     else:
         geomList = [None]
     
     queryParamList = cmdargs.queryparam
-    results = []
-    # Loop over each polygon in the input polygonfile
-    for geom in geomList:
-        tmpParamList = copy.copy(queryParamList)
-        if geom is not None:
-            tmpParamList.append("geometry={}".format(geom.ExportToWkt()))
-        tmpResults = saraclient.searchSara(urlOpener, cmdargs.sentinel, tmpParamList)
-        results.extend(tmpResults)
-    
-    # Remove any duplicates from images which intersect multiple geometries in geomlist
-    tmpResults = []
+    
+    def makeParamList(geom):
+        # A new list is only needed when there is a geometry to add
+        if geom is None:
+            paramList = queryParamList
+        else:
+            paramList = queryParamList + ["geometry={}".format(geom.ExportToWkt())]
+        return paramList
+    
+    if len(geomList) == 0:
+        # A polygon file with no polygons in it, so nothing to search, but still 
+        # write the (empty) outputs
+        writeResults(cmdargs, iter([]), excludeSet)
+    elif len(geomList) == 1:
+        # A single search, so we can stream the results straight through from the 
+        # server, one page at a time, without holding them all in memory
+        results = saraclient.searchSaraIter(urlOpener, cmdargs.sentinel, 
+            makeParamList(geomList[0]))
+        writeResults(cmdargs, results, excludeSet)
+    else:
+        # Search for each polygon in the input polygonfile. These are independent queries,
+        # so run them concurrently, as they spend most of their time waiting on the server. 
+        def searchOneGeom(geom):
+            return saraclient.searchSara(urlOpener, cmdargs.sentinel, makeParamList(geom))
+        
+        numThreads = min(MAX_SEARCH_THREADS, len(geomList))
+        with futures.ThreadPoolExecutor(max_workers=numThreads) as pool:
+            results = itertools.chain.from_iterable(pool.map(searchOneGeom, geomList))
+            writeResults(cmdargs, results, excludeSet)
+
+
+def writeResults(cmdargs, results, excludeSet):
+    """
+    Write each feature from the results iterable to the selected outputs, as it arrives. 
+    Removes any duplicates from images which intersect multiple search geometries, 
+    and any which are in the exclude set. The attributes we need from each feature 
+    are looked up once only, rather than digging them out of the feature structure 
+    again for each use. 
+    
+    """
     idSet = set()
-    for r in results:
-        esaid = saraclient.getFeatAttr(r, saraclient.FEATUREATTR_ESAID)
-        if esaid not in idSet:
-            idSet.add(esaid)
-            tmpResults.append(r)
-    results = tmpResults
-    
-    # Restrict further by additional search options
-    results = [f for f in results 
-        if saraclient.getFeatAttr(f, saraclient.FEATUREATTR_ESAID) not in excludeSet]
-    
-    if cmdargs.urllist is not None:
-        writeUrllist(cmdargs.urllist, results)
-    if cmdargs.curlscript is not None:
-        writeCurlScript(cmdargs, results)
-    if cmdargs.jsonfeaturesfile is not None:
-        writeJsonFeatures(cmdargs.jsonfeaturesfile, results)
-    if cmdargs.simplejsonfile is not None:
-        writeSimpleJsonFile(cmdargs.simplejsonfile, results)
+    with SearchOutputs(cmdargs) as outputs:
+        for f in results:
+            esaid = saraclient.getFeatAttr(f, saraclient.FEATUREATTR_ESAID)
+            if esaid not in idSet and esaid not in excludeSet:
+                idSet.add(esaid)
+                url = saraclient.getFeatAttr(f, saraclient.FEATUREATTR_DOWNLOADURL)
+                outputs.writeFeature(url, f)
 
 
 def loadExcludeList(excludeListFile):
     """
-    Load a list of zipfile names to exclude. Return a set() of these names. 
+    Load a list of zipfile names to exclude. Return a frozenset() of these names, or 
+    for a large list, a SortedIdSet, which supports the same "in" test using
+    less memory. 
     
     """
     if excludeListFile is None:
         excludeSet = set()
     elif os.path.exists(excludeListFile):
-        excludeList = [line.strip() for line in open(excludeListFile)]
-        esaIdList = [os.path.basename(filename).strip(".zip") for filename in excludeList]
-        excludeSet = set(esaIdList)
+        # Read in one go. The names may be paths or URLs, and rpartition() is a 
+        # cheaper way to get the last component than os.path.basename()
+        with open(excludeListFile) as f:
+            nameList = [line.strip().rpartition('/')[2] for line in f.read().splitlines()]
+        excludeList = [dropSuffix(name, ".zip") for name in nameList if len(name) > 0]
+        if len(excludeList) < LARGE_EXCLUDELIST_SIZE:
+            excludeSet = frozenset(excludeList)
+        else:
+            excludeSet = SortedIdSet(excludeList)
     else:
         raise AusCopHubSearchError("Unable to read excludelist file '{}'".format(excludeListFile))
     
     return excludeSet
 
 
-def writeCurlScript(cmdargs, results):
+def dropSuffix(name, suffix):
     """
-    Write a bash script of curl commands to download all selected files. 
+    Return the given name with the given suffix removed, if it ends with it. Note
+    that str.strip(suffix) would remove any of the suffix characters, not the suffix. 
+    
     """
-    f = open(cmdargs.curlscript, 'w')
-    f.write("#!/bin/bash\n")
-    for feat in results:
-        url = saraclient.getFeatAttr(feat, saraclient.FEATUREATTR_DOWNLOADURL)
-        proxyOpt = ""
-        if cmdargs.proxy is not None:
-            proxyOpt = "-x {}".format(cmdargs.proxy)
-        curlCmd = "curl -n -L -O -J {} {} {}".format(cmdargs.curloptions, proxyOpt, url)
-        f.write(curlCmd+'\n')
-    f.close()
+    if name.endswith(suffix):
+        name = name[:-len(suffix)]
+    return name
 
 
-def writeUrllist(urllistfile, results):
+class SortedIdSet(object):
     """
-    Write an output of just the download URLs
+    A read-only set of ID strings, held as a sorted list and searched by bisection. 
+    
+    This is used for very large exclude lists. The ESA ID strings share long common 
+    prefixes, but a prefix tree built from Python objects would take far more memory 
+    than the strings themselves. A plain sorted list avoids the hash table overhead 
+    of a set(), while membership tests are still only O(log n). 
+    
     """
-    f = open(urllistfile, 'w')
-    for r in results:
-        url = saraclient.getFeatAttr(r, saraclient.FEATUREATTR_DOWNLOADURL)
-        f.write(url+'\n')
-    f.close()
+    def __init__(self, idList):
+        self.idList = sorted(set(idList))
+    
+    def __contains__(self, idStr):
+        i = bisect.bisect_left(self.idList, idStr)
+        return (i < len(self.idList) and self.idList[i] == idStr)
+    
+    def __len__(self):
+        return len(self.idList)
 
 
-def writeJsonFeatures(jsonfeaturesfile, results):
+class SearchOutputs(object):
     """
-    Write a JSON file of the results. This is mostly just for testing purposes, I think....
+    The output files requested on the commandline. These are written one feature
+    at a time, as the search results arrive, so the whole set of results need never
+    be held in memory at once. Use as a context manager, or call close() when 
+    finished, to complete the files. If the search fails part way, the context 
+    manager calls discard() instead, so that a partial set of results cannot be 
+    mistaken for a complete one. 
+    
+    The output files are:
+        urllist: the download URLs, one per line
+        curlscript: a bash script of curl commands to download all selected files
+        jsonfeaturesfile: a GeoJSON FeatureCollection of the full features. This is 
+            written compactly, without indentation, as it can be very large, and is 
+            mostly intended to be read by other software. 
+        simplejsonfile: a JSON list of simple dictionaries, with just a few 
+            easy-to-find attributes on each feature, one per line. Mostly just for 
+            testing purposes. 
+    
     """
-    f = open(jsonfeaturesfile, 'w')
-    geoJsonObj = {"type":"FeatureCollection", "properties":{}, "features":results}
-    json.dump(geoJsonObj, f, indent=2)
+    def __init__(self, cmdargs):
+        self.urllistFile = None
+        self.curlscriptFile = None
+        self.jsonfeaturesFile = None
+        self.simplejsonFile = None
+        self.numFeatures = 0
 
+        if cmdargs.urllist is not None:
+            self.urllistFile = open(cmdargs.urllist, 'w', buffering=WRITE_BUFFERSIZE)
+        if cmdargs.curlscript is not None:
+            self.curlscriptFile = open(cmdargs.curlscript, 'w', buffering=WRITE_BUFFERSIZE)
+            self.curlscriptFile.write("#!/bin/bash\n")
+            proxyOpt = ""
+            if cmdargs.proxy is not None:
+                proxyOpt = "-x {}".format(cmdargs.proxy)
+            # Everything except the URL is the same on every line
+            self.curlPrefix = "curl -n -L -O -J {} {} ".format(cmdargs.curloptions, proxyOpt)
+        if cmdargs.jsonfeaturesfile is not None:
+            self.jsonfeaturesFile = open(cmdargs.jsonfeaturesfile, 'w', buffering=WRITE_BUFFERSIZE)
+            self.jsonfeaturesFile.write('{"type":"FeatureCollection","properties":{},"features":[\n')
+        if cmdargs.simplejsonfile is not None:
+            self.simplejsonFile = open(cmdargs.simplejsonfile, 'w', buffering=WRITE_BUFFERSIZE)
+            self.simplejsonFile.write('[\n')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.discard()
+    
+    def writeFeature(self, url, feat):
+        """
+        Write the given feature, with the given download URL, to each of the output files
+        """
+        # Separator between JSON list elements
+        jsonSep = ""
+        if self.numFeatures > 0:
+            jsonSep = ",\n"
 
-def writeSimpleJsonFile(simplejsonfile, results):
+        if self.urllistFile is not None:
+            self.urllistFile.write(url+'\n')
+        if self.curlscriptFile is not None:
+            self.curlscriptFile.write(self.curlPrefix+url+'\n')
+        if self.jsonfeaturesFile is not None:
+            self.jsonfeaturesFile.write(jsonSep + jsonDumps(feat))
+        if self.simplejsonFile is not None:
+            self.simplejsonFile.write(jsonSep + jsonDumps(saraclient.simplifyFullFeature(feat)))
+        self.numFeatures += 1
+    
+    def close(self):
+        """
+        Finish off and close all the output files
+        """
+        if self.jsonfeaturesFile is not None:
+            self.jsonfeaturesFile.write('\n]}\n')
+        if self.simplejsonFile is not None:
+            self.simplejsonFile.write('\n]\n')
+        for f in self.openFiles():
+            f.close()
+    
+    def discard(self):
+        """
+        Close and remove all the output files, without finishing them off
+        """
+        for f in self.openFiles():
+            f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+    
+    def openFiles(self):
+        """
+        Return a list of the output file objects which were opened
+        """
+        return [f for f in [self.urllistFile, self.curlscriptFile, self.jsonfeaturesFile, 
+            self.simplejsonFile] if f is not None]
+
+
+def jsonDumps(obj):
     """
-    Write a simple JSON file of the results, with just a few easy-to-find attributes
-    on each feature. Mostly just for testing purposes. 
+    Return a compact JSON string for the given object. Uses the orjson package
+    if it is available, as it is much faster, otherwise falls back to the standard
+    json module. 
     """
-    f = open(simplejsonfile, 'w')
-    simpleList = [saraclient.simplifyFullFeature(feat) for feat in results]
-    json.dump(simpleList, f, indent=2)
+    if orjson is not None:
+        jsonStr = orjson.dumps(obj).decode('utf-8')
+    else:
+        jsonStr = json.dumps(obj, separators=(',', ':'))
+    return jsonStr
 
 
-def readPolygonFile(polygonfile):
+def readPolygonFile(polygonfile, simplifyTolerance=0):
     """
     Read the given vector file and return a list of ogr.Geometry objects 
     for each polygon in the first layer. The geometries are re-projected 
-    into lat/long (EPSG:4326). 
+    into lat/long (EPSG:4326), if not already in it. If simplifyTolerance 
+    is greater than zero, they are then simplified to within that 
+    tolerance (in degrees). 
         
     """
     srLL = osr.SpatialReference()
@@ -214,15 +359,18 @@ def readPolygonFile(polygonfile):
 
     ds = ogr.Open(polygonfile)
     lyr = ds.GetLayer()
+    lyrSr = lyr.GetSpatialRef()
+    needsTransform = (lyrSr is None or not lyrSr.IsSame(srLL))
     feat = lyr.GetNextFeature()
     geomList = []
     while feat is not None:
-        geom = feat.GetGeometryRef()
-        # Copy the geometry
-        geom2 = ogr.Geometry(wkt=geom.ExportToWkt())
-        geom2.AssignSpatialReference(geom.GetSpatialReference())
-        geom2.TransformTo(srLL)
-        geomList.append(geom2)
+        # Copy the geometry, as the feature owns the original
+        geom = feat.GetGeometryRef().Clone()
+        if needsTransform:
+            geom.TransformTo(srLL)
+        if simplifyTolerance > 0:
+            geom = geom.SimplifyPreserveTopology(simplifyTolerance)
+        geomList.append(geom)
         feat = lyr.GetNextFeature()
     
     return geomList
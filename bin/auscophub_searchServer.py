@@ -17,15 +17,30 @@ a simple fashion, and will hopefully be replaced at some point.
 from __future__ import print_function, division
 
 import os
+import sys
 import argparse
 import datetime
+import itertools
+from concurrent import futures
 
 from osgeo import ogr, osr
+try:
+    import shapely
+    import numpy
+except ImportError:
+    shapely = None
 
 from auscophub import client
 from auscophub import geomutils
 
 
+# Number of footprints tested in each task, when the OGR region filter is run 
+# in parallel. Large enough that the pickling of each task is a small overhead. 
+REGION_CHUNKSIZE = 256
+# Filtering options which are only meaningful for the radar (Sentinel-1)
+RADAR_ONLY_OPTIONS = ['polarisation', 'swathmode', 'direction']
+
+
 def getCmdargs():
     """
     Get commandline arguments
@@ -57,6 +72,17 @@ def getCmdargs():
             "For Sentinel-3 SRAL, options are {SR_2_WAT___, SR_2_LAN___}"))
     p.add_argument("--proxy", help=("URL of proxy server. Default uses no proxy, "+
         "assuming direct connection to the internet. Currently only supports non-authenticating proxies. "))
+    defaultCacheDir = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "auscophub", "thredds")
+    p.add_argument("--cachedir", default=os.getenv("AUSCOPHUB_CACHEDIR", defaultCacheDir),
+        help=("Local directory in which to cache the XML files read from the server, so that "+
+            "repeated searches do not read them again. A file is read again if its modified date "+
+            "or size in the server's catalog has changed. Default is $AUSCOPHUB_CACHEDIR if set, "+
+            "otherwise %(default)s"))
+    p.add_argument("--nocache", default=False, action="store_true",
+        help="Do not use the local cache of XML files (neither read nor write it)")
+    p.add_argument("--maxconcurrency", type=int, default=client.DEFAULT_NUM_THREADS,
+        help="Maximum number of XML files to read from the server at once (default=%(default)s)")
     
     filterGroup = p.add_argument_group(title="Filtering options")
     filterGroup.add_argument("--excludelist", help=("File listing zipfile names to exclude from "+
@@ -127,6 +153,17 @@ def getCmdargs():
     if cmdargs.product is None:
         cmdargs.product = defaultProductDict[cmdargs.sentinel]
     
+    # Check for searches which cannot match anything, or filters which cannot apply, 
+    # before doing any work on the server
+    if cmdargs.startdate > cmdargs.enddate:
+        p.error("Start date {} is after end date {}".format(cmdargs.startdate, cmdargs.enddate))
+    if cmdargs.sentinel != 1:
+        for radarOpt in RADAR_ONLY_OPTIONS:
+            if getattr(cmdargs, radarOpt) is not None:
+                print("Warning: --{} applies only to Sentinel-1, and is ignored".format(radarOpt),
+                    file=sys.stderr)
+                setattr(cmdargs, radarOpt, None)
+    
     return cmdargs
 
 
@@ -147,54 +184,62 @@ def mainRoutine():
         # The OGR Envelope tuple is in the same order as our boundingBox tuple
         boundingBox = searchPolygon.GetEnvelope()
     
+    cacheDir = None
+    if not cmdargs.nocache:
+        cacheDir = cmdargs.cachedir
+    
     metalist = client.getDescriptionMetaFromThreddsByBounds(urlOpener, cmdargs.sentinel, 
         cmdargs.instrument, cmdargs.product, cmdargs.startdate, cmdargs.enddate, 
-        boundingBox)
-    metalist = [(urlStr, metaObj) for (urlStr, metaObj) in metalist 
-        if os.path.basename(urlStr).strip(".xml") not in excludeSet]
+        boundingBox, cacheDir=cacheDir, 
+        numThreads=cmdargs.maxconcurrency)
     
-    # Do any further filtering here
-    if not cmdargs.allowbadmd5:
-        metalist = filterBadMd5(metalist)
+    # The exclude list and all the attribute filters in a single pass, then the more 
+    # expensive region filter on whatever is left
+    keepMeta = combinePredicates(makeFilterPredicates(cmdargs))
+    metalist = [(urlStr, metaObj) for (urlStr, metaObj) in metalist
+        if dropSuffix(urlStr.rpartition('/')[2], ".xml") not in excludeSet and keepMeta(metaObj)]
     metalist = filterByRegion(metalist, boundingBox, searchPolygon)
-    metalist = filterBySatellite(metalist, cmdargs)
-    metalist = filterByCloud(metalist, cmdargs)
-    metalist = filterByPolarisation(metalist, cmdargs)
-    metalist = filterBySwathMode(metalist, cmdargs)
-    metalist = filterByDirection(metalist, cmdargs)
     
-    # Generate list of zipfile URLs
-    zipfileUrlList = [urlStr.replace(".xml", ".zip") for (urlStr, metaObj) in metalist]
-    
-    writeOutput(cmdargs, zipfileUrlList, metalist)
+    writeOutput(cmdargs, metalist)
     
 
 def loadExcludeList(excludeListFile):
     """
-    Load a list of zipfile names to exclude. Return a set() of these names. 
+    Load a list of zipfile names to exclude. Return a frozenset() of these names. 
     
     """
     if excludeListFile is None:
         excludeSet = set()
     elif os.path.exists(excludeListFile):
-        excludeList = [line.strip() for line in open(excludeListFile)]
-        esaIdList = [os.path.basename(filename).strip(".zip") for filename in excludeList]
-        excludeSet = set(esaIdList)
+        # Read in one go. The names may be paths or URLs, and rpartition() is a 
+        # cheaper way to get the last component than os.path.basename()
+        with open(excludeListFile) as f:
+            nameList = [line.strip().rpartition('/')[2] for line in f.read().splitlines()]
+        excludeSet = frozenset([dropSuffix(name, ".zip") for name in nameList if len(name) > 0])
     else:
         raise AusCopHubSearchError("Unable to read excludelist file '{}'".format(excludeListFile))
     
     return excludeSet
 
 
-def filterBadMd5(metalist):
+def dropSuffix(name, suffix):
     """
-    Remove any metadata objects where md5_local does not match md5_esa. 
+    Return the given name with the given suffix removed, if it ends with it. Note
+    that str.strip(suffix) would remove any of the suffix characters, not the suffix. 
     
     """
-    metalistFiltered = [(urlStr, metaObj) for (urlStr, metaObj) in metalist 
-        if metaObj.zipfileMd5esa is None or 
-        metaObj.zipfileMd5esa.lower() == metaObj.zipfileMd5local.lower()]
-    return metalistFiltered
+    if name.endswith(suffix):
+        name = name[:-len(suffix)]
+    return name
+
+
+def md5Matches(metaObj):
+    """
+    Return False if md5_local does not match md5_esa for the given metadata object. 
+    
+    """
+    return (metaObj.zipfileMd5esa is None or 
+        metaObj.zipfileMd5esa.lower() == metaObj.zipfileMd5local.lower())
 
 
 def filterByRegion(metalist, boundingBox, searchPolygon):
@@ -202,116 +247,287 @@ def filterByRegion(metalist, boundingBox, searchPolygon):
     Filter the list items based on their footprint polygons, and given region.
     If searchPolygon is not None, use that, otherwise use the boundingBox. 
     
+    If shapely (version 2 or later) is available, it is used to test all the footprints
+    at once. Otherwise each footprint is tested in turn with OGR. In either case, 
+    a footprint whose centroid is inside the search region is accepted without 
+    testing its whole outline. 
+    
     """
+    searchIsBox = (searchPolygon is None)
     if searchPolygon is None:
         (westLong, eastLong, southLat, northLat) = boundingBox
         bboxWkt = 'POLYGON(({left} {top}, {right} {top}, {right} {bottom}, {left} {bottom}, {left} {top}))'.format(
             left=westLong, right=eastLong, top=northLat, bottom=southLat)
         searchPolygon = ogr.Geometry(wkt=bboxWkt)
     
-    metalistFiltered = []
-    for (urlStr, metaObj) in metalist:
-        footprintGeom = ogr.Geometry(wkt=str(metaObj.footprintWkt))
-        prefEpsg = geomutils.findSensibleProjection(footprintGeom)
-        if geomutils.crossesDateline(footprintGeom, prefEpsg):
-            footprintGeom = geomutils.splitAtDateline(footprintGeom, prefEpsg)
-        if footprintGeom.Intersects(searchPolygon):
-            metalistFiltered.append((urlStr, metaObj))
+    if searchCoversAll(metalist, searchPolygon, searchIsBox):
+        # Every footprint must intersect the search region
+        metalistFiltered = list(metalist)
+    elif shapely is not None and hasattr(shapely, 'contains_xy') and len(metalist) > 0:
+        metalistFiltered = filterByRegionShapely(metalist, searchPolygon)
+    else:
+        # The cheap centroid test first, then the full footprint test on the rest
+        keep = [centroidInside(metaObj, searchPolygon) for (urlStr, metaObj) in metalist]
+        residualNdx = [i for i in range(len(metalist)) if not keep[i]]
+        residualWktList = [str(metalist[i][1].footprintWkt) for i in residualNdx]
+        residualKeep = footprintsIntersect(residualWktList, searchPolygon.ExportToWkt(), 
+            searchIsBox)
+        for (i, footprintKeep) in zip(residualNdx, residualKeep):
+            keep[i] = footprintKeep
+        metalistFiltered = [metalist[i] for i in range(len(metalist)) if keep[i]]
     return metalistFiltered
 
 
-def filterByCloud(metalist, cmdargs):
+def searchCoversAll(metalist, searchPolygon, searchIsBox):
     """
-    Filter the meta objects by cloud amount. If no cloud amount present, then
-    all are acceptable (e.g. for Sentinel-1)
+    Return True if the search polygon contains the whole extent of all the footprints
+    in metalist, in which case there is no need to test them individually. This is 
+    the common case of searching the whole archive area. The extent is found directly 
+    from the WKT coordinates, without making any geometries. Footprints which 
+    cross the date line have extents spanning most of the globe, so any such 
+    footprint means this returns False. 
     
     """
-    metalistFiltered = []
-    for (urlStr, metaObj) in metalist:
-        cloudPcnt = None
-        if hasattr(metaObj, 'cloudCoverPcnt'):
-            cloudPcnt = metaObj.cloudCoverPcnt
-        if cloudPcnt is None or cloudPcnt <= cmdargs.maxcloud:
-            metalistFiltered.append((urlStr, metaObj))
+    coversAll = False
+    if len(metalist) > 0:
+        envelopeList = [client.wktEnvelope(metaObj.footprintWkt) for (urlStr, metaObj) in metalist]
+        wholeEnvelope = (min([env[0] for env in envelopeList]), max([env[1] for env in envelopeList]),
+            min([env[2] for env in envelopeList]), max([env[3] for env in envelopeList]))
+        searchEnvelope = searchPolygon.GetEnvelope()
+        coversAll = envelopeWithin(wholeEnvelope, searchEnvelope)
+        if coversAll and not searchIsBox:
+            (xMin, xMax, yMin, yMax) = wholeEnvelope
+            extentWkt = 'POLYGON(({left} {top}, {right} {top}, {right} {bottom}, {left} {bottom}, {left} {top}))'.format(
+                left=xMin, right=xMax, top=yMax, bottom=yMin)
+            coversAll = searchPolygon.Contains(ogr.Geometry(wkt=extentWkt))
+    return coversAll
+
+
+def filterByRegionShapely(metalist, searchPolygon):
+    """
+    The shapely version of filterByRegion(). 
+    
+    Footprints whose centroid is inside the search polygon are accepted straight away, 
+    with one vectorised shapely.contains_xy() call, and their WKT is never parsed. 
+    The remaining footprints are parsed all at once, and put into an STRtree, 
+    which is then queried with the search polygon. 
+    
+    Footprints which cross the international date line have a longitude extent of
+    180 degrees or more. These are not meaningful in lat/long, so are still split
+    and tested with OGR, by footprintIntersects(). 
+    
+    If the search polygon covers the whole extent of the other footprints, they
+    all intersect it, and the index is not needed. Covers is used rather than contains, 
+    as an extent which touches the boundary of the search polygon still intersects it. 
+    
+    """
+    searchShape = shapely.from_wkt(searchPolygon.ExportToWkt())
+    # Prepare the search shape, as it is tested against many points and geometries
+    shapely.prepare(searchShape)
+    searchEnvelope = searchPolygon.GetEnvelope()
+    
+    # Centroids as arrays. A centroid of None becomes NaN, which is never inside
+    ctrLong = numpy.array([metaObj.ctrLong for (urlStr, metaObj) in metalist], dtype=numpy.float64)
+    ctrLat = numpy.array([metaObj.ctrLat for (urlStr, metaObj) in metalist], dtype=numpy.float64)
+    keep = shapely.contains_xy(searchShape, ctrLong, ctrLat)
+    
+    residualNdx = (~keep).nonzero()[0]
+    if len(residualNdx) > 0:
+        footprintWktList = [str(metalist[i][1].footprintWkt) for i in residualNdx]
+        footprints = shapely.from_wkt(footprintWktList)
+        bounds = shapely.bounds(footprints)
+        crossesDateline = (bounds[:, 2] - bounds[:, 0]) >= 180
+        
+        notDatelineNdx = (~crossesDateline).nonzero()[0]
+        wholeExtent = None
+        if len(notDatelineNdx) > 0:
+            wholeExtent = shapely.box(*shapely.total_bounds(footprints[notDatelineNdx]))
+        if wholeExtent is not None and shapely.covers(searchShape, wholeExtent):
+            hits = notDatelineNdx
+        else:
+            tree = shapely.STRtree(footprints)
+            hits = tree.query(searchShape, predicate='intersects')
+        keep[residualNdx[hits]] = True
+        
+        for j in crossesDateline.nonzero()[0]:
+            keep[residualNdx[j]] = footprintIntersects(footprintWktList[j], searchPolygon, 
+                searchEnvelope, False, preparedSearchShape=searchShape)
+    
+    metalistFiltered = [metalist[i] for i in keep.nonzero()[0]]
     return metalistFiltered
 
 
-def filterBySatellite(metalist, cmdargs):
+def footprintsIntersect(footprintWktList, searchWkt, searchIsBox):
     """
-    Filter the meta objects by particular satellite. If cmdargs.satelliteletter 
-    is None, all are included. 
+    Return a list of True/False values, one for each footprint WKT in the given list, 
+    for whether it intersects the search polygon (given as WKT). The footprints 
+    are divided into chunks, which are tested in a pool of processes, as the OGR
+    work is CPU-bound. A single chunk is just tested directly. 
     
     """
-    metalistFiltered = []
-    for (urlStr, metaObj) in metalist:
-        sat = None
-        if cmdargs.satelliteletter is not None:
-            sat = "S{}{}".format(cmdargs.sentinel, cmdargs.satelliteletter)
-        if sat is None or metaObj.satellite == sat:
-            metalistFiltered.append((urlStr, metaObj))
-    return metalistFiltered
+    chunkList = [footprintWktList[i:i+REGION_CHUNKSIZE] 
+        for i in range(0, len(footprintWktList), REGION_CHUNKSIZE)]
+    if len(chunkList) <= 1:
+        chunkResults = [footprintChunkIntersects(chunk, searchWkt, searchIsBox)
+            for chunk in chunkList]
+    else:
+        numChunks = len(chunkList)
+        with futures.ProcessPoolExecutor() as executor:
+            chunkResults = list(executor.map(footprintChunkIntersects, chunkList, 
+                [searchWkt] * numChunks, [searchIsBox] * numChunks))
+    return list(itertools.chain.from_iterable(chunkResults))
 
 
-def filterByPolarisation(metalist, cmdargs):
+def footprintChunkIntersects(footprintWktList, searchWkt, searchIsBox):
     """
-    Filter the meta objects by polarisation. If no polarisation values present, then
-    all are acceptable (e.g. for Sentinel-2)
+    Test a chunk of footprints for footprintsIntersect(). This runs in a worker 
+    process, so the search polygon is passed as WKT, as OGR geometries cannot be 
+    pickled, and is parsed once for the whole chunk. 
     
     """
-    if cmdargs.polarisation is not None:
-        metalistFiltered = []
-        reqdPolarisations = cmdargs.polarisation.split('+')
-        for (urlStr, metaObj) in metalist:
-            polarisationList = None
-            if hasattr(metaObj, 'polarisationValuesList'):
-                polarisationList = metaObj.polarisationValuesList
-            exclude = False
-            if polarisationList is not None:
-                for reqdPol in reqdPolarisations:
-                    if reqdPol not in polarisationList:
-                        exclude = True
-            if not exclude:
-                metalistFiltered.append((urlStr, metaObj))
+    searchPolygon = ogr.Geometry(wkt=searchWkt)
+    searchEnvelope = searchPolygon.GetEnvelope()
+    return [footprintIntersects(footprintWkt, searchPolygon, searchEnvelope, searchIsBox)
+        for footprintWkt in footprintWktList]
+
+
+def centroidInside(metaObj, searchPolygon):
+    """
+    Return True if the metadata object has a centroid, and it is inside the search 
+    polygon. Such a footprint must intersect the search polygon, so this cheap test 
+    can accept it without parsing the footprint WKT. 
+    
+    """
+    inside = False
+    if metaObj.ctrLong is not None and metaObj.ctrLat is not None:
+        ctrPoint = ogr.Geometry(ogr.wkbPoint)
+        ctrPoint.AddPoint_2D(metaObj.ctrLong, metaObj.ctrLat)
+        inside = searchPolygon.Contains(ctrPoint)
+    return inside
+
+
+def footprintIntersects(footprintWkt, searchPolygon, searchEnvelope, searchIsBox,
+        preparedSearchShape=None):
+    """
+    Return True if the given footprint WKT intersects the search polygon, using OGR. 
+    A footprint which crosses the international date line is split there first. 
+    If searchIsBox is True, the search polygon is just its own envelope, so 
+    a footprint whose envelope is inside that is accepted without further tests. 
+    
+    If preparedSearchShape is given, it is a prepared shapely geometry of the
+    search polygon, and the final intersection test is done with that instead, 
+    passing the footprint across as WKB. 
+    
+    """
+    footprintGeom = ogr.Geometry(wkt=str(footprintWkt))
+    footprintEnvelope = footprintGeom.GetEnvelope()
+    # Cheap test against the search envelope first, so that footprints which are
+    # nowhere near the search region skip the more expensive work below. 
+    if not envelopesMayIntersect(footprintEnvelope, searchEnvelope):
+        return False
+    if searchIsBox and envelopeWithin(footprintEnvelope, searchEnvelope):
+        return True
+    prefEpsg = geomutils.findSensibleProjection(footprintGeom)
+    if geomutils.crossesDateline(footprintGeom, prefEpsg):
+        footprintGeom = geomutils.splitAtDateline(footprintGeom, prefEpsg)
+    if preparedSearchShape is not None:
+        footprintShape = shapely.from_wkb(bytes(footprintGeom.ExportToWkb()))
+        intersects = bool(shapely.intersects(preparedSearchShape, footprintShape))
     else:
-        metalistFiltered = metalist
-    return metalistFiltered
+        intersects = footprintGeom.Intersects(searchPolygon)
+    return intersects
 
 
-def filterBySwathMode(metalist, cmdargs):
+def envelopesMayIntersect(footprintEnvelope, searchEnvelope):
     """
-    Filter meta objects by swath mode. If no mode attribute present, e.g. for Sentinel-2,
-    then all meta objects are acceptable. 
+    Given two OGR envelope tuples (xMin, xMax, yMin, yMax) in lat/long, return False
+    if they definitely do not intersect. Footprints which cross the international 
+    date line have envelopes which span most of the longitude range, and are only
+    tested on latitude, as they are later split at the date line. 
     
     """
-    if cmdargs.swathmode is not None:
-        metalistFiltered = []
-        for (urlStr, metaObj) in metalist:
-            exclude = False
-            if hasattr(metaObj, 'mode') and metaObj.mode != cmdargs.swathmode:
-                exclude = True
-            if not exclude:
-                metalistFiltered.append((urlStr, metaObj))
+    (fpXmin, fpXmax, fpYmin, fpYmax) = footprintEnvelope
+    (sXmin, sXmax, sYmin, sYmax) = searchEnvelope
+    mayIntersect = (fpYmin <= sYmax and fpYmax >= sYmin)
+    if mayIntersect and (fpXmax - fpXmin) < 180:
+        mayIntersect = (fpXmin <= sXmax and fpXmax >= sXmin)
+    return mayIntersect
+
+
+def envelopeWithin(footprintEnvelope, searchEnvelope):
+    """
+    Given two OGR envelope tuples (xMin, xMax, yMin, yMax) in lat/long, return True
+    if the footprint envelope lies entirely within the search envelope. 
+    
+    """
+    (fpXmin, fpXmax, fpYmin, fpYmax) = footprintEnvelope
+    (sXmin, sXmax, sYmin, sYmax) = searchEnvelope
+    return (fpXmin >= sXmin and fpXmax <= sXmax and fpYmin >= sYmin and fpYmax <= sYmax)
+
+
+def combinePredicates(predicates):
+    """
+    Combine the given list of predicate functions into a single function, which 
+    returns True only if all of them do, stopping at the first which does not. 
+    This avoids making a new generator for all(...) on every object tested. 
+    
+    """
+    if len(predicates) == 0:
+        combined = lambda metaObj: True
+    elif len(predicates) == 1:
+        combined = predicates[0]
     else:
-        metalistFiltered = metalist
-    return metalistFiltered
+        def combined(metaObj):
+            for pred in predicates:
+                if not pred(metaObj):
+                    return False
+            return True
+    return combined
 
 
-def filterByDirection(metalist, cmdargs):
+def makeFilterPredicates(cmdargs):
     """
-    Filter by pass direction. Comparison is case-insensitive. 
+    Make a list of predicate functions for the attribute-based filters selected by 
+    cmdargs. Each takes a metadata object, and returns True if it should be kept.
+    Filters which are not selected are not included. The cheapest tests
+    come first, so that the combined test can stop early on the most common rejections. 
+    
     """
+    predicates = []
+    
+    if cmdargs.satelliteletter is not None:
+        sat = "S{}{}".format(cmdargs.sentinel, cmdargs.satelliteletter)
+        predicates.append(lambda metaObj: metaObj.satellite == sat)
+    
     if cmdargs.direction is not None:
-        metalistFiltered = []
-        for (urlStr, metaObj) in metalist:
-            exclude = False
-            if (hasattr(metaObj, 'passDirection') and 
-                    metaObj.passDirection.lower() != cmdargs.direction.lower()):
-                exclude = True
-            if not exclude:
-                metalistFiltered.append((urlStr, metaObj))
-    else:
-        metalistFiltered = metalist
-    return metalistFiltered
+        direction = cmdargs.direction.lower()
+        # Comparison is case-insensitive. Objects with no passDirection are acceptable
+        predicates.append(lambda metaObj: 
+            metaObj.passDirection is None or 
+            metaObj.passDirection.lower() == direction)
+
+    if cmdargs.swathmode is not None:
+        swathmode = cmdargs.swathmode
+        # If no mode attribute present, e.g. for Sentinel-2, then all are acceptable
+        predicates.append(lambda metaObj: metaObj.mode is None or metaObj.mode == swathmode)
+
+    if not cmdargs.allowbadmd5:
+        predicates.append(md5Matches)
+
+    # If no cloud amount present, then all are acceptable (e.g. for Sentinel-1)
+    maxcloud = cmdargs.maxcloud
+    predicates.append(lambda metaObj: 
+        metaObj.cloudCoverPcnt is None or 
+        metaObj.cloudCoverPcnt <= maxcloud)
+
+    if cmdargs.polarisation is not None:
+        reqdPolarisations = set(cmdargs.polarisation.split('+'))
+        # If no polarisation values present, then all are acceptable (e.g. for Sentinel-2)
+        predicates.append(lambda metaObj: 
+            metaObj.polarisationValuesList is None or 
+            reqdPolarisations.issubset(metaObj.polarisationValuesList))
+    
+    return predicates
 
 
 def getVectorMultipolygon(polygonfile):
@@ -323,51 +539,77 @@ def getVectorMultipolygon(polygonfile):
     ds = ogr.Open(polygonfile)
     lyr = ds.GetLayer()
     feat = lyr.GetNextFeature()
-    wholeGeom = None
+    geomList = []
     while feat is not None:
-        geom = feat.GetGeometryRef()
-        if wholeGeom is None:
-            wholeGeom = geom.Clone()
-        else:
-            wholeGeom = wholeGeom.Union(geom)
+        # Copy the geometry, as the feature owns the original
+        geomList.append(feat.GetGeometryRef().Clone())
         feat = lyr.GetNextFeature()
+    wholeGeom = geomutils.unionOfGeometries(geomList)
+    if wholeGeom is None:
+        raise AusCopHubSearchError("No polygons found in '{}'".format(polygonfile))
+    if wholeGeom.GetSpatialReference() is None:
+        wholeGeom.AssignSpatialReference(lyr.GetSpatialRef())
     
     srLL = osr.SpatialReference()
     srLL.ImportFromEPSG(4326)
     geomutils.preventGdal3axisSwap(srLL)
-    wholeGeom.TransformTo(srLL)
+    err = wholeGeom.TransformTo(srLL)
+    if err != 0:
+        raise AusCopHubSearchError("Unable to transform polygons in '{}' to lat/long (OGR error {})".format(
+            polygonfile, err))
     
     return wholeGeom
 
 
-def writeOutput(cmdargs, zipfileUrlList, metalist):
+def zipfileUrls(metalist):
+    """
+    Generate the zipfile URL for each entry in the given metalist
+    """
+    for (urlStr, metaObj) in metalist:
+        yield urlStr.replace(".xml", ".zip")
+
+
+def writeOutput(cmdargs, metalist):
     """
     Write the selected output file(s)
     """
     if cmdargs.urllist is not None:
-        f = open(cmdargs.urllist, 'w')
-        for zipfileUrl in zipfileUrlList:
-            f.write(zipfileUrl+'\n')
-        f.close()
+        lines = [zipfileUrl+'\n' for zipfileUrl in zipfileUrls(metalist)]
+        with open(cmdargs.urllist, 'w') as f:
+            f.write(''.join(lines))
 
     if cmdargs.curlscript is not None:
-        f = open(cmdargs.curlscript, 'w')
-        f.write("#!/bin/bash\n")
-        for zipfileUrl in zipfileUrlList:
-            zipfileName = os.path.basename(zipfileUrl)
-            proxyOpt = ""
-            if cmdargs.proxy is not None:
-                proxyOpt = " -x {}".format(cmdargs.proxy)
-            curlCmd = "curl {} -o {} {} {}".format(zipfileUrl, zipfileName, cmdargs.curloptions,
-                proxyOpt)
-            f.write(curlCmd+'\n')
-        f.close()
+        proxyOpt = ""
+        if cmdargs.proxy is not None:
+            proxyOpt = " -x {}".format(cmdargs.proxy)
+        # The options at the end of each line are the same every time
+        curlSuffix = " {}{}\n".format(cmdargs.curloptions, proxyOpt)
+        lines = ["curl "+zipfileUrl+" -o "+os.path.basename(zipfileUrl)+curlSuffix
+            for zipfileUrl in zipfileUrls(metalist)]
+        with open(cmdargs.curlscript, 'w') as f:
+            f.write("#!/bin/bash\n" + ''.join(lines))
 
     if cmdargs.saveserverxml:
-        # Save each of the server XML fragments to its original filename, in the local directory
-        for (urlStr, metaObj) in metalist:
-            xmlFilename = os.path.basename(urlStr)
-            open(xmlFilename, 'w').write(metaObj.xmlStr)
+        # Save each of the server XML fragments to its original filename, in the local directory. 
+        # These are many small files, so overlap the writes in a pool of threads
+        with futures.ThreadPoolExecutor(max_workers=cmdargs.maxconcurrency) as executor:
+            saveJobs = [executor.submit(saveXmlFile, os.path.basename(urlStr), metaObj.xmlStr)
+                for (urlStr, metaObj) in metalist]
+            for job in saveJobs:
+                # Re-raise any exception from the write
+                job.result()
+
+
+def saveXmlFile(xmlFilename, xmlStr):
+    """
+    Write the given XML string to the given file. The string is as read from the 
+    server, which may be bytes, so it is written in binary mode. 
+    
+    """
+    if not isinstance(xmlStr, bytes):
+        xmlStr = xmlStr.encode('utf-8')
+    with open(xmlFilename, 'wb') as f:
+        f.write(xmlStr)
 
 
 class AusCopHubSearchError(Exception): pass
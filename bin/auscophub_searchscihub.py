@@ -6,18 +6,21 @@ results as a json file.
 This script is a copy of the one DSITI have been using in other contexts, and so 
 contains a number of extra features not required here. 
 
-We are using curl to do the network transfers. The userame/password for the ESA server
-is handled by configuring them into the user's local ~/.netrc file, which curl will use. 
+We are using the requests package to do the network transfers, with a single session
+so that the connection to the server is re-used for every query. The userame/password 
+for the ESA server is handled by configuring them into the user's local ~/.netrc file, 
+which requests will use. 
 
 """
 from __future__ import print_function, division
 
 import sys
 import argparse
-import subprocess
 import json
 import datetime
 import math
+from collections import OrderedDict
+from concurrent import futures
 from xml.dom import minidom
 
 # Import url quote function, with Python 2/3 compatibility
@@ -26,6 +29,8 @@ try:
 except ImportError:
     from urllib.parse import quote as urlquote
     
+import requests
+from requests.adapters import HTTPAdapter
 from osgeo import ogr, osr
 
 from auscophub import geomutils
@@ -42,6 +47,13 @@ regionDict = {
 
 # The main public scihub server search URL
 serverBaseUrl = "https://scihub.copernicus.eu"
+# Timeouts (in seconds) for connecting to, and reading from, the server
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+# Maximum number of pages to query at once. ESA's server throttles beyond about this
+MAX_PAGE_THREADS = 6
+# Maximum number of MD5 lookups to do at once
+MAX_MD5_THREADS = 8
 
 
 def getCmdargs():
@@ -75,7 +87,7 @@ def getCmdargs():
     p.add_argument("--proxyserver", help="Name of proxy server")
     p.add_argument("--nocheckcertificate", default=False, action="store_true",
         help=("Turn off checking of ESA website SSL certificate, in case your "+
-            "version of curl doesn't know how to do it (default will check)"))
+            "system's certificate store doesn't know how to do it (default will check)"))
     p.add_argument("--includemd5", default=False, action="store_true",
         help="For every file found, query ESA for its MD5 hash, and include this in the output. "+
             "Not recommended, as their server is very slow. ")
@@ -110,40 +122,54 @@ def mainRoutine():
     cmdargs = getCmdargs()
     rowsPerQuery = 100      # Mandated by ESA - any more will be an error
     roiWkt = makeRoiWkt(cmdargs)
+    session = makeSession(cmdargs)
     
-    resultsDict = getServerContents(cmdargs, 0, rowsPerQuery, roiWkt)
+    excludeSet = set()
+    if cmdargs.excludelist is not None:
+        with open(cmdargs.excludelist) as f:
+            excludeSet = set(line.strip() for line in f)
+    
+    searchQuery = makeSearchQuery(cmdargs, rowsPerQuery, roiWkt)
+    resultsDict = getServerContents(session, searchQuery, 0, rowsPerQuery)
     
     numResults = int(resultsDict['opensearch:totalResults'])
     numPages = int(math.ceil(numResults / rowsPerQuery))
     print('Querying', numResults, 'zip files, in', numPages, 'separate pages')
     
     if numResults > 0:
-        outputList = extractResults(resultsDict)
-
-        for p in range(1, numPages):
-            resultsDict = getServerContents(cmdargs, p, rowsPerQuery, roiWkt)
-            outputList.extend(extractResults(resultsDict))
+        # Remove any possible duplicates as the pages are gathered. These could, in theory, 
+        # arise due to the bizarre way in which ESA make us do separate queries for multiple 
+        # pages, while the underlying set of entries could change at the same time. I have 
+        # not seen it happen, but the underlying flaw bothers me. 
+        # The first entry for each ESA ID is kept, in the order they were found. 
+        entriesById = OrderedDict()
+        def addPageResults(pageResults):
+            for entry in pageResults:
+                entriesById.setdefault(entry['esaId'], entry)
+        
+        addPageResults(extractResults(resultsDict, excludeSet))
 
-        if cmdargs.excludelist is not None:
-            excludeSet = set([line.strip() for line in open(cmdargs.excludelist)])
-            outputList = [entry for entry in outputList if entry['esaId'] not in excludeSet]
+        # Query the remaining pages concurrently, keeping the results in page order
+        def getPageResults(pageNum):
+            return extractResults(getServerContents(session, searchQuery, pageNum, rowsPerQuery),
+                excludeSet)
+        with futures.ThreadPoolExecutor(max_workers=MAX_PAGE_THREADS) as executor:
+            for pageResults in executor.map(getPageResults, range(1, numPages)):
+                addPageResults(pageResults)
+        outputList = list(entriesById.values())
 
         if cmdargs.includemd5:
-            for entry in outputList:
-                addMd5(entry, cmdargs)
+            # Each lookup fills in its own entry, so there are no results to gather
+            with futures.ThreadPoolExecutor(max_workers=MAX_MD5_THREADS) as executor:
+                list(executor.map(lambda entry: addMd5(session, entry, cmdargs), outputList))
     else:
         outputList = []
     
-    # Remove any possible duplicates. These could, in theory, arise due to the bizarre way
-    # in which ESA make us do separate queries for multiple pages, while the underlying
-    # set of entries could change at the same time. I have not seen it happen, but the
-    # underlying flaw bothers me. 
-    outputList = removeDuplicateEntries(outputList)
     print("Found", len(outputList), "entries")
 
-    outputJsonStr = json.dumps(outputList)
-
-    print(outputJsonStr, file=open(cmdargs.outfile, 'w'))
+    with open(cmdargs.outfile, 'w') as f:
+        json.dump(outputList, f)
+        f.write('\n')
 
 
 def makeRoiWkt(cmdargs):
@@ -166,14 +192,16 @@ def makeRoiWkt(cmdargs):
         srLL.ImportFromEPSG(4326)
         geomutils.preventGdal3axisSwap(srLL)
         srLyr = lyr.GetSpatialRef()
-        tr = osr.CoordinateTransformation(srLyr, srLL)
-        geom.Transform(tr)
+        # Only construct a transformation if the layer is not already in lat/long
+        if srLyr is not None and not srLyr.IsSame(srLL):
+            tr = osr.CoordinateTransformation(srLyr, srLL)
+            geom.Transform(tr)
         
         # Now manually construct the WKT, but with only 4 decimal places in each value. Apparently
         # ESA's software doesn't cope with more. 
-        geomJsonDict = eval(geom.ExportToJson())
-        coords = geomJsonDict['coordinates']
-        coordsPairStrList = ["{:.4f} {:.4f}".format(p[0], p[1]) for p in coords[0]]
+        # Take the coordinates of the outer ring directly from the geometry
+        outerRing = geom.GetGeometryRef(0)
+        coordsPairStrList = ["{:.4f} {:.4f}".format(p[0], p[1]) for p in outerRing.GetPoints()]
         coordsStr = ','.join(coordsPairStrList)
         roiWkt = "POLYGON(({}))".format(coordsStr)
     else:
@@ -182,10 +210,29 @@ def makeRoiWkt(cmdargs):
     return roiWkt
 
 
-def getServerContents(cmdargs, pageNum, rowsPerQuery, roiWkt):
+def makeSession(cmdargs):
     """
-    Query the server, against the bounding box, and return a list of the server contents.
-    The list is formed by simply loading the reported JSON string. 
+    Make a requests.Session for all queries to the ESA server, so that the
+    connection (and its SSL handshake) is re-used. The username/password come 
+    from ~/.netrc, which requests reads by default. 
+    
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.verify = not cmdargs.nocheckcertificate
+    if cmdargs.proxyserver is not None:
+        session.proxies = {'http': cmdargs.proxyserver, 'https': cmdargs.proxyserver}
+    return session
+
+
+def makeSearchQuery(cmdargs, rowsPerQuery, roiWkt):
+    """
+    Make the parts of the search URL which are the same for every page, i.e. the 
+    server URL, and the query string following the start parameter. These are
+    quoted once here, rather than for every page. Returns a tuple
+        (serverUrl, queryStr)
+    
     """
     footprintStr = '"Intersects({})"'.format(roiWkt)
     timeRangeStr = "[{}T00:00:00.000Z TO {}T23:59:59.999Z]".format(cmdargs.startdate, cmdargs.enddate)
@@ -195,46 +242,53 @@ def getServerContents(cmdargs, pageNum, rowsPerQuery, roiWkt):
     cloudSearch = 'cloudcoverpercentage:[0 TO {}]'.format(cmdargs.maxcloud)
     
     serverUrl = "{}/{}".format(serverBaseUrl, cmdargs.server)
-    start = rowsPerQuery * pageNum
 
-    queryUrl = ("start={}&rows={}&q=platformname:Sentinel-{}+AND+footprint:{}+AND+"+
-        "beginposition:{}+AND+ingestiondate:{}+AND+{}").format(
-            start, rowsPerQuery, cmdargs.sentinel, urlquote(footprintStr), urlquote(timeRangeStr), 
+    queryStr = ("rows={}&q=platformname:Sentinel-{}+AND+footprint:{}+AND+"+
+        "beginposition:{}+AND+ingestiondate:{}+AND+{}&format=json").format(
+            rowsPerQuery, cmdargs.sentinel, urlquote(footprintStr), urlquote(timeRangeStr), 
             urlquote(ingestTimeRangeStr), urlquote(cloudSearch))
-    fullUrl = "%s/search?%s&format=json" % (serverUrl, queryUrl)
+    return (serverUrl, queryStr)
 
-    cmdList = ["curl", "--silent", "--show-error", "--globoff", "-n", fullUrl]
-    if cmdargs.nocheckcertificate:
-        cmdList.append("--insecure")
-    if cmdargs.proxyserver is not None:
-        cmdList.extend(["-x", cmdargs.proxyserver])
-    proc = subprocess.Popen(cmdList, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdoutStr, stderrStr) = proc.communicate()
 
-    if proc.returncode != 0 or len(stderrStr) > 0:
-        print(stderrStr)
+def getServerContents(session, searchQuery, pageNum, rowsPerQuery):
+    """
+    Query the server, against the bounding box, and return a list of the server contents.
+    The list is formed by simply loading the reported JSON string. The searchQuery
+    is as returned by makeSearchQuery(). 
+    """
+    (serverUrl, queryStr) = searchQuery
+    start = rowsPerQuery * pageNum
+    fullUrl = "{}/search?start={}&{}".format(serverUrl, start, queryStr)
+
+    try:
+        response = session.get(fullUrl, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.RequestException as e:
+        print(e, file=sys.stderr)
         sys.exit()
 
-    jsonStr = stdoutStr
+    # Parse straight from the response bytes. Using response.text would first make a 
+    # decoded copy of the whole page, after guessing its encoding if the server 
+    # does not give one. That is only needed to report an error. 
     try:
-        resultsDict = json.loads(jsonStr)['feed']
-    except ValueError:
+        resultsDict = json.loads(response.content)['feed']
+    except (ValueError, KeyError):
         resultsDict = None
     
     if resultsDict is None:
         print("Unable to query server, with query URL:", file=sys.stderr)
         print(fullUrl, file=sys.stderr)
         print("Response was:", file=sys.stderr)
-        print(jsonStr, file=sys.stderr)
+        print(response.text, file=sys.stderr)
         sys.exit()
     
     return resultsDict
 
 
-def extractResults(resultsDict):
+def extractResults(resultsDict, excludeSet):
     """
     Return a list of dictionaries, one for each entry in the resultsDict. Each
-    dictionary contains a few selected fields. 
+    dictionary contains a few selected fields. Entries whose ESA ID is in
+    excludeSet are skipped. 
     
     """
     outList = []
@@ -248,60 +302,51 @@ def extractResults(resultsDict):
         
     for entry in entryList:
         d = {}
-        if type(entry) is dict:
+        if type(entry) is dict and entry['title'] not in excludeSet:
             d['imagelink'] = entry['link'][0]['href']
             d['esaId'] = entry['title']
             d['uuid'] = entry['id']
-            doubles = entry['double']
-            if isinstance(doubles, list):
-                cloudItemList = [i for i in doubles if i['name'] == 'cloudcoverpercentage']
-                if len(cloudItemList) > 0:
-                    d['cloudcoverpercentage'] = cloudItemList[0]['content']
-            elif isinstance(doubles, dict):
-                d['cloudcoverpercentage'] = doubles['content']
+            cloudPcnt = namedContent(entry['double'], 'cloudcoverpercentage')
+            if cloudPcnt is not None:
+                d['cloudcoverpercentage'] = cloudPcnt
+            footprintWkt = namedContent(entry['str'], 'footprint')
+            if footprintWkt is not None:
+                d['footprintWkt'] = footprintWkt
             outList.append(d)
-            strings = entry['str']
-            if isinstance(strings, list):
-                outlineWktList = [s for s in strings if s['name'] == "footprint"]
-                if len(outlineWktList) > 0:
-                    d['footprintWkt'] = outlineWktList[0]['content']
-            elif isinstance(strings, dict):
-                d['footprintWkt'] = strings['content']
     return outList
 
 
-def removeDuplicateEntries(outputList):
+def namedContent(items, name):
     """
-    Take a list of entries (dictionaries), and create a new list where duplicate
-    entries have been omitted. The basis for detecting duplication is the esaId key. 
-    
+    Return the content of the first of the given items with the given name, or None
+    if there is no such item. As with entries, ESA give a single item as just a 
+    dictionary, rather than a list of one. 
     """
-    newOutputList = []
-    esaIdSet = set()
-    for entry in outputList:
-        esaId = entry['esaId']
-        if esaId not in esaIdSet:
-            esaIdSet.add(esaId)
-            newOutputList.append(entry)
-    return newOutputList
+    if isinstance(items, dict):
+        if items.get('name') == name:
+            return items['content']
+    else:
+        for item in items:
+            if item['name'] == name:
+                return item['content']
+    return None
 
 
-def addMd5(entry, cmdargs):
+def addMd5(session, entry, cmdargs):
     """
     Query ESA again to find the MD5 value for this entry
     """
     serverUrl = "{}/{}".format(serverBaseUrl, cmdargs.server)
     uuid = entry['uuid']
     md5queryUrl = "{}/odata/v1/Products('{}')/Checksum/Value/$value".format(serverUrl, uuid)
-    cmdList = ["curl", "-n", md5queryUrl]
-    if cmdargs.proxyserver is not None:
-        cmdList.extend(['-x', cmdargs.proxyserver])
     
-    proc = subprocess.Popen(cmdList, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdoutStr, stderrStr) = proc.communicate()
+    try:
+        response = session.get(md5queryUrl, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.RequestException:
+        response = None
 
-    if proc.returncode == 0:
-        md5 = stdoutStr.strip()
+    if response is not None and response.ok:
+        md5 = response.text.strip()
         # Sometimes the server responds with an error message, so only store 
         # things which actually look like MD5 hash values. 
         if len(md5) == 32:
@@ -15,7 +15,21 @@ from __future__ import print_function, division
 import sys
 import os
 import argparse
+import re
+import glob
+import errno
 import zipfile
+import hashlib
+import pickle
+import itertools
+from concurrent import futures
+# If python-isal is available, have zipfile use its faster drop-in zlib replacement 
+# for decompressing the metadata out of each zipfile. 
+try:
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib
+except ImportError:
+    isal_zlib = None
 isPython3 = (sys.version_info.major == 3)
 if isPython3:
     from urllib.parse import urljoin
@@ -27,9 +41,29 @@ from auscophub import sen2meta
 from auscophub import sen3meta
 from auscophub import sen5meta
 from auscophub import dirstruct
+from auscophub import geomutils
 from auscophub.sen3thumb import sen3thumb 
 from auscophub.saraadmin import postToSara
 
+# The Sentinel number for each prefix of a zipfile name which we know how to handle
+SENTINEL_NUMBERS = {'S1': 1, 'S2': 2, 'S3': 3, 'S5': 5}
+
+# Number of zipfiles given to a worker process at a time, when using --jobs
+JOB_BATCHSIZE = 4
+
+# Finds the start date/time in a Sentinel file name, e.g. _20200102T030405, and 
+# captures the year and month
+SENSINGDATE_REGEX = re.compile(r"_(\d{4})(\d{2})\d{2}T\d{6}")
+
+# The function to create the XML file, for each Sentinel number
+CREATE_XML_FUNCS = {1: dirstruct.createSentinel1Xml, 2: dirstruct.createSentinel2Xml,
+    3: dirstruct.createSentinel3Xml, 5: dirstruct.createSentinel5Xml}
+
+# The metadata class for each Sentinel number whose files are zipfiles. Sentinel-5 is
+# a netCDF file, and is handled separately. 
+ZIPFILE_META_CLASSES = {1: sen1meta.Sen1ZipfileMeta, 2: sen2meta.Sen2ZipfileMeta, 
+    3: sen3meta.Sen3ZipfileMeta}
+
 def getCmdargs():
     """
     Get commandline arguments
@@ -62,13 +96,19 @@ def getCmdargs():
         help="Instead of moving the zipfile, copy it instead (default will use move)")
     p.add_argument("--symlink", default=False, action="store_true",
         help="Instead of moving the zipfile, symbolic link it instead (default will use move)")
+    p.add_argument("--hardlink", default=False, action="store_true",
+        help=("Instead of moving the zipfile, hard link it, which leaves the original in "+
+            "place without copying any data. If the storage directory is on a different "+
+            "filesystem, it is copied instead (default will use move). Note that "+
+            "--makereadonly then also applies to the original, as they are the same file. "))
     p.add_argument("--moveandsymlink", default=False, action="store_true",
         help=("Move the file, as per the default, and then create a symlink from the old "+
             "location pointing to the new location (default will use move)"))
     p.add_argument("--makereadonly", default=False, action="store_true",
         help="Make the files (zip, xml and preview) read-only after creation, copying or moving (default='%(default)s').")
     p.add_argument("--errorlog", 
-        help="Any zipfiles with errors will be logged in this file")
+        help=("Any zipfiles with errors will be logged in this file, as they are found. "+
+            "The file is appended to, not overwritten"))
     p.add_argument("--md5esa", help=("Value of MD5 hash for a single zipfile, as given by ESA. "+
         "This option only makes sense when processing a single zipfile, not for a list of "+
         "zipfiles. The value will be included in the resulting XML file. "))
@@ -78,13 +118,23 @@ def getCmdargs():
             "The default is to assume that the top dir does not include these, and they will "+
             "be generated too"))
     p.add_argument("--exitonziperror", default=False, action="store_true",
-        help="Test each zipfile, and exit on finding one which reports internal errors (default will not test)")
+        help=("Test each zipfile, and exit on finding one which reports internal errors (default will not test). "+
+            "With --xmlonly or --xmlandpreview, only the zipfile directory is checked, not the "+
+            "contents of every member"))
     p.add_argument("--mountpath", default=".",
         help="Basepath for archivemount a Sentinel-3 zipfile when generating its quicklook thumbnail.")
     p.add_argument("--saraurl", default="https://copernicus.nci.org.au/sara.server/1.0/collections/",
         help="Url to post the resource to the SARA API (default='%(default)s').")
     p.add_argument("--sarauser", default="",
         help="Username:password to post the resource to the SARA API. Required to enable posting.")
+    p.add_argument("--metacachedir",
+        help=("Directory in which to keep the metadata read from each zipfile, so that "+
+            "a repeat run on the same files (e.g. after a --dummy run, or a failure) does "+
+            "not need to read it all again. Entries are keyed on the zipfile's path, size "+
+            "and modification time. Default does not cache. "))
+    p.add_argument("--jobs", type=int, default=1,
+        help=("Number of zipfiles to process at once, in separate processes "+
+            "(default=%(default)s)"))
     p.add_argument("--updatesara", default=False, action="store_true",
         help="If the product is already in SARA, delete and re-post.")
 
@@ -102,110 +152,341 @@ def mainRoutine():
     Main routine
     """
     cmdargs = getCmdargs()
-    zipfilelist = []
+    zipfiles = iterZipfiles(cmdargs)
+    
+    if cmdargs.md5esa is not None:
+        zipfiles = list(zipfiles)
+        numZipfiles = len(zipfiles)
+        if numZipfiles != 1:
+            print("Can only use --md5esa with single zipfiles, but {} zipfiles were supplied".format(
+                numZipfiles), file=sys.stderr)
+            sys.exit(1)
+    
+    # Errors are written as they happen, so they are not lost if the run dies part way
+    if cmdargs.errorlog is not None:
+        errorFile = open(cmdargs.errorlog, 'a', buffering=1)
+    else:
+        errorFile = sys.stderr
+
+    processor = ZipfileProcessor(cmdargs)
+    try:
+        if cmdargs.jobs > 1:
+            # Each zipfile is independent of the others, so spread them across processes. 
+            # Hand them out a few at a time, to save on round trips to the workers, and 
+            # keep only a couple of batches per worker in flight, so the list is read as 
+            # we go. Results are reported as soon as they come back, in whatever order. 
+            # They all come back here, so only this process writes to errorFile. 
+            maxPending = 2 * cmdargs.jobs
+            with futures.ProcessPoolExecutor(max_workers=cmdargs.jobs) as executor:
+                pending = set()
+                for zipfileBatch in iterBatches(zipfiles, JOB_BATCHSIZE):
+                    if len(pending) >= maxPending:
+                        (done, pending) = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                        handleBatchResults(errorFile, processor, done)
+                    pending.add(executor.submit(processor.processBatch, zipfileBatch))
+                handleBatchResults(errorFile, processor, futures.as_completed(pending))
+        else:
+            # One at a time, so just read the list as we go
+            for zipfilename in zipfiles:
+                handleResult(errorFile, processor, processor(zipfilename))
+    finally:
+        if cmdargs.errorlog is not None:
+            errorFile.close()
+
+
+def iterBatches(iterable, batchSize):
+    """
+    Generator of lists of up to batchSize items from the given iterable
+    """
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, batchSize))
+    while len(batch) > 0:
+        yield batch
+        batch = list(itertools.islice(iterator, batchSize))
+
+
+def handleBatchResults(errorFile, processor, batchFutures):
+    """
+    Deal with the results from the given finished futures, each of which
+    is a call to ZipfileProcessor.processBatch()
+    """
+    for fut in batchFutures:
+        for result in fut.result():
+            handleResult(errorFile, processor, result)
+
+
+def handleResult(errorFile, processor, result):
+    """
+    Deal with the result of processing one zipfile with the given ZipfileProcessor. 
+    Any error message is written to the open errorFile, and any post to SARA is 
+    done here, so that only the main process ever talks to the SARA server. 
+    """
+    (msg, saraPost) = result
+    if msg is not None:
+        errorFile.write(msg+'\n')
+    if saraPost is not None:
+        processor.postToSara(saraPost)
+
+
+def iterZipfiles(cmdargs):
+    """
+    Generator of the zipfile names to process, first those given on the 
+    commandline, then those in the --zipfilelist file. The list file is read in 
+    one go and split into lines, and blank lines are skipped. 
+    """
     if cmdargs.zipfile is not None:
-        zipfilelist.extend(cmdargs.zipfile)
+        for zipfilename in cmdargs.zipfile:
+            yield zipfilename
     if cmdargs.zipfilelist is not None:
-        zipfilelist.extend([line.strip() for line in open(cmdargs.zipfilelist)])
+        with open(cmdargs.zipfilelist) as f:
+            lineList = f.read().splitlines()
+        for line in lineList:
+            zipfilename = line.strip()
+            if len(zipfilename) > 0:
+                yield zipfilename
+
+
+class ZipfileProcessor(object):
+    """
+    Does all the work for a single zipfile. The settings which are the same for
+    every zipfile are worked out once, when this is constructed. An instance is
+    callable with a zipfile name, so it can be handed to a process pool. 
     
-    numZipfiles = len(zipfilelist)
-    if cmdargs.md5esa is not None and numZipfiles!= 1:
-        print("Can only use --md5esa with single zipfiles, but {} zipfiles were supplied".format(
-            numZipfiles), file=sys.stderr)
-        sys.exit(1)
+    """
+    def __init__(self, cmdargs):
+        self.cmdargs = cmdargs
+        self.moveZipfiles = not cmdargs.xmlonly and not cmdargs.xmlandpreview
+        self.makePreviews = not cmdargs.xmlonly and not cmdargs.nopreview
+        # Post to SARA only if user credentials are provided
+        self.saraCredentials = None
+        if ':' in cmdargs.sarauser:
+            (username, password) = cmdargs.sarauser.split(':', 1)
+            if username and password:
+                self.saraCredentials = (username, password)
+        # If all we would do is write an XML file which is not to be overwritten, then a 
+        # file which already has one can be skipped without even reading its metadata
+        self.skipExistingXml = (cmdargs.xmlonly and cmdargs.nooverwrite and 
+            self.saraCredentials is None)
     
-    filesWithErrors = []
+    def processBatch(self, zipfileBatch):
+        """
+        Process a list of zipfiles, returning the list of results, one for each
+        """
+        return [self(zipfilename) for zipfilename in zipfileBatch]
     
-    # Process each zipfile in the list
-    for zipfilename in zipfilelist:
-        (ok, msg) = checkZipfileName(zipfilename)
+    def __call__(self, zipfilename):
+        """
+        Process the given zipfile. Returns a tuple (msg, saraPost). The msg is None 
+        if all went well, otherwise a string explaining what was wrong with it. The 
+        saraPost is None, unless the XML file should now be posted to SARA, with 
+        the postToSara() method. 
+        """
+        cmdargs = self.cmdargs
+        dummy = cmdargs.dummy
+        verbose = cmdargs.verbose
+        nooverwrite = cmdargs.nooverwrite
+        makereadonly = cmdargs.makereadonly
+        saraPost = None
         
-        if cmdargs.exitonziperror:
-            try:
-                zf = zipfile.ZipFile(zipfilename)
-                zipcheck = zf.testzip()
-                if zipcheck is not None:
-                    raise zipfile.BadZipfile("Zipfile {} failed internal checks".format(zipfilename))
-            except zipfile.BadZipfile as e:
-                raise zipfile.BadZipfile("Zipfile {} failed internal checks; {}".format(zipfilename,e))
-
-        sentinelNumber = int(os.path.basename(zipfilename)[1])
-        if sentinelNumber not in (1, 2, 3, 5):
-            msg = "Unknown Sentinel number '{}': {}".format(sentinelNumber, zipfilename)
-            ok = False
+        # With exitonziperror, the zipfile is about to be opened as a ZipFile, which 
+        # reads the same end-of-central-directory record, so don't check it twice
+        (ok, msg) = checkZipfileName(zipfilename, not cmdargs.exitonziperror)
+
+        # If the zipfile gets opened for checking, keep it open for reading the metadata
+        zf = None
+        try:
+            if cmdargs.exitonziperror:
+                try:
+                    zf = zipfile.ZipFile(zipfilename)
+                    # Decompressing every member to check its CRC is only worth it if the 
+                    # zipfile itself is to be stored. For the XML (and preview) alone, 
+                    # opening it has already checked the central directory. 
+                    if self.moveZipfiles:
+                        zipcheck = zf.testzip()
+                        if zipcheck is not None:
+                            raise zipfile.BadZipfile("Zipfile {} failed internal checks".format(zipfilename))
+                except zipfile.BadZipfile as e:
+                    raise zipfile.BadZipfile("Zipfile {} failed internal checks; {}".format(zipfilename,e))
+
+            # The name has been checked, so if ok this will be found
+            sentinelNumber = SENTINEL_NUMBERS.get(os.path.basename(zipfilename)[:2])
+
+            if ok and self.skipExistingXml:
+                existingXmlFile = findExistingXml(zipfilename, sentinelNumber, 
+                    cmdargs.storagetopdir, cmdargs.productdirgiven)
+                if existingXmlFile is not None:
+                    if verbose or dummy:
+                        print("XML already exists {}".format(existingXmlFile))
+                    return (None, None)
+
+            if ok:
+                try:
+                    metainfo = readMetainfo(zipfilename, sentinelNumber, cmdargs.metacachedir, zf)
+                except Exception as e:
+                    msg = "Exception '{}' raised reading: {}".format(str(e), zipfilename)
+                    ok = False
+        finally:
+            if zf is not None:
+                zf.close()
 
-        if ok:
-            try:
-                if sentinelNumber == 1:
-                    metainfo = sen1meta.Sen1ZipfileMeta(zipfilename=zipfilename)
-                elif sentinelNumber == 2:
-                    metainfo = sen2meta.Sen2ZipfileMeta(zipfilename=zipfilename)
-                elif sentinelNumber == 3:
-                    metainfo = sen3meta.Sen3ZipfileMeta(zipfilename=zipfilename)
-                elif sentinelNumber == 5:
-                    metainfo = sen5meta.Sen5Meta(ncfile=zipfilename)
-            except Exception as e:
-                msg = "Exception '{}' raised reading: {}".format(str(e), zipfilename)
-                ok = False
-        
         if ok:
             relativeOutputDir = dirstruct.makeRelativeOutputDir(metainfo, 
                 dirstruct.stdGridCellSize[sentinelNumber], 
                 productDirGiven=cmdargs.productdirgiven)
             finalOutputDir = os.path.join(cmdargs.storagetopdir, relativeOutputDir)
-            dirstruct.checkFinalDir(finalOutputDir, cmdargs.dummy, cmdargs.verbose)
-            
-            if sentinelNumber == 1:
-                finalXmlFile = dirstruct.createSentinel1Xml(zipfilename, finalOutputDir, metainfo, 
-                    cmdargs.dummy, cmdargs.verbose, cmdargs.nooverwrite, cmdargs.md5esa, cmdargs.makereadonly)
-            elif sentinelNumber == 2:
-                finalXmlFile = dirstruct.createSentinel2Xml(zipfilename, finalOutputDir, metainfo, 
-                    cmdargs.dummy, cmdargs.verbose, cmdargs.nooverwrite, cmdargs.md5esa, cmdargs.makereadonly)
-            elif sentinelNumber == 3:
-                finalXmlFile = dirstruct.createSentinel3Xml(zipfilename, finalOutputDir, metainfo, 
-                    cmdargs.dummy, cmdargs.verbose, cmdargs.nooverwrite, cmdargs.md5esa, cmdargs.makereadonly)
-            elif sentinelNumber == 5:
-                finalXmlFile = dirstruct.createSentinel5Xml(zipfilename, finalOutputDir, metainfo, 
-                    cmdargs.dummy, cmdargs.verbose, cmdargs.nooverwrite, cmdargs.md5esa, cmdargs.makereadonly)
-
-            if not cmdargs.xmlonly and not cmdargs.xmlandpreview:
-                dirstruct.moveZipfile(zipfilename, finalOutputDir, cmdargs.dummy, cmdargs.verbose, 
-                    cmdargs.copy, cmdargs.symlink, cmdargs.nooverwrite, cmdargs.moveandsymlink, cmdargs.makereadonly)
-                    
-            if not cmdargs.xmlonly and not cmdargs.nopreview:
-                if sentinelNumber != 3:
-                    dirstruct.createPreviewImg(zipfilename, finalOutputDir, metainfo, 
-                                               cmdargs.dummy, cmdargs.verbose, cmdargs.nooverwrite, cmdargs.makereadonly)
-                else:
-                    sen3thumb(zipfilename, finalOutputDir,
-                              cmdargs.dummy, cmdargs.verbose, cmdargs.nooverwrite, mountpath=cmdargs.mountpath)
-            # Post to SARA if there's a xmlfile and user credential is provided
-            if ':' in cmdargs.sarauser and finalXmlFile:
-                username,password = cmdargs.sarauser.split(':')
-                if username and password:
-                    saraurl=urljoin(cmdargs.saraurl,'S{}'.format(sentinelNumber))
-                    if cmdargs.dummy:
-                        print("Would post to SARA at {}".format(saraurl))
-                    else:
-                        postToSara(finalXmlFile, saraurl, username, password, 
-                                   verbose=cmdargs.verbose, update = cmdargs.updatesara)
+            dirstruct.checkFinalDir(finalOutputDir, dummy, verbose)
+
+            # The preview image comes from metainfo, so can be made alongside everything
+            # else. If the zipfile is being copied or linked, rather than moved, that can 
+            # also go alongside making the XML, which reads the zipfile to hash it. A 
+            # plain move has to wait until that is done. The Sentinel-3 thumbnail needs 
+            # the zipfile in place, so is done at the end. 
+            sourceStays = (cmdargs.copy or cmdargs.symlink or cmdargs.hardlink)
+            moveArgs = (zipfilename, finalOutputDir, dummy, verbose, cmdargs.copy, 
+                cmdargs.symlink, nooverwrite, cmdargs.moveandsymlink, makereadonly)
+            with futures.ThreadPoolExecutor(max_workers=2) as executor:
+                jobList = []
+                if self.makePreviews and sentinelNumber != 3:
+                    jobList.append(executor.submit(dirstruct.createPreviewImg, zipfilename, 
+                        finalOutputDir, metainfo, dummy, verbose, nooverwrite, makereadonly))
+                if self.moveZipfiles and sourceStays:
+                    jobList.append(executor.submit(dirstruct.moveZipfile, *moveArgs, 
+                        makeHardlink=cmdargs.hardlink))
+
+                finalXmlFile = CREATE_XML_FUNCS[sentinelNumber](zipfilename, finalOutputDir, metainfo, 
+                    dummy, verbose, nooverwrite, cmdargs.md5esa, makereadonly)
+                if self.moveZipfiles and not sourceStays:
+                    dirstruct.moveZipfile(*moveArgs, makeHardlink=cmdargs.hardlink)
+
+                # Re-raise anything which went wrong in the background
+                for job in jobList:
+                    job.result()
+
+            if self.makePreviews and sentinelNumber == 3:
+                sen3thumb(zipfilename, finalOutputDir,
+                          dummy, verbose, nooverwrite, mountpath=cmdargs.mountpath)
+            # Post to SARA if there's a xmlfile and user credential is provided. This
+            # is left to the caller, so that it is not done from many processes at once. 
+            if self.saraCredentials is not None and finalXmlFile:
+                saraurl=urljoin(cmdargs.saraurl,'S{}'.format(sentinelNumber))
+                saraPost = (finalXmlFile, saraurl)
 
         if not ok:
-            filesWithErrors.append(msg)
-    
-    # Report files which had errors
-    if len(filesWithErrors) > 0:
-        if cmdargs.errorlog is not None:
-            f = open(cmdargs.errorlog, 'w')
+            return (msg, None)
+        return (None, saraPost)
+
+    def postToSara(self, saraPost):
+        """
+        Post the XML file to SARA, as returned by processing a zipfile, i.e. a tuple 
+        of (finalXmlFile, saraurl). 
+        """
+        (finalXmlFile, saraurl) = saraPost
+        (username, password) = self.saraCredentials
+        if self.cmdargs.dummy:
+            print("Would post to SARA at {}".format(saraurl))
         else:
-            f = sys.stderr
-        for msg in filesWithErrors:
-            f.write(msg+'\n')
+            postToSara(finalXmlFile, saraurl, username, password, 
+                       verbose=self.cmdargs.verbose, update=self.cmdargs.updatesara)
+
+
+def findExistingXml(zipfilename, sentinelNumber, storagetopdir, productDirGiven):
+    """
+    Look for an XML file for the given zipfile which is already in the storage
+    directories, without reading the zipfile's metadata. The year and month 
+    directories are taken from the first date/time in the zipfile name, and the 
+    other levels are matched with wildcards. Returns the name of the XML file, 
+    or None if there isn't one (or the name has no date/time in it). 
+    """
+    dateMatch = SENSINGDATE_REGEX.search(os.path.basename(zipfilename))
+    if dateMatch is None:
+        return None
+    (year, month) = dateMatch.groups()
+
+    suffix = '.nc' if sentinelNumber == 5 else '.zip'
+    xmlBasename = os.path.basename(dirstruct.makeFinalFilename(zipfilename, '', suffix, '.xml'))
+    pathPieces = [storagetopdir]
+    if not productDirGiven:
+        pathPieces.extend(["Sentinel-{}".format(sentinelNumber), "*", "*"])
+    pathPieces.extend([year, "{}-{}".format(year, month), "*", xmlBasename])
+    existingList = glob.glob(os.path.join(*pathPieces))
+    if len(existingList) > 0:
+        return existingList[0]
+    return None
 
 
-def checkZipfileName(zipfilename):
+def readMetainfo(zipfilename, sentinelNumber, cacheDir, zf=None):
     """
-    Check for some obvious errors with the zipfile name. 
+    Read the metadata object for the given zipfile. If cacheDir is not None, 
+    then look for it there first, and save it there if it had to be read. 
+    If the caller already has the zipfile open, the zipfile.ZipFile object can be 
+    given as zf, otherwise it is opened (and closed) here, only if required. 
+    """
+    cacheFilename = None
+    if cacheDir is not None:
+        statInfo = os.stat(zipfilename)
+        key = repr((os.path.abspath(zipfilename), statInfo.st_size, statInfo.st_mtime))
+        keyHash = hashlib.md5(key.encode('utf-8')).hexdigest()
+        cacheFilename = os.path.join(cacheDir, keyHash[:2], keyHash+".pkl")
+        if os.path.exists(cacheFilename):
+            try:
+                with open(cacheFilename, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                # A broken cache entry is no worse than no entry, so read it again
+                pass
+
+    if sentinelNumber == 5:
+        metainfo = sen5meta.Sen5Meta(ncfile=zipfilename)
+    else:
+        openedHere = (zf is None)
+        if openedHere:
+            zf = zipfile.ZipFile(zipfilename, 'r')
+        try:
+            metaClass = ZIPFILE_META_CLASSES[sentinelNumber]
+            metainfo = metaClass(zipfilename=zipfilename, zipfileObj=zf)
+        finally:
+            if openedHere:
+                zf.close()
+    
+    # Some metadata classes only make their footprint when it is first used. The XML
+    # always needs it, so make it now, so that any failure is reported as an error 
+    # reading this file, and the cached copy already has it. 
+    if isinstance(metainfo, geomutils.LazyFootprintMixin):
+        metainfo.makeFootprint()
+    
+    if cacheFilename is not None:
+        saveMetainfo(metainfo, cacheFilename)
+    return metainfo
+
+
+def saveMetainfo(metainfo, cacheFilename):
+    """
+    Pickle the metainfo object into the given cache file. It is written to a
+    temporary name and then renamed, so other processes never see a partial file. 
+    Failure to save is not an error, as it only means it will be read again next time. 
+    """
+    cacheSubdir = os.path.dirname(cacheFilename)
+    tmpFilename = "{}.{}.tmp".format(cacheFilename, os.getpid())
+    try:
+        if not os.path.isdir(cacheSubdir):
+            try:
+                os.makedirs(cacheSubdir)
+            except OSError:
+                # Probably made by another process in the meantime
+                pass
+        with open(tmpFilename, 'wb') as f:
+            pickle.dump(metainfo, f, pickle.HIGHEST_PROTOCOL)
+        dirstruct.replaceFile(tmpFilename, cacheFilename)
+    except Exception:
+        if os.path.exists(tmpFilename):
+            os.remove(tmpFilename)
+
+
+def checkZipfileName(zipfilename, checkIsZipfile=True):
+    """
+    Check for some obvious errors with the zipfile name. If checkIsZipfile is True, 
+    also check that a .zip file really is a zipfile. This only reads the 
+    end-of-central-directory record at the tail of the file, not the whole archive. 
     Return a tuple (ok, msg), where ok is True if everything OK, and msg is a string
     with an explanation of any error (None if no error). 
     
@@ -213,17 +494,22 @@ def checkZipfileName(zipfilename):
     ok = True
     msg = None
     zipfileBasename = os.path.basename(zipfilename)
-    if not os.path.exists(zipfilename):
-        msg = "File not found: {}".format(zipfilename)
-        ok = False
-    elif not os.access(zipfilename, os.R_OK):
-        msg = "No read permission: {}".format(zipfilename)
-        ok = False
-    elif zipfilename.endswith('.zip') and not zipfile.is_zipfile(zipfilename):
-        msg = "Is not a zipfile: {}".format(zipfilename)
+    # Just open it, rather than checking existence and permissions separately first,
+    # as each of those is another trip to the (possibly remote) filesystem
+    try:
+        with open(zipfilename, 'rb') as f:
+            if checkIsZipfile and zipfilename.endswith('.zip') and not zipfile.is_zipfile(f):
+                msg = "Is not a zipfile: {}".format(zipfilename)
+                ok = False
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            msg = "File not found: {}".format(zipfilename)
+        elif e.errno == errno.EACCES:
+            msg = "No read permission: {}".format(zipfilename)
+        else:
+            msg = "Unable to open '{}': {}".format(zipfilename, str(e))
         ok = False
-    elif not (zipfileBasename.startswith("S") and len(zipfileBasename) > 2 and 
-            zipfileBasename[1].isdigit()):
+    if ok and not (len(zipfileBasename) > 2 and zipfileBasename[:2] in SENTINEL_NUMBERS):
         msg = "Zipfile name non-standard, cannot identify Sentinel: {}".format(zipfilename)
         ok = False
     return (ok, msg)
@@ -35,24 +35,27 @@ def mainRoutine():
     cmdargs = getCmdargs()
     
     urlOpener = saraclient.makeUrlOpener(proxy=cmdargs.proxy)
+    # Tiny square in the centre of Canberra, so only one thing will ever overlap it. 
+    # The same one is used for every test. 
+    canberraRoi = makeCanberraRoi()
     
     numTests = 0
     countPassed = 0
     
     # test Sentinel-1
-    ok = testSearch(urlOpener, 1, "2017-01-08")
+    ok = testSearch(urlOpener, canberraRoi, 1, "2017-01-08")
     numTests += 1
     if ok:
         countPassed += 1
 
     # test Sentinel-2
-    ok = testSearch(urlOpener, 2, "2017-01-05")
+    ok = testSearch(urlOpener, canberraRoi, 2, "2017-01-05")
     numTests += 1
     if ok:
         countPassed += 1
 
     # test Sentinel-3
-    ok = testSearch(urlOpener, 3, "2017-01-08")
+    ok = testSearch(urlOpener, canberraRoi, 3, "2017-01-08")
     numTests += 1
     if ok:
         countPassed += 1
@@ -61,13 +64,12 @@ def mainRoutine():
 
 
 
-def testSearch(urlOpener, sentinel, date):
+def testSearch(urlOpener, canberraRoi, sentinel, date):
     """
-    Test a search query and briefly report the results. 
+    Test a search query over the given canberraRoi WKT string, and briefly 
+    report the results. 
     """
     ok = True
-    # Tiny square in the centre of Canberra, so only one thing will ever overlap it. 
-    canberraRoi = makeCanberraRoi()
     
     paramList = ['startDate={}T00:00:00'.format(date), 
         'completionDate={}T23:59:59'.format(date), 
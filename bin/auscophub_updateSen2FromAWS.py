@@ -11,18 +11,38 @@ from __future__ import print_function, division
 import sys
 import os
 import argparse
+import re
 import tempfile
 import datetime
 import subprocess
 import zipfile
 import json
 import threading
+from concurrent import futures
 try:
     # Python-3 name
     import queue
 except ImportError:
     # Python-2 name
     import Queue as queue
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from s3transfer.manager import TransferManager, TransferConfig
+except ImportError:
+    boto3 = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+AWS_BUCKET = "sentinel-s2-l1c-zips"
+AWS_REGION = "eu-central-1"
+# Pipe buffer size when streaming output from the aws command
+STREAM_BUFSIZE = 1 << 20
+# Matches the base name of each line of an exclude list, without any '.zip' suffix
+EXCLUDE_NAME_REGEX = re.compile(r"^[ \t]*(?:[^\n]*/)?([^/\n]*?)(?:\.zip)?[ \t\r]*$", re.MULTILINE)
 
 
 def getCmdargs():
@@ -58,16 +78,30 @@ def mainRoutine():
     
     errMsgList = []
     
-    excludeSet = getExclusionSet(cmdargs)
-    esaList = queryEsaServer(cmdargs, errMsgList)
-    awsSet = queryAws(cmdargs, errMsgList)
+    # The ESA and AWS queries are independent network calls, so run them 
+    # concurrently. Each has its own list of error messages, so they are not 
+    # appending to the same list. 
+    (esaErrMsgList, awsErrMsgList) = ([], [])
+    with futures.ThreadPoolExecutor(2) as executor:
+        esaJob = executor.submit(queryEsaServer, cmdargs, esaErrMsgList)
+        awsJob = executor.submit(queryAws, cmdargs, awsErrMsgList)
+        excludeSet = getExclusionSet(cmdargs)
+        esaList = esaJob.result()
+        awsSizeDict = awsJob.result()
+    errMsgList.extend(esaErrMsgList)
+    errMsgList.extend(awsErrMsgList)
     
-    listForDownload = [entry for entry in esaList if entry['esaId'] in awsSet and 
-        entry['esaId'] not in excludeSet]
-    
-    zipfileList = ["{}.zip".format(entry['esaId']) for entry in listForDownload]
+    # The IDs we could download are worked out with one set difference, so each ESA
+    # entry then needs just one lookup
+    eligibleIdSet = set(awsSizeDict).difference(excludeSet)
+    zipfileList = ["{}.zip".format(entry['esaId']) for entry in esaList 
+        if entry['esaId'] in eligibleIdSet]
+    (zipfileList, alreadyPresentList) = findLocalZipfiles(zipfileList, awsSizeDict, 
+        cmdargs.dummy)
 
     (successList, failureList) = doDownloads(zipfileList, cmdargs)
+    # Files left from an earlier run are reported along with the new downloads
+    successList = alreadyPresentList + successList
     if len(failureList) > 0:
         msg = '\n'.join(failureList)
         errMsgList.append(msg)
@@ -91,16 +125,16 @@ def getExclusionSet(cmdargs):
     we already have them). Input is a text file of these strings, optionally including 
     their full path, i.e. as full file names, or just as plain ID strings. 
     
-    Each one is run through os.path.basename() and .replace('.zip', '') in order to 
-    strip away the extra details and make ID strings. 
+    The whole file is read at once, and EXCLUDE_NAME_REGEX picks out the base name 
+    of each line, without any '.zip' suffix, in order to strip away the extra details 
+    and make ID strings. 
     
     """
     if cmdargs.excludelist is not None and os.path.exists(cmdargs.excludelist):
-        excludeList = [line.strip() for line in open(cmdargs.excludelist)]
-        excludeList = [os.path.basename(fn).replace('.zip', '') for fn in excludeList]
-        excludeSet = set(excludeList)
+        with open(cmdargs.excludelist) as f:
+            excludeSet = frozenset(EXCLUDE_NAME_REGEX.findall(f.read()))
     else:
-        excludeSet = set()
+        excludeSet = frozenset()
     
     return excludeSet
 
@@ -144,7 +178,12 @@ def queryEsaServer(cmdargs, errMsgList):
 
         if os.path.exists(jsonFile):
             try:
-                esaList = json.load(open(jsonFile))
+                with open(jsonFile, 'rb') as f:
+                    jsonBytes = f.read()
+                if orjson is not None:
+                    esaList = orjson.loads(jsonBytes)
+                else:
+                    esaList = json.loads(jsonBytes)
             except Exception:
                 esaList = []
             os.remove(jsonFile)
@@ -161,81 +200,238 @@ def queryAws(cmdargs, errMsgList):
     Get a full listing of the current AWS Sentinel-2 zips bucket. At this point we are unable
     to distinguish which ones we need, so just get a full listing. 
     
-    Assume we have the AWS CLI installed and configured. 
+    If boto3 is available, the listing is paged through with boto3, otherwise 
+    assume we have the AWS CLI installed and configured. 
+    
+    Return a dictionary of the sizes (in bytes) of all the zip files held on AWS, 
+    keyed by their ESA ID strings. 
+    
+    """
+    if boto3 is not None:
+        awsSizeDict = queryAwsBoto(cmdargs, errMsgList)
+    else:
+        awsSizeDict = queryAwsCli(cmdargs, errMsgList)
+    return awsSizeDict
+
+
+def queryAwsBoto(cmdargs, errMsgList):
+    """
+    List the AWS bucket using a boto3 list_objects_v2 paginator, which hands back
+    the object keys already parsed, a page at a time. 
+    
+    """
+    s3client = makeS3Client(cmdargs)
+    paginator = s3client.get_paginator('list_objects_v2')
+    pageIterator = paginator.paginate(Bucket=AWS_BUCKET, RequestPayer='requester',
+        PaginationConfig={'PageSize': 1000})
+    try:
+        awsSizeDict = dict((obj['Key'].split('.')[0], obj['Size']) 
+            for page in pageIterator for obj in page.get('Contents', []))
+    except Exception as e:
+        msg = "Error querying AWS bucket. Exception was:\n{}".format(str(e))
+        errMsgList.append(msg)
+        awsSizeDict = {}
     
-    Return a set() of the ESA ID strings for all the zip files held on AWS. 
+    return awsSizeDict
+
+
+def queryAwsCli(cmdargs, errMsgList):
+    """
+    List the AWS bucket by running the aws CLI command. Each line of its output
+    is "date time size name". 
     
     """
     cmdList = [
-        "aws", "s3", "ls", "sentinel-s2-l1c-zips", "--request-payer", "requester",
-        "--region", "eu-central-1"
+        "aws", "s3", "ls", AWS_BUCKET, "--request-payer", "requester",
+        "--region", AWS_REGION
     ]
     
-    env = os.environ.copy()
-    if cmdargs.proxy is not None:
-        env['https_proxy'] = cmdargs.proxy
+    env = makeAwsCliEnv(cmdargs)
     
     ok = True
     try:
         proc = subprocess.Popen(cmdList, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env)
+            env=env, bufsize=STREAM_BUFSIZE, universal_newlines=True)
     except OSError as e:
         msg = "Unable to access aws command\nException={}".format(str(e))
         errMsgList.append(msg)
         ok = False
 
-    awsSet = set()
+    awsSizeDict = {}
     if ok:
-        (stdout, stderr) = proc.communicate()
+        # The listing can be very large, so read it a line at a time rather than
+        # holding the whole thing in memory. Stderr is drained by a separate thread, 
+        # so the command cannot block on a full stderr pipe. 
+        stderrList = []
+        stderrThread = threading.Thread(target=lambda: stderrList.append(proc.stderr.read()))
+        stderrThread.daemon = True
+        stderrThread.start()
+
+        for line in proc.stdout:
+            fields = line.split()
+            if len(fields) > 0:
+                zipfileName = fields[-1]
+                esaId = zipfileName.split('.')[0]
+                size = None
+                if len(fields) >= 4 and fields[-2].isdigit():
+                    size = int(fields[-2])
+                awsSizeDict[esaId] = size
+        proc.stdout.close()
+        proc.wait()
+        stderrThread.join()
+        stderr = stderrList[0]
 
         if len(stderr) > 0:
             msg = "Error querying AWS bucket. Stderr was:\n{}".format(stderr)
             errMsgList.append(msg)
+    
+    return awsSizeDict
 
-        lineList = stdout.split('\n')
-        for line in lineList:
-            if len(line) > 0:
-                zipfileName = line.strip().split()[-1]
-                esaId = zipfileName.split('.')[0]
-                awsSet.add(esaId)
+
+def findLocalZipfiles(zipfileList, awsSizeDict, dummy):
+    """
+    Split zipfileList into those which still need to be downloaded, and those 
+    which are already in the current directory (e.g. left by an earlier run which did 
+    not finish), at the same size as on AWS. The directory is listed once, and only 
+    those names which appear in it are checked for size. 
+    
+    Return a tuple of lists (zipfilesToDownload, zipfilesAlreadyPresent). 
+    
+    """
+    localNameSet = set(os.listdir('.'))
+    zipfilesToDownload = []
+    zipfilesAlreadyPresent = []
+    for zipfileName in zipfileList:
+        awsSize = awsSizeDict.get(zipfileName.split('.')[0])
+        if (zipfileName in localNameSet and awsSize is not None and 
+                os.path.getsize(zipfileName) == awsSize):
+            if dummy:
+                print("Already have", zipfileName)
+            zipfilesAlreadyPresent.append(zipfileName)
+        else:
+            zipfilesToDownload.append(zipfileName)
     
-    return awsSet
+    return (zipfilesToDownload, zipfilesAlreadyPresent)
 
     
 def doDownloads(zipfileList, cmdargs):
     """
-    Do downloads from AWS, using a Queue of parallel threads, each of which 
-    spawns an asynchronous subprocess to run the aws download command. 
+    Do downloads from AWS. If boto3 is available, these are all done through a 
+    single TransferManager, which shares one S3 client (and its connection pool) 
+    between all transfers. Otherwise, fall back to a Queue of parallel threads, 
+    each of which spawns a subprocess to run the aws download command. 
+    
+    """
+    if cmdargs.dummy:
+        (successList, failureList) = (zipfileList, [])
+    elif boto3 is not None:
+        (successList, failureList) = doBotoDownloads(zipfileList, cmdargs)
+    else:
+        (successList, failureList) = doCliDownloads(zipfileList, cmdargs)
+    
+    return (successList, failureList)
+
+
+def doBotoDownloads(zipfileList, cmdargs):
+    """
+    Download all the zip files through one boto3 TransferManager, with up to 
+    cmdargs.numdownloadthreads requests in flight at once. 
     
     """
-    downloadQueue = queue.Queue(maxsize=cmdargs.numdownloadthreads)
     successList = []
     failureList = []
     
-    if not cmdargs.dummy:
-        # Start parallel threads
-        for i in range(cmdargs.numdownloadthreads):
-            t = threading.Thread(target=downloadWorker, 
-                args=(downloadQueue, successList, failureList, cmdargs))
-            t.daemon = True
-            t.start()
+    s3client = makeS3Client(cmdargs)
+    transferConfig = TransferConfig(max_request_concurrency=cmdargs.numdownloadthreads)
+    
+    with TransferManager(s3client, config=transferConfig) as manager:
+        transferList = [(zipfileName, manager.download(AWS_BUCKET, zipfileName, zipfileName, 
+                extra_args={'RequestPayer': 'requester'}))
+            for zipfileName in zipfileList]
+        
+        for (zipfileName, transfer) in transferList:
+            try:
+                transfer.result()
+                errMsg = ""
+            except Exception as e:
+                errMsg = str(e)
+            # The transfer does a head_object before downloading, and records the size
+            size = transfer.meta.size
+            if checkDownloadedZipfile(zipfileName, size, errMsg, failureList):
+                successList.append(zipfileName)
+    
+    return (successList, failureList)
 
-        # Put all the zip file names into the queue
-        for zipfileName in zipfileList:
-            downloadQueue.put(zipfileName)
 
-        # Wait for them all to complete
-        downloadQueue.join()
-    else:
-        successList = zipfileList
+def makeS3Client(cmdargs):
+    """
+    Return a boto3 S3 client for the region holding the zips bucket, going 
+    through the proxy, if one was given. 
+    
+    """
+    proxies = None
+    if cmdargs.proxy is not None:
+        proxies = {'https': cmdargs.proxy}
+    s3client = boto3.client('s3', region_name=AWS_REGION, 
+        config=BotoConfig(proxies=proxies))
+    return s3client
+
+
+def makeAwsCliEnv(cmdargs):
+    """
+    Return the environment in which to run the aws command, with the proxy set, if 
+    one was given. 
+    
+    """
+    env = os.environ.copy()
+    if cmdargs.proxy is not None:
+        env['https_proxy'] = cmdargs.proxy
+    return env
+
+
+def doCliDownloads(zipfileList, cmdargs):
+    """
+    Do downloads from AWS, using a Queue of parallel threads, each of which 
+    spawns an asynchronous subprocess to run the aws download command. 
+    
+    """
+    downloadQueue = queue.Queue()
+    # The environment is the same for every download
+    env = makeAwsCliEnv(cmdargs)
+    
+    # Start parallel threads. Each worker gets its own result lists, which 
+    # are only merged once all the downloads are finished. 
+    workerResults = []
+    for i in range(cmdargs.numdownloadthreads):
+        (workerSuccessList, workerFailureList) = ([], [])
+        t = threading.Thread(target=downloadWorker, 
+            args=(downloadQueue, workerSuccessList, workerFailureList, env))
+        t.daemon = True
+        t.start()
+        workerResults.append((workerSuccessList, workerFailureList))
+
+    # Put all the zip file names into the queue
+    for zipfileName in zipfileList:
+        downloadQueue.put(zipfileName)
+
+    # Wait for them all to complete
+    downloadQueue.join()
+    
+    successSet = set()
+    failureList = []
+    for (workerSuccessList, workerFailureList) in workerResults:
+        successSet.update(workerSuccessList)
+        failureList.extend(workerFailureList)
+    # Report successes in the same order as they were requested
+    successList = [zipfileName for zipfileName in zipfileList if zipfileName in successSet]
     
     return (successList, failureList)
 
 
-def downloadWorker(downloadQueue, successList, failureList, cmdargs):
+def downloadWorker(downloadQueue, successList, failureList, env):
     """
     A worker function, which does downloads drawn from the download queue. Multiple threads
-    will run one of these each. 
+    will run one of these each. The aws command is run with the given environment. 
     
     The model of how to do this comes from the Python documentation for the queue module. 
     
@@ -245,51 +441,73 @@ def downloadWorker(downloadQueue, successList, failureList, cmdargs):
         
         # Start an asynchronous process to do the download from AWS
         cmdList = [
-            "aws", "s3api", "get-object", "--bucket", "sentinel-s2-l1c-zips", 
-            "--key", zipfileName, "--region", "eu-central-1", "--request-payer", "requester", 
+            "aws", "s3api", "get-object", "--bucket", AWS_BUCKET, 
+            "--key", zipfileName, "--region", AWS_REGION, "--request-payer", "requester", 
             zipfileName
         ]
-        env = os.environ.copy()
-        if cmdargs.proxy is not None:
-            env['https_proxy'] = cmdargs.proxy
-        
         proc = subprocess.Popen(cmdList, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             env=env)
         # Wait for the process to complete
         (stdout, stderr) = proc.communicate()
         
-        # Decode the JSON report of the transfer
-        try:
-            awsTransferReport = json.load(stdout)
-        except Exception:
-            awsTransferReport = None
-
-        ok = True
-        if not os.path.exists(zipfileName):
-            msg = "Failed to download {}. Stderr from download: {}".format(zipfileName, stderr)
-            failureList.append(msg)
-            ok = False
-        elif not zipfile.is_zipfile(zipfileName):
-            msg = "Downloaded {}, but is not a zipfile. Stderr from download: {}".format(
-                zipfileName, stderr)
-            failureList.append(msg)
-            #os.remove(zipfileName)
-            os.rename(zipfileName, zipfileName.replace('.zip', '.zip.bad'))
-            ok = False
-        elif awsTransferReport is not None:
-            localFileStat = os.stat(zipfileName)
-            localFileSize = localFileStat.st_size
-            if 'ContentLength' in awsTransferReport and awsTransferReport['ContentLength'] != localFileSize:
-                msg = "Transferred {}, but file size {} does not match reported size {}. Stderr from download: {}".format(
-                    zipfileName, localFileSize, awsTransferReport['ContentLength'], stderr)
-                failureList.append(msg)
-                os.remove(zipfileName)
-                ok = False
-        
-        if ok:
+        # Decode the JSON report of the transfer. This is the output text itself, 
+        # not a file, and there is none if the command failed. 
+        awsTransferReport = None
+        if len(stdout) > 0:
+            try:
+                awsTransferReport = json.loads(stdout)
+            except ValueError:
+                pass
+
+        size = None
+        if awsTransferReport is not None:
+            size = awsTransferReport.get('ContentLength')
+        if checkDownloadedZipfile(zipfileName, size, stderr, failureList):
             successList.append(zipfileName)
         
         downloadQueue.task_done()
+
+
+def checkDownloadedZipfile(zipfileName, expectedSize, errMsg, failureList):
+    """
+    Check that the given zipfile was downloaded intact. If expectedSize is not None,
+    the local file size must match it. Any failure is appended to failureList, along 
+    with the given error message from the download. 
+    
+    Return True if the download is OK. 
+    
+    """
+    # A single open, with the size and the zipfile check both taken from 
+    # the open file, rather than separate exists/stat/is_zipfile calls each 
+    # looking up the file again
+    try:
+        with open(zipfileName, 'rb') as f:
+            localFileSize = os.fstat(f.fileno()).st_size
+            isZip = zipfile.is_zipfile(f)
+        exists = True
+    except (IOError, OSError):
+        exists = False
+
+    ok = True
+    if not exists:
+        msg = "Failed to download {}. Stderr from download: {}".format(zipfileName, errMsg)
+        failureList.append(msg)
+        ok = False
+    elif not isZip:
+        msg = "Downloaded {}, but is not a zipfile. Stderr from download: {}".format(
+            zipfileName, errMsg)
+        failureList.append(msg)
+        #os.remove(zipfileName)
+        os.rename(zipfileName, zipfileName.replace('.zip', '.zip.bad'))
+        ok = False
+    elif expectedSize is not None and expectedSize != localFileSize:
+        msg = "Transferred {}, but file size {} does not match reported size {}. Stderr from download: {}".format(
+            zipfileName, localFileSize, expectedSize, errMsg)
+        failureList.append(msg)
+        os.remove(zipfileName)
+        ok = False
+    
+    return ok
         
 
 if __name__ == "__main__":